@@ -0,0 +1,349 @@
+"""
+Benchmarks of the upload, thumbnail, listing, reconciliation and temporary link paths.
+
+Everything runs in this process, against a fresh SQLite database and media directory in a temporary directory,
+so no services are needed. Results are written as JSON, along with the commit they were measured at,
+and --compare prints how they changed from an earlier run, so regressions show up between commits:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --compare before.json [--suite listing --suite resize] [--quick]
+
+Suites:
+    resize          rendering one thumbnail, per source format and size, and thumbnail format
+    upload          POST /images/ and rendering its thumbnails, for tiers of 1, 4 and 16 heights
+    listing         queries and latency of GET /images/, for users with 10, 1k and 50k images
+    reconciliation  updating the thumbnails of every image of a user after a tier change
+    temporary_links resolution rate of temporary links and signed links
+"""
+from pathlib import Path
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+SUITES = {}
+
+
+def suite(function):
+    """Decorator registering a benchmark suite, a function returning a list of results"""
+    SUITES[function.__name__] = function
+    return function
+
+
+def setup_django(directory):
+    """Point Django at a database and media directory in the given directory, and create the tables"""
+    sys.path.insert(0, str(PROJECT_DIR))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "heximages.settings")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ["DJANGO_ALLOWED_HOSTS"] = "testserver"
+    os.environ["SQL_ENGINE"] = "django.db.backends.sqlite3"
+    os.environ["SQL_DATABASE"] = os.path.join(directory, "db.sqlite3")
+    os.environ["MEDIAFILES_DIR"] = os.path.join(directory, "media")
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command("migrate", run_syncdb=True, verbosity=0)
+
+
+def timings(durations):
+    """Summary of a list of durations, in milliseconds"""
+    return {
+        "median_ms": round(statistics.median(durations) * 1000, 3),
+        "min_ms": round(min(durations) * 1000, 3),
+        "max_ms": round(max(durations) * 1000, 3),
+    }
+
+
+def measure(function, repeat):
+    """Call the function `repeat` times, returns the duration of every call"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def noise_image(width, height):
+    """A photo-like image, noise is as expensive to decode and encode as real pictures, unlike flat colors"""
+    from PIL import Image as PILImage
+    return PILImage.merge("RGB", [PILImage.effect_noise((width, height), 64) for _ in range(3)])
+
+
+def jpeg_bytes(width, height):
+    from io import BytesIO
+    buffer = BytesIO()
+    noise_image(width, height).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def create_user(name, heights=(), **tier_fields):
+    """Create a user on a tier of its own with the given thumbnail heights, returns the auth user"""
+    from django.contrib.auth.models import User
+    from image_api.models import ImageAPIUser, ThumbnailHeight, Tier
+    tier = Tier.objects.create(name=name, **tier_fields)
+    tier.thumbnail_heights.add(*[ThumbnailHeight.objects.get_or_create(height=height)[0] for height in heights])
+    user = User.objects.create(username=name)
+    ImageAPIUser.objects.create(auth_user=user, tier=tier)
+    return user
+
+
+def api_client(user):
+    from rest_framework.test import APIClient
+    client = APIClient()
+    client.force_authenticate(user=user)
+    return client
+
+
+def bulk_create_images(user, count, heights=()):
+    """
+    Create `count` images of the user sharing one stored file, with READY thumbnails of the given heights,
+    without rendering or storing anything per image, so big users are quick to set up.
+    """
+    from django.core.files.base import ContentFile
+    from image_api.models import Blob, Image, Thumbnail, ThumbnailHeight
+    image_api_user = user.image_api_user
+    original = Blob.store(ContentFile(jpeg_bytes(640, 480)), "original.jpg")
+    renditions = {height: Blob.store(ContentFile(jpeg_bytes(height * 4 // 3, height)), "thumbnail.jpg", original, height, Thumbnail.JPEG, 80) for height in heights}
+    thumbnail_heights = {height: ThumbnailHeight.objects.get_or_create(height=height)[0] for height in heights}
+    for start in range(0, count, 1000):
+        images = Image.objects.bulk_create([
+            Image(name=f"image{i}", user=image_api_user, file=original.file.name, blob=original, content_hash=original.sha256)
+            for i in range(start, min(start + 1000, count))
+        ])
+        Thumbnail.objects.bulk_create([
+            Thumbnail(
+                image=image, thumbnail_height=thumbnail_heights[height], file=blob.file.name, blob=blob,
+                status=Thumbnail.READY, size=blob.size, content_hash=blob.sha256,
+            )
+            for image in images
+            for height, blob in renditions.items()
+        ])
+
+
+@suite
+def resize(args):
+    from image_api.rendering import FORMATS, format_supported, render_thumbnails
+    results = []
+    sizes = [1000] if args.quick else [1000, 4000]
+    repeat = 3 if args.quick else 5
+    with tempfile.TemporaryDirectory() as directory:
+        for width in sizes:
+            height = width * 3 // 4
+            image_pil = noise_image(width, height)
+            for source_format, extension in (("JPEG", ".jpg"), ("PNG", ".png")):
+                path = os.path.join(directory, f"source{extension}")
+                image_pil.save(path, format=source_format)
+                for format in FORMATS:
+                    if not format_supported(format):
+                        continue
+                    durations = measure(lambda: render_thumbnails(path, [200], format), repeat)
+                    results.append({
+                        "case": {"source": source_format.lower(), "size": f"{width}x{height}", "format": format, "height": 200},
+                        **timings(durations),
+                        "images_per_second": round(1 / statistics.median(durations), 2),
+                    })
+    return results
+
+
+@suite
+def upload(args):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from image_api.jobs import run_pending_jobs
+    results = []
+    repeat = 2 if args.quick else 5
+    for count in (1, 4, 16):
+        user = create_user(f"upload{count}", [100 + 50 * i for i in range(count)])
+        client = api_client(user)
+        upload_durations, render_durations = [], []
+        for i in range(repeat):
+            # every upload is a new picture, so nothing is reused from the blob storage
+            image_file = SimpleUploadedFile(name="upload.jpg", content=jpeg_bytes(2000, 1500), content_type="image/jpeg")
+            start = time.perf_counter()
+            response = client.post("/images/", {"name": f"upload{i}", "file": image_file})
+            upload_durations.append(time.perf_counter() - start)
+            assert response.status_code == 201, response.content
+            start = time.perf_counter()
+            run_pending_jobs()
+            render_durations.append(time.perf_counter() - start)
+        results.append({
+            "case": {"heights": count, "size": "2000x1500"},
+            "upload": timings(upload_durations),
+            "render": timings(render_durations),
+            **timings([upload + render for upload, render in zip(upload_durations, render_durations)]),
+        })
+    return results
+
+
+@suite
+def listing(args):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    results = []
+    repeat = 5 if args.quick else 20
+    for count in ((10, 1000) if args.quick else (10, 1000, 50000)):
+        user = create_user(f"listing{count}", [200, 400], can_get_original=True, can_get_temporary=True)
+        bulk_create_images(user, count, [200, 400])
+        client = api_client(user)
+        client.get("/images/")  # the first request imports and compiles what the others reuse
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get("/images/")
+        assert response.status_code == 200, response.content
+        results.append({
+            "case": {"images": count},
+            "queries": len(queries),
+            **timings(measure(lambda: client.get("/images/"), repeat)),
+        })
+    return results
+
+
+@suite
+def reconciliation(args):
+    from image_api.jobs import run_jobs
+    from image_api.models import Job, ThumbnailHeight, Tier
+    count = 200 if args.quick else 2000
+    user = create_user("reconciliation", [200])
+    bulk_create_images(user, count, [200])
+    image_api_user = user.image_api_user
+    bigger_tier = Tier.objects.create(name="reconciliation bigger")
+    bigger_tier.thumbnail_heights.add(ThumbnailHeight.objects.get(height=200), ThumbnailHeight.objects.get_or_create(height=400)[0])
+    results = []
+    for case, tier in (("add_height", bigger_tier), ("remove_height", image_api_user.tier)):
+        image_api_user.tier = tier
+        image_api_user.save()  # queues the reconciliation job
+        jobs = list(Job.objects.filter(kind=Job.RECONCILE_TIER, status=Job.QUEUED))
+        start = time.perf_counter()
+        run_jobs(jobs)
+        duration = time.perf_counter() - start
+        Job.objects.filter(kind=Job.RENDER_THUMBNAILS).delete()  # rendering isn't part of the reconciliation
+        results.append({
+            "case": {"change": case, "images": count},
+            **timings([duration]),
+            "images_per_second": round(count / duration, 2),
+        })
+    return results
+
+
+@suite
+def temporary_links(args):
+    from datetime import timedelta
+    from django.test import Client
+    from django.utils import timezone
+    from image_api.models import Image, TemporaryLink
+    from image_api.signing import sign_link
+    count = 200 if args.quick else 2000
+    user = create_user("temporary_links", [200], can_get_original=True, can_get_temporary=True)
+    bulk_create_images(user, 1, [200])
+    image = Image.objects.get(user__auth_user=user)
+    now = timezone.now()
+    links = TemporaryLink.objects.bulk_create([
+        TemporaryLink(image=image, duration=timedelta(hours=1), datetime_created=now, expires_at=now + timedelta(hours=1))
+        for _ in range(count)
+    ])
+
+    client = api_client(user)
+    paths = {
+        "temporary_link": [f"/temporary_links/{link.slug}/" for link in links],
+        # signed links need no authentication, a plain client doesn't pay for forcing it
+        "signed_link": [f"/signed/{sign_link(image.file.name, None, link.expires_at, link.slug)}" for link in links],
+    }
+    results = []
+    for kind, kind_paths in paths.items():
+        kind_client = client if kind == "temporary_link" else Client()
+        kind_client.get(kind_paths[0])
+        durations = []
+        for path in kind_paths:
+            start = time.perf_counter()
+            response = kind_client.get(path)
+            durations.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.content
+        results.append({
+            "case": {"kind": kind, "links": count},
+            **timings(durations),
+            "resolutions_per_second": round(len(durations) / sum(durations), 2),
+        })
+    return results
+
+
+def metrics(result, prefix=""):
+    """The numbers of a result, flattened to dotted names"""
+    for key, value in result.items():
+        if isinstance(value, dict):
+            if key != "case":
+                yield from metrics(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)):
+            yield f"{prefix}{key}", value
+
+
+def compare(baseline, report):
+    """Print the change of every metric from the baseline, rates are better higher and the rest lower"""
+    previous = {
+        (name, json.dumps(result["case"], sort_keys=True)): dict(metrics(result))
+        for name, results in baseline["suites"].items()
+        for result in results
+    }
+    print(f"compared to {baseline['commit'][:12]}, measured {baseline['datetime']}")
+    for name, results in report["suites"].items():
+        for result in results:
+            before = previous.get((name, json.dumps(result["case"], sort_keys=True)))
+            if before is None:
+                continue
+            case = " ".join(f"{key}={value}" for key, value in result["case"].items())
+            for metric, value in metrics(result):
+                if metric not in before or not before[metric] or metric.endswith(("min_ms", "max_ms")):
+                    continue
+                change = (value - before[metric]) / before[metric] * 100
+                worse = change < 0 if metric.endswith("per_second") else change > 0
+                flag = "  <-- regression" if worse and abs(change) >= 10 else ""
+                print(f"{name:<16}{case:<52}{metric:<24}{before[metric]:>12}{value:>12}{change:>+9.1f}%{flag}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=PROJECT_DIR, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suite", action="append", choices=SUITES, help="suite to run, can be repeated, all of them by default")
+    parser.add_argument("--quick", action="store_true", help="smaller cases and fewer repetitions, for a quick check")
+    parser.add_argument("--output", help="file the JSON results are written to, printed if it's not given")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "datetime": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "quick": args.quick,
+        "suites": {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        setup_django(directory)
+        for name in args.suite or SUITES:
+            print(f"running {name}", file=sys.stderr)
+            report["suites"][name] = SUITES[name](args)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    elif not args.compare:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(json.load(baseline), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Throughput and latency of the serving endpoints, with gunicorn's threaded workers (WSGI) and uvicorn workers (ASGI).
+
+Both servers are started from gunicorn.conf.py as the "serve" pool, with the same number of workers,
+and get a fresh SQLite database with one image, its thumbnail and a temporary link,
+then a pool of clients requests the three of them in turn for a fixed time.
+Files aren't sent, as that's nginx's job, so this measures what Django does for every file request.
+
+    python benchmarks/serve_load.py [--workers 2] [--concurrency 32] [--duration 10] [--json]
+"""
+from pathlib import Path
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+SERVER_MODES = ("wsgi", "asgi")
+
+
+def setup_django():
+    sys.path.insert(0, str(PROJECT_DIR))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "heximages.settings")
+    import django
+    django.setup()
+
+
+def create_fixtures():
+    """Create a user with an image, its thumbnail and a temporary link, returns the session cookie and the URLs to request"""
+    setup_django()
+    from datetime import timedelta
+    from django.contrib.auth.models import User
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import Client
+    from image_api.jobs import run_pending_jobs
+    from image_api.models import Image, ImageAPIUser, TemporaryLink, ThumbnailHeight, Tier
+
+    tier = Tier.objects.create(name="benchmark", can_get_original=True, can_get_temporary=True)
+    tier.thumbnail_heights.add(ThumbnailHeight.objects.create(height=200))
+    user = User.objects.create(username="benchmark")
+    image_api_user = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+    image = Image(name="benchmark", user=image_api_user)
+    with open(PROJECT_DIR / "image_api/test_files/TestImage.png", "rb") as file:
+        image.file = SimpleUploadedFile(name="TestImage.png", content=file.read(), content_type="image/png")
+    image.save()
+    run_pending_jobs()
+    link = TemporaryLink.objects.create(image=image, duration=timedelta(hours=1))
+
+    client = Client()
+    client.force_login(user)  # a session, as checking a password on every request would be all the benchmark measures
+    return client.cookies["sessionid"].value, ["/images/benchmark/", "/images/benchmark/thumbnail/200/", f"/temporary_links/{link.slug}/"]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except urllib.error.HTTPError:  # any response means the server is up
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"The server didn't start in {timeout} seconds")
+
+
+def load(base_url, paths, session, concurrency, duration):
+    """Request the paths in turn from `concurrency` threads for `duration` seconds, returns the latencies and the error count"""
+    latencies, errors = [], [0]
+    deadline = time.monotonic() + duration
+
+    def client(offset):
+        i = offset
+        while time.monotonic() < deadline:
+            request = urllib.request.Request(base_url + paths[i % len(paths)], headers={"Cookie": f"sessionid={session}"})
+            start = time.perf_counter()
+            try:
+                urllib.request.urlopen(request, timeout=30).read()
+            except OSError:
+                errors[0] += 1
+                continue
+            finally:
+                i += 1
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def benchmark(mode, env, paths, session, args):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn"],
+        cwd=PROJECT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        env={**env, "SERVER_MODE": mode, "GUNICORN_POOL": "serve", "GUNICORN_WORKERS": str(args.workers), "GUNICORN_BIND": f"127.0.0.1:{port}"},
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        wait_for(base_url + paths[0])
+        load(base_url, paths, session, args.concurrency, 1)  # warm up the workers
+        latencies, errors = load(base_url, paths, session, args.concurrency, args.duration)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests_per_second": len(latencies) / args.duration,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2, help="worker processes of both servers")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load per server")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--setup", action="store_true", help=argparse.SUPPRESS)  # used for the fixture process
+    args = parser.parse_args()
+
+    if args.setup:
+        session, paths = create_fixtures()
+        print(json.dumps({"session": session, "paths": paths}))
+        return
+
+    directory = tempfile.mkdtemp()
+    env = {
+        **os.environ,
+        "SECRET_KEY": os.environ.get("SECRET_KEY", "benchmark"),
+        "DJANGO_ALLOWED_HOSTS": "127.0.0.1",
+        "SQL_ENGINE": "django.db.backends.sqlite3",
+        "SQL_DATABASE": os.path.join(directory, "db.sqlite3"),
+        "MEDIAFILES_DIR": os.path.join(directory, "media"),
+    }
+    try:
+        subprocess.run([sys.executable, "manage.py", "migrate", "--run-syncdb"], cwd=PROJECT_DIR, env=env, check=True, capture_output=True)
+        output = subprocess.run([sys.executable, __file__, "--setup"], env=env, check=True, capture_output=True, text=True).stdout
+        fixtures = json.loads(output.splitlines()[-1])
+        results = [benchmark(mode, env, fixtures["paths"], fixtures["session"], args) for mode in SERVER_MODES]
+    finally:
+        shutil.rmtree(directory)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':<6}{'req/s':>10}{'p50':>10}{'p99':>10}{'errors':>8}")
+    for result in results:
+        print(f"{result['mode']:<6}{result['requests_per_second']:>10.1f}{result['p50_ms']:>8.1f}ms{result['p99_ms']:>8.1f}ms{result['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main()
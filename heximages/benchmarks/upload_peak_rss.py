@@ -0,0 +1,114 @@
+"""
+Peak RSS of handling one upload, before and after the header-only pixel budget check.
+
+"before" is what the upload path used to do: decode the whole image and resize it.
+"after" is the current one: the header is checked against the pixel budget, and images within it
+are rendered with draft()/reduce(), so the decode is bounded by the thumbnail size where the format allows it.
+Every case runs in a fresh process, so their peak RSS doesn't include the others.
+
+    python benchmarks/upload_peak_rss.py [--size 8000] [--height 200] [--json]
+"""
+from pathlib import Path
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+
+
+def setup_django():
+    sys.path.insert(0, str(PROJECT_DIR))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "heximages.settings")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("DJANGO_ALLOWED_HOSTS", "localhost")
+    import django
+    django.setup()
+
+
+def peak_rss_kib():
+    """Peak RSS of this process, VmHWM is used where it's available, as ru_maxrss survives the exec of the child processes"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+
+
+def run_case(case, path, height):
+    """Handle one upload the way the case does, in this process, returns the outcome"""
+    setup_django()
+    from django.conf import settings
+    from PIL import Image as PILImage
+    from image_api.rendering import render_thumbnails, size_for_height
+    from image_api.uploads import ImageTooLarge, check_image_size
+
+    if case == "baseline":
+        return "imports only"
+    if case == "before":
+        PILImage.MAX_IMAGE_PIXELS = None
+        image_pil = PILImage.open(path)
+        image_pil.resize(size_for_height(image_pil.size, height))
+        return "rendered"
+    with open(path, "rb") as file:
+        try:
+            check_image_size(file, settings.MAX_IMAGE_PIXELS, settings.MAX_IMAGE_DIMENSION)
+        except ImageTooLarge:
+            return "rejected"
+    render_thumbnails(path, [height])
+    return "rendered"
+
+
+def make_uploads(directory, size):
+    """A big JPEG, which draft() can decode at a fraction of its size, and a PNG over the default pixel budget"""
+    from PIL import Image as PILImage
+    paths = {}
+    image_pil = PILImage.new("RGB", (size, size * 3 // 4), "teal")
+    paths["jpeg"] = os.path.join(directory, "upload.jpg")
+    image_pil.save(paths["jpeg"], quality=90)
+    image_pil = PILImage.new("RGB", (size, size), "teal")
+    paths["png"] = os.path.join(directory, "upload.png")
+    image_pil.save(paths["png"])
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=8000, help="width of the generated uploads, in pixels")
+    parser.add_argument("--height", type=int, default=200, help="height of the rendered thumbnail")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--run", nargs=2, metavar=("CASE", "PATH"), help=argparse.SUPPRESS)  # used for the child processes
+    args = parser.parse_args()
+
+    if args.run:
+        outcome = run_case(args.run[0], args.run[1], args.height)
+        print(json.dumps({"outcome": outcome, "peak_rss_kib": peak_rss_kib()}))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for format, path in make_uploads(directory, args.size).items():
+            for case in ("baseline", "before", "after"):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--height", str(args.height), "--run", case, path],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                results.append({"format": format, "case": case, **json.loads(output.splitlines()[-1])})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'upload':<8}{'case':<10}{'outcome':<14}{'peak RSS':>12}")
+    for result in results:
+        print(f"{result['format']:<8}{result['case']:<10}{result['outcome']:<14}{result['peak_rss_kib'] / 1024:>9.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
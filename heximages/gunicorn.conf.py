@@ -0,0 +1,58 @@
+"""
+gunicorn settings, read from the environment.
+
+The app is served by two pools of workers, told apart by GUNICORN_POOL, and nginx sends each request to one of them:
+"serve" answers the API and the file requests, which are short and mostly wait on the database,
+so it runs many threads, while "upload" takes image uploads, which are long and read, hash and check every file,
+so it runs one request per worker, with a longer timeout. "all" is a single pool doing both.
+"""
+import multiprocessing
+import os
+
+POOL = os.environ.get("GUNICORN_POOL", "all")  # "serve", "upload" or "all"
+SERVER_MODE = os.environ.get("SERVER_MODE", "wsgi")  # see heximages/settings.py, uploads are always served by sync workers
+CPUS = multiprocessing.cpu_count()
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+if POOL == "upload":
+    workers = int(os.environ.get("GUNICORN_WORKERS", CPUS))
+    threads = int(os.environ.get("GUNICORN_THREADS", 1))
+    timeout = int(os.environ.get("GUNICORN_TIMEOUT", 300))  # seconds a request can take before its worker is killed
+else:
+    workers = int(os.environ.get("GUNICORN_WORKERS", CPUS * 2 + 1))
+    threads = int(os.environ.get("GUNICORN_THREADS", 4))
+    timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+
+if SERVER_MODE == "asgi" and POOL != "upload":
+    wsgi_app = "heximages.asgi:application"
+    worker_class = "uvicorn.workers.UvicornWorker"  # one event loop per worker, threads don't apply
+else:
+    wsgi_app = "heximages.wsgi:application"
+    worker_class = "gthread" if threads > 1 else "sync"
+
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))  # seconds workers get to finish their requests on restarts
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# workers are replaced after this many requests, returning the memory Pillow fragmented,
+# the jitter keeps them from all restarting at the same time
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 100))
+
+# the app is imported once in the master, so the workers share its modules copy-on-write, and replacing one is only a fork
+preload_app = bool(int(os.environ.get("GUNICORN_PRELOAD", 1)))
+
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"  # the heartbeat files of the workers, a disk backed directory can stall them
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG")  # "-" logs requests to stdout
+
+
+def when_ready(server):
+    """Import what the first request would, before the workers are forked, so they share it too"""
+    if not preload_app:
+        return
+    from django.urls import get_resolver
+    import PIL.Image
+    get_resolver().url_patterns  # the URLconf, and with it the views, DRF and the rendering code
+    PIL.Image.init()  # Pillow's format plugins
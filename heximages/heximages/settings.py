@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -71,6 +72,8 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'heximages.wsgi.application'
+ASGI_APPLICATION = 'heximages.asgi.application'
+SERVER_MODE = os.environ.get("SERVER_MODE", "wsgi")  # "wsgi" runs gunicorn's sync workers, "asgi" uvicorn workers and the async serving views
 
 
 # Database
@@ -127,6 +130,17 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / os.environ.get("MEDIAFILES_DIR", "mediafiles_dev")
+DEFAULT_FILE_STORAGE = "image_api.storage.AtomicFileSystemStorage"  # files only get their name once they're completely written
+
+# uploads are always spooled to a temporary file on the media volume, so they're never held in memory,
+# and storing them is a rename, see image_api/uploads.py
+FILE_UPLOAD_HANDLERS = ["image_api.uploads.MediaVolumeUploadHandler"]
+UPLOAD_TEMP_DIR = MEDIA_ROOT / ".uploads"
+UPLOAD_SESSION_MAX_AGE = int(os.environ.get("UPLOAD_SESSION_MAX_AGE", 24 * 60 * 60))  # seconds a resumable upload can take
+UPLOAD_SESSION_MAX_SIZE = int(os.environ.get("UPLOAD_SESSION_MAX_SIZE", 200 * 1024 * 1024))  # bytes a resumable upload can have
+# limits of uploaded images for tiers that don't set their own, decoding an image takes about 4 bytes per pixel
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 50_000_000))
+MAX_IMAGE_DIMENSION = int(os.environ.get("MAX_IMAGE_DIMENSION", 20_000))
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
@@ -134,3 +148,110 @@ MEDIA_ROOT = BASE_DIR / os.environ.get("MEDIAFILES_DIR", "mediafiles_dev")
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CSRF_TRUSTED_ORIGINS = ['http://localhost:8032']
+
+
+# Django REST framework
+
+REST_FRAMEWORK = {
+    "PAGE_SIZE": int(os.environ.get("API_PAGE_SIZE", 100)),
+}
+SILENCED_SYSTEM_CHECKS = ["rest_framework.W001"]  # pagination classes are set per view, PAGE_SIZE is their shared default
+
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 500))  # objects fetched per query by the streaming exports
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 100))  # images or temporary links created by one batch request
+
+
+# Signed temporary links
+
+SIGNED_LINK_SECRET = os.environ.get("SIGNED_LINK_SECRET", SECRET_KEY)  # shared with nginx when SIGNED_LINK_BACKEND is "nginx"
+SIGNED_LINK_BACKEND = os.environ.get("SIGNED_LINK_BACKEND", "django")  # "django" or "nginx"
+SIGNED_LINK_NGINX_PREFIX = "/secure/"
+SIGNED_LINK_CHECK_REVOCATION = int(os.environ.get("SIGNED_LINK_CHECK_REVOCATION", 0))  # if enabled, deleted TemporaryLinks stop working, at the cost of a query
+
+
+# Thumbnails
+
+THUMBNAIL_RENDERING = os.environ.get("THUMBNAIL_RENDERING", "eager")  # "eager" renders every tier height in the background after upload, "lazy" renders on the first request
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get("THUMBNAIL_CACHE_MAX_BYTES", 0))  # disk budget of lazily rendered thumbnails, 0 means unlimited
+THUMBNAIL_CACHE_SIZE_INTERVAL = 60  # seconds between measurements of the cache size, each process counts its own changes in between
+THUMBNAIL_CACHE_TOUCH_INTERVAL = 60  # seconds between updates of last_accessed of a thumbnail, so every hit isn't a write
+THUMBNAIL_LOCK_DIR = MEDIA_ROOT / ".locks"
+THUMBNAIL_QUALITY = 80  # encoder quality used for tiers that don't set their own
+# heights actually rendered for tiers allowing arbitrary heights, requests are served the closest bigger one
+THUMBNAIL_HEIGHT_LADDER = [int(height) for height in os.environ.get("THUMBNAIL_HEIGHT_LADDER", "100 200 400 800 1600").split()]
+
+
+# Blob storage
+
+BLOB_GC_GRACE = int(os.environ.get("BLOB_GC_GRACE", 3600))  # seconds an unreferenced blob is kept, so uploads in progress can still reuse it
+# levels of directories blobs are spread over, each named after the next two hex digits of their hash, so with 2 levels
+# a million blobs make about 15 files per directory. Existing blobs are moved by `manage.py migrate_media_layout`
+BLOB_SHARD_DEPTH = int(os.environ.get("BLOB_SHARD_DEPTH", 2))
+
+
+# Object storage, see image_api/object_storage.py
+
+# "filesystem" stores media files in MEDIA_ROOT, which every service has to share, "s3" in an S3 compatible object storage,
+# like MinIO, so services can run on any number of hosts. It needs django-storages and boto3
+MEDIA_STORAGE = os.environ.get("MEDIA_STORAGE", "filesystem")
+if MEDIA_STORAGE == "s3":
+    DEFAULT_FILE_STORAGE = "image_api.object_storage.ObjectStorage"
+# how files of the object storage are served: "redirect" sends clients to a presigned URL, "nginx" has nginx fetch it for them
+MEDIA_DELIVERY = os.environ.get("MEDIA_DELIVERY", "redirect")
+AWS_STORAGE_BUCKET_NAME = os.environ.get("S3_BUCKET", "heximages")
+AWS_S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")  # unset for AWS itself
+S3_PUBLIC_ENDPOINT_URL = os.environ.get("S3_PUBLIC_ENDPOINT_URL")  # the endpoint in redirects, when clients reach it at another address
+AWS_S3_REGION_NAME = os.environ.get("S3_REGION", "us-east-1")
+AWS_ACCESS_KEY_ID = os.environ.get("S3_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.environ.get("S3_SECRET_ACCESS_KEY")
+AWS_S3_SIGNATURE_VERSION = "s3v4"
+AWS_QUERYSTRING_EXPIRE = int(os.environ.get("S3_URL_EXPIRE", 3600))  # seconds presigned URLs are valid
+AWS_S3_FILE_OVERWRITE = True  # names of blobs are their hash, a file that's already there has the same content
+AWS_S3_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # files read from the object storage are spooled to disk above this size
+S3_MULTIPART_CHUNK_SIZE = int(os.environ.get("S3_MULTIPART_CHUNK_SIZE", 8 * 1024 * 1024))  # bytes, files bigger than this are uploaded in parts
+
+
+# HTTP caching
+
+IMAGE_CACHE_MAX_AGE = int(os.environ.get("IMAGE_CACHE_MAX_AGE", 3600))  # Cache-Control max-age of files, for tiers that don't set their own
+NGINX_AUTH_CACHE_SECONDS = int(os.environ.get("NGINX_AUTH_CACHE_SECONDS", 60))  # how long nginx reuses the authorization of a file request
+
+
+# Caches, see image_api/capabilities.py
+
+# the capabilities of users are kept by every process for CAPABILITIES_CACHE_TTL seconds, and changes made by other processes
+# can take that long to apply. With SHARED_CACHE_DIR, they're also kept in a file based cache shared by every process,
+# where changes to tiers and users invalidate them right away, and sessions are read from it instead of the DB.
+# It has to be a directory every service sees, like one on the media volume.
+CAPABILITIES_CACHE_TTL = int(os.environ.get("CAPABILITIES_CACHE_TTL", 5))
+CAPABILITIES_SHARED_CACHE_TTL = int(os.environ.get("CAPABILITIES_SHARED_CACHE_TTL", 300))
+SHARED_CACHE_DIR = os.environ.get("SHARED_CACHE_DIR")
+
+if SHARED_CACHE_DIR:
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "shared": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": BASE_DIR / SHARED_CACHE_DIR},
+    }
+    SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"  # written to both, so they survive the cache being cleared
+    SESSION_CACHE_ALIAS = "shared"
+
+
+# Background jobs
+
+JOB_LOCK_TIMEOUT = int(os.environ.get("JOB_LOCK_TIMEOUT", 600))  # seconds after which a running job is considered abandoned
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+RECONCILIATION_CHUNK_SIZE = int(os.environ.get("RECONCILIATION_CHUNK_SIZE", 500))  # images updated per transaction after a tier change
+THUMBNAIL_RETRY_AFTER = int(os.environ.get("THUMBNAIL_RETRY_AFTER", 2))  # seconds clients are told to wait for pending thumbnails
+
+
+# Instrumentation, see image_api/middleware.py
+
+METRICS_ENABLED = int(os.environ.get("METRICS_ENABLED", 0))  # request, query and rendering metrics, exposed at /metrics
+PROFILING_ENABLED = int(os.environ.get("PROFILING_ENABLED", 0))  # lets staff users profile their requests with PROFILING_HEADER
+PROFILING_HEADER = "X-Profile"
+PROFILING_DIR = Path(os.environ.get("PROFILING_DIR", Path(tempfile.gettempdir()) / "heximages-profiles"))
+
+if METRICS_ENABLED:
+    MIDDLEWARE.insert(0, "image_api.middleware.MetricsMiddleware")  # first, so it times the other middleware too
+if PROFILING_ENABLED:
+    MIDDLEWARE.append("image_api.middleware.ProfilingMiddleware")  # after AuthenticationMiddleware, it needs the user
@@ -25,6 +25,10 @@ urlpatterns = [
     path('', include('image_api.urls'))
 ]
 
+if settings.SERVER_MODE == "asgi":
+    # files are served by async views, which take precedence over the serving actions of the API views
+    urlpatterns.insert(2, path('', include('image_api.async_urls')))
+
 
 if bool(settings.DEBUG):
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User, Group
-from image_api.models import ImageAPIUser, Tier, Image, Thumbnail, ThumbnailHeight
+from image_api.models import ImageAPIUser, Tier, Image, Thumbnail, ThumbnailHeight, Job, TierReconciliation, Blob
 
 
 @admin.display(description="Tier")
@@ -41,3 +41,29 @@ admin.site.register(ThumbnailHeight)
 admin.site.register(Tier)
 admin.site.register(Image)
 admin.site.register(Thumbnail)
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'attempts', 'available_at', 'datetime_created')
+    list_filter = ('kind', 'status')
+
+
+@admin.action(description="Resume selected reconciliations")
+def resume_reconciliations(modeladmin, request, queryset):
+    for reconciliation in queryset.exclude(status=TierReconciliation.DONE):
+        Job.enqueue(Job.RECONCILE_TIER, reconciliation=reconciliation.pk)
+
+
+@admin.register(TierReconciliation)
+class TierReconciliationAdmin(admin.ModelAdmin):
+    list_display = ('user', 'status', 'images_done', 'images_total', 'datetime_created', 'datetime_updated')
+    list_filter = ('status',)
+    actions = (resume_reconciliations,)
+
+
+@admin.register(Blob)
+class BlobAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'source', 'height', 'format', 'size', 'datetime_referenced')
+    list_filter = ('format',)
+    search_fields = ('sha256',)
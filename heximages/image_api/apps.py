@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ImageApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'image_api'
+
+    def ready(self):
+        from image_api import capabilities  # noqa: F401, connects the signals invalidating the cached capabilities
@@ -0,0 +1,12 @@
+from django.urls import re_path
+from image_api import async_views
+
+# the list actions of the viewsets, which the router routes before their detail routes
+LIST_ACTIONS = r"(?!(?:export|batch)/$)"
+
+# the same routes as the router gives the serving actions of the viewsets, these are put before them in ASGI mode
+urlpatterns = [
+    re_path(rf'^images/{LIST_ACTIONS}(?P<name>[^/.]+)/$', async_views.image_detail, name='image-detail'),
+    re_path(r'^images/(?P<name>[^/.]+)/thumbnail/(?P<height>[\d]+)/$', async_views.image_thumbnail, name='image-thumbnail'),
+    re_path(rf'^temporary_links/{LIST_ACTIONS}(?P<slug>[^/.]+)/$', async_views.temporary_link_detail, name='temporarylink-detail'),
+]
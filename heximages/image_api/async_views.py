@@ -0,0 +1,126 @@
+"""
+Async views of the serving endpoints, used when the app runs in ASGI mode (SERVER_MODE="asgi", see gunicorn.conf.py).
+
+Serving a file is a few queries and an X-Accel-Redirect, so under uvicorn a worker waits on many of them at once,
+instead of holding a thread per request. Django 4.0 has no async ORM yet, so every lookup is one sync_to_async call,
+which runs in the thread of the request, and on demand rendering runs there too, off the event loop.
+Only GET and HEAD requests are answered here, the other methods are passed to the API views.
+"""
+from asgiref.sync import sync_to_async
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from image_api.capabilities import get_capabilities
+from image_api.http_cache import is_versioned_request
+from image_api.models import Image, TemporaryLink, Thumbnail
+from image_api.thumbnail_cache import get_or_render_thumbnail
+from image_api.views import (
+    ImageViewSet, TemporaryLinkViewSet, resolve_thumbnail_height, serve_image, serve_thumbnail, unready_thumbnail_response,
+)
+
+import functools
+
+
+def api_error(request, exc):
+    """The JSON response the API views return for an APIException"""
+    response = JsonResponse({"detail": exc.detail}, status=exc.status_code)
+    if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+        # like DRF, 401 is only returned if the first authentication class can tell how to authenticate
+        header = api_settings.DEFAULT_AUTHENTICATION_CLASSES[0]().authenticate_header(request)
+        if header:
+            response["WWW-Authenticate"] = header
+        else:
+            response.status_code = exceptions.PermissionDenied.status_code
+    return response
+
+
+def serving_view(api_view):
+    """Decorator of the async views, requests other than GET and HEAD are handled by the API view"""
+    api_view = sync_to_async(api_view)
+
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return await api_view(request, *args, **kwargs)
+            try:
+                return await view(request, *args, **kwargs)
+            except Http404:
+                return api_error(request, exceptions.NotFound())
+            except exceptions.APIException as exc:
+                return api_error(request, exc)
+
+        wrapper.csrf_exempt = True  # like the API views, SessionAuthentication checks CSRF itself
+        return wrapper
+    return decorator
+
+
+def authenticate(request):
+    """Authenticate the request with the API's authentication classes, returns the capabilities of the user"""
+    authenticators = [authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    if not Request(request, authenticators=authenticators).user.is_authenticated:
+        raise exceptions.NotAuthenticated()
+    return get_capabilities(request)
+
+
+def lookup_image(request, name):
+    capabilities = authenticate(request)
+    return capabilities, get_object_or_404(Image, user_id=capabilities.image_api_user_id, name=name)
+
+
+@sync_to_async
+def get_image(request, name):
+    return lookup_image(request, name)
+
+
+@sync_to_async
+def get_thumbnail(request, name, height):
+    """
+    Look up the image and the height of a thumbnail request, along with the thumbnail if it's rendered in the background,
+    it's None for thumbnails rendered on demand. Everything is done in one call, as each of them is a thread switch.
+    """
+    capabilities, image = lookup_image(request, name)
+    thumbnail_height, lazy = resolve_thumbnail_height(capabilities, height)
+    format = capabilities.negotiate_format(request.headers.get("Accept", ""))
+    thumbnail = None
+    if not lazy and format == Thumbnail.JPEG:
+        thumbnail = get_object_or_404(Thumbnail, image=image, thumbnail_height=thumbnail_height, format=Thumbnail.JPEG)
+    return capabilities, image, thumbnail_height, format, thumbnail
+
+
+@sync_to_async
+def get_temporary_link(request, slug):
+    capabilities = authenticate(request)
+    queryset = TemporaryLink.objects.active().select_related("image")
+    return capabilities, get_object_or_404(queryset, image__user_id=capabilities.image_api_user_id, slug=slug)
+
+
+@serving_view(ImageViewSet.as_view({"get": "retrieve", "put": "update", "patch": "partial_update", "delete": "destroy"}))
+async def image_detail(request, name):
+    capabilities, image = await get_image(request, name)
+    return serve_image(request, image, capabilities.cache_max_age, is_versioned_request(request, image.content_hash))
+
+
+@serving_view(ImageViewSet.as_view({"get": "thumbnail"}))
+async def image_thumbnail(request, name, height):
+    capabilities, image, thumbnail_height, format, thumbnail = await get_thumbnail(request, name, int(height))
+    hit = None
+    if thumbnail is None:
+        # other formats and lazy thumbnails are rendered by the first request for them
+        thumbnail, hit = await sync_to_async(get_or_render_thumbnail)(image, thumbnail_height, format, capabilities.thumbnail_quality)
+    else:
+        response = unready_thumbnail_response(thumbnail, JsonResponse)
+        if response is not None:
+            return response
+    return serve_thumbnail(request, image, thumbnail, thumbnail_height, format, capabilities.cache_max_age, hit)
+
+
+@serving_view(TemporaryLinkViewSet.as_view({"get": "retrieve", "put": "update", "patch": "partial_update", "delete": "destroy"}))
+async def temporary_link_detail(request, slug):
+    capabilities, temporary_link = await get_temporary_link(request, slug)
+    # the link mustn't outlive its expiry in any cache
+    max_age = min(capabilities.cache_max_age, (temporary_link.expires_at - timezone.now()).total_seconds())
+    return serve_image(request, temporary_link.image, max_age)
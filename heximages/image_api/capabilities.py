@@ -0,0 +1,172 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from image_api.models import ImageAPIUser, ThumbnailHeight, Tier
+from image_api.rendering import FORMATS, format_supported
+
+import time
+
+LOCAL_CACHE_MAX_ENTRIES = 10_000  # the local caches are emptied when they get this big, instead of tracking what's least used
+
+
+class TierCapabilities:
+    """
+    The features available to a user, resolved from their tier once per request.
+    Serializers get it through their context instead of walking from every object to its tier.
+    """
+
+    def __init__(self, image_api_user_id, tier_id, can_get_original, can_get_temporary, thumbnail_heights, min_thumbnail_height=None, max_thumbnail_height=None, thumbnail_formats=("jpeg",), thumbnail_quality=None, cache_max_age=None, max_pixels=None, max_dimension=None):
+        self.image_api_user_id = image_api_user_id
+        self.tier_id = tier_id
+        self.can_get_original = can_get_original
+        self.can_get_temporary = can_get_temporary
+        self.thumbnail_heights = thumbnail_heights
+        self.min_thumbnail_height = min_thumbnail_height
+        self.max_thumbnail_height = max_thumbnail_height
+        self.thumbnail_formats = thumbnail_formats
+        self.thumbnail_quality = thumbnail_quality
+        self.cache_max_age = settings.IMAGE_CACHE_MAX_AGE if cache_max_age is None else cache_max_age
+        self.max_pixels = max_pixels or settings.MAX_IMAGE_PIXELS
+        self.max_dimension = max_dimension or settings.MAX_IMAGE_DIMENSION
+
+    def allows_arbitrary_height(self, height):
+        """Whether the height is in the range of arbitrary thumbnail heights of the tier"""
+        if self.min_thumbnail_height is None or self.max_thumbnail_height is None:
+            return False
+        return self.min_thumbnail_height <= height <= self.max_thumbnail_height
+
+    def negotiate_format(self, accept):
+        """
+        Pick the first format of the tier that's explicitly listed in the Accept header and supported by Pillow.
+        Wildcards only match JPEG, which is also the fallback, as every client can display it.
+        """
+        accepted = set()
+        for media_range in accept.split(","):
+            media_type, _, parameters = media_range.partition(";")
+            if parameters.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                continue
+            accepted.add(media_type.strip().lower())
+        for format in self.thumbnail_formats:
+            if FORMATS.get(format, (None, None))[1] in accepted and format_supported(format):
+                return format
+        return "jpeg"
+
+    @staticmethod
+    def tier_fields(tier):
+        """The arguments coming from the tier, they're what's cached for every tier"""
+        return {
+            "can_get_original": tier.can_get_original,
+            "can_get_temporary": tier.can_get_temporary,
+            "thumbnail_heights": frozenset(tier.thumbnail_heights.values_list("height", flat=True)),
+            "min_thumbnail_height": tier.min_thumbnail_height,
+            "max_thumbnail_height": tier.max_thumbnail_height,
+            "thumbnail_formats": tuple(tier.thumbnail_formats.split()),
+            "thumbnail_quality": tier.thumbnail_quality,
+            "cache_max_age": tier.cache_max_age,
+            "max_pixels": tier.max_pixels,
+            "max_dimension": tier.max_dimension,
+        }
+
+    @classmethod
+    def for_image_api_user(cls, image_api_user):
+        return cls(image_api_user.pk, image_api_user.tier_id, **cls.tier_fields(image_api_user.tier))
+
+
+class CapabilityCache:
+    """
+    Values kept by the process for CAPABILITIES_CACHE_TTL seconds, in front of the shared cache, if there's one.
+    Invalidating a key drops it from both, but only for this process, the others see it once their copy expires.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._values = {}  # key: (expiry, value)
+
+    def shared_cache(self):
+        return caches["shared"] if "shared" in settings.CACHES else None
+
+    def get(self, key, load):
+        """The cached value of the key, or the one returned by load(), which is then cached"""
+        now = time.monotonic()
+        entry = self._values.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        shared_cache = self.shared_cache()
+        value = shared_cache.get(f"{self.prefix}:{key}") if shared_cache is not None else None
+        if value is None:
+            value = load()
+            if shared_cache is not None:
+                shared_cache.set(f"{self.prefix}:{key}", value, settings.CAPABILITIES_SHARED_CACHE_TTL)
+        if settings.CAPABILITIES_CACHE_TTL:
+            if len(self._values) >= LOCAL_CACHE_MAX_ENTRIES:
+                self._values.clear()
+            self._values[key] = (now + settings.CAPABILITIES_CACHE_TTL, value)
+        return value
+
+    def invalidate(self, key):
+        self._values.pop(key, None)
+        shared_cache = self.shared_cache()
+        if shared_cache is not None:
+            shared_cache.delete(f"{self.prefix}:{key}")
+
+    def clear(self):
+        self._values.clear()
+
+
+# users and tiers are cached apart, so a change of a tier is a single invalidation, however many users have it
+user_tiers = CapabilityCache("capabilities:user")  # auth user id: (ImageAPIUser id, tier id)
+tier_fields = CapabilityCache("capabilities:tier")  # tier id: TierCapabilities.tier_fields()
+
+
+def cached_capabilities(auth_user_id):
+    """The capabilities of a user, from the caches, only what they're missing is queried"""
+    loaded_tiers = {}
+
+    def load_user_tier():
+        image_api_user = ImageAPIUser.objects.select_related("tier").get(auth_user_id=auth_user_id)
+        loaded_tiers[image_api_user.tier_id] = image_api_user.tier  # fetched along, in case the tier isn't cached either
+        return image_api_user.pk, image_api_user.tier_id
+
+    image_api_user_id, tier_id = user_tiers.get(auth_user_id, load_user_tier)
+    fields = tier_fields.get(tier_id, lambda: TierCapabilities.tier_fields(loaded_tiers.get(tier_id) or Tier.objects.get(pk=tier_id)))
+    return TierCapabilities(image_api_user_id, tier_id, **fields)
+
+
+def get_capabilities(request):
+    """Return the capabilities of the request's user, they're looked up only on the first call for every request"""
+    http_request = getattr(request, "_request", request)  # store them on the Django request, shared by every DRF request wrapping it
+    if not hasattr(http_request, "tier_capabilities"):
+        http_request.tier_capabilities = cached_capabilities(request.user.pk)
+    return http_request.tier_capabilities
+
+
+@receiver(post_save, sender=ImageAPIUser)
+@receiver(post_delete, sender=ImageAPIUser)
+def invalidate_user_capabilities(sender, instance, **kwargs):
+    user_tiers.invalidate(instance.auth_user_id)
+
+
+@receiver(post_save, sender=Tier)
+@receiver(post_delete, sender=Tier)
+def invalidate_tier_capabilities(sender, instance, **kwargs):
+    tier_fields.invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender=Tier.thumbnail_heights.through)
+def invalidate_tier_thumbnail_heights(sender, instance, action, reverse, pk_set, **kwargs):
+    """Heights added to or removed from tiers, from either side of the relation"""
+    if not reverse and action in ("post_add", "post_remove", "post_clear"):
+        tier_fields.invalidate(instance.pk)
+    elif reverse and action in ("post_add", "post_remove"):
+        for tier_id in pk_set:
+            tier_fields.invalidate(tier_id)
+    elif reverse and action == "pre_clear":  # the tiers are only known before they're removed
+        invalidate_tiers_of_height(sender=ThumbnailHeight, instance=instance)
+
+
+@receiver(pre_delete, sender=ThumbnailHeight)
+def invalidate_tiers_of_height(sender, instance, **kwargs):
+    for tier_id in Tier.objects.filter(thumbnail_heights=instance).values_list("pk", flat=True):
+        tier_fields.invalidate(tier_id)
@@ -0,0 +1,56 @@
+"""
+HTTP caching of images, thumbnails and temporary links.
+
+Files are served with a strong ETag made from their content hash and a Last-Modified of the time they were written,
+both stored in the DB, so conditional requests are answered with 304 before the file is looked up.
+URLs carrying the version of the original image (?v=...) are content addressed, and can be cached forever.
+"""
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+VERSION_LENGTH = 16  # characters of the content hash used in ?v=
+
+
+def version(content_hash):
+    """The version of a file put in its URLs, empty for files without a hash"""
+    return content_hash[:VERSION_LENGTH]
+
+
+def versioned_url(url, content_hash):
+    if not content_hash:
+        return url
+    return f"{url}?v={version(content_hash)}"
+
+
+def is_versioned_request(request, content_hash):
+    """Whether the request is for a content addressed URL of the file with the given hash"""
+    return bool(content_hash) and request.GET.get("v") == version(content_hash)
+
+
+def not_modified(request, content_hash, last_modified):
+    """Return a 304 (or 412) response if the client's copy is still valid, None if the file has to be sent"""
+    if not content_hash:  # files written before hashes were stored, or not rendered yet
+        return None
+    return get_conditional_response(request, etag=quote_etag(content_hash), last_modified=last_modified and int(last_modified.timestamp()))
+
+
+def add_cache_headers(response, content_hash, last_modified, max_age, immutable=False):
+    """
+    Add the validators and Cache-Control to a file response.
+    Responses are private, as they depend on the user, and nginx only caches the outcome
+    of the authentication and lookup for NGINX_AUTH_CACHE_SECONDS, told by X-Accel-Expires.
+    """
+    max_age = max(int(max_age), 0)
+    if content_hash:
+        response["ETag"] = quote_etag(content_hash)
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    if immutable:
+        patch_cache_control(response, private=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, private=True, max_age=max_age)
+    if response.has_header("X-Accel-Redirect"):
+        response["X-Accel-Expires"] = min(max_age if not immutable else IMMUTABLE_MAX_AGE, settings.NGINX_AUTH_CACHE_SECONDS)
+    return response
@@ -0,0 +1,210 @@
+"""
+A small database backed job queue.
+
+Jobs are rows of the Job model, so no external broker is needed. Every job kind has a handler,
+which runs in the worker process and returns the CPU heavy part of the job as a (function, args, callback) tuple.
+The function is run in the worker's process pool, and the callback gets its result back in the worker process,
+where it's safe to use the ORM.
+"""
+from concurrent.futures import Future, as_completed
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from image_api.models import Blob, Image, Job, Thumbnail, ThumbnailHeight, TierReconciliation, batched_file_removal, reconcile_thumbnails, remove_paths
+from image_api.rendering import open_original, render_thumbnails, rendered_files
+from image_api import metrics
+
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+JOB_HANDLERS = {}
+JOB_FAILURE_HANDLERS = {}
+
+
+def job_handler(kind):
+    """Decorator registering the handler of a job kind"""
+    def decorator(function):
+        JOB_HANDLERS[kind] = function
+        return function
+    return decorator
+
+
+def job_failure_handler(kind):
+    """Decorator registering a function that's called when a job of the given kind fails for the last time"""
+    def decorator(function):
+        JOB_FAILURE_HANDLERS[kind] = function
+        return function
+    return decorator
+
+
+class InlineExecutor:
+    """Executor running everything in the current process, used when no process pool is needed"""
+
+    def submit(self, function, *args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def claim_jobs(limit):
+    """Mark up to `limit` available jobs as running and return them"""
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.JOB_LOCK_TIMEOUT)  # jobs of workers that crashed are picked up again
+    with transaction.atomic():
+        jobs = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(Q(status=Job.QUEUED, available_at__lte=now) | Q(status=Job.RUNNING, locked_at__lte=stale))
+            .order_by("available_at", "id")[:limit]
+        )
+        Job.objects.filter(pk__in=[job.pk for job in jobs]).update(status=Job.RUNNING, locked_at=now, attempts=F("attempts") + 1)
+    for job in jobs:
+        job.attempts += 1
+    return jobs
+
+
+def complete_job(job):
+    Job.objects.filter(pk=job.pk).update(status=Job.DONE, locked_at=None, last_error="")
+
+
+def fail_job(job, error):
+    """Retry the job with an exponential backoff, or give up on it if it ran out of attempts"""
+    logger.error("Job %s failed: %s", job.pk, error)
+    last_error = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+    if job.attempts >= settings.JOB_MAX_ATTEMPTS:
+        Job.objects.filter(pk=job.pk).update(status=Job.FAILED, locked_at=None, last_error=last_error)
+        if job.kind in JOB_FAILURE_HANDLERS:
+            JOB_FAILURE_HANDLERS[job.kind](job)
+    else:
+        available_at = timezone.now() + timedelta(seconds=2 ** job.attempts)
+        Job.objects.filter(pk=job.pk).update(status=Job.QUEUED, locked_at=None, available_at=available_at, last_error=last_error)
+
+
+def run_jobs(jobs, executor=None):
+    """Run the claimed jobs, sending their CPU heavy parts to the executor"""
+    executor = executor or InlineExecutor()
+    futures = {}
+    for job in jobs:
+        try:
+            work = JOB_HANDLERS[job.kind](job)
+            if work is None:  # nothing left to do
+                complete_job(job)
+                continue
+            function, args, callback = work
+            futures[executor.submit(function, *args)] = (job, callback)
+        except Exception as e:
+            fail_job(job, e)
+
+    for future in as_completed(futures):
+        job, callback = futures[future]
+        try:
+            callback(future.result())
+            complete_job(job)
+        except Exception as e:
+            fail_job(job, e)
+
+
+def run_pending_jobs(executor=None, batch_size=10):
+    """Run jobs until there are none available, returns the number of jobs that were run"""
+    count = 0
+    while jobs := claim_jobs(batch_size):
+        run_jobs(jobs, executor)
+        count += len(jobs)
+    return count
+
+
+def render_thumbnail_files(original_name, heights, quality=None):
+    """
+    Render the JPEG thumbnails of an original image, this runs in the process pool so it must not touch the DB.
+    The thumbnails are returned as the paths of their temporary files, to be opened with rendered_files(),
+    instead of sending their content between the processes. The Pillow timings are returned along with them,
+    as the pool processes aren't scraped.
+    """
+    with metrics.recording() as observations, open_original(original_name) as original:
+        rendered = render_thumbnails(original, heights, "jpeg", quality)
+    return {height: content.keep() for height, content in rendered.items()}, observations
+
+
+@job_handler(Job.RENDER_THUMBNAILS)
+def render_image_thumbnails(job):
+    image = Image.objects.select_related("user__tier").filter(pk=job.payload["image"]).first()
+    if image is None:  # the image was deleted before its thumbnails were rendered
+        return None
+    thumbnails = list(image.thumbnails.filter(status=Thumbnail.PENDING).select_related("thumbnail_height"))
+    if not thumbnails:
+        return None
+    quality = image.user.tier.thumbnail_quality or settings.THUMBNAIL_QUALITY
+    fields = ["file", "blob", "status", "size", "content_hash", "datetime_rendered"]
+
+    # renditions of the same original, stored for another image, are reused without rendering them again
+    renditions = Blob.find_renditions(image.blob, [thumbnail.thumbnail_height.height for thumbnail in thumbnails], Thumbnail.JPEG, quality)
+    for thumbnail in thumbnails:
+        if thumbnail.thumbnail_height.height in renditions:
+            thumbnail.use_blob(renditions[thumbnail.thumbnail_height.height])
+    Thumbnail.objects.bulk_update([thumbnail for thumbnail in thumbnails if thumbnail.blob_id is not None], fields)
+    thumbnails = [thumbnail for thumbnail in thumbnails if thumbnail.blob_id is None]
+    if not thumbnails:
+        return None
+
+    def save_thumbnails(result):
+        rendered, observations = result
+        metrics.replay(observations)
+        with rendered_files(rendered) as files:
+            for thumbnail in thumbnails:
+                height = thumbnail.thumbnail_height.height
+                if image.blob is None:  # stored before blobs existed, there's no original to key the rendition by
+                    thumbnail.use_file(files[height], "thumbnail.jpg")
+                else:
+                    thumbnail.use_blob(Blob.store(files[height], "thumbnail.jpg", image.blob, height, Thumbnail.JPEG, quality))
+        Thumbnail.objects.bulk_update(thumbnails, fields)
+
+    heights = [thumbnail.thumbnail_height.height for thumbnail in thumbnails]
+    return render_thumbnail_files, (image.file.name, heights, quality), save_thumbnails
+
+
+@job_failure_handler(Job.RENDER_THUMBNAILS)
+def render_image_thumbnails_failed(job):
+    Thumbnail.objects.filter(image_id=job.payload["image"], status=Thumbnail.PENDING).update(status=Thumbnail.FAILED)
+
+
+@job_handler(Job.RECONCILE_TIER)
+def reconcile_tier(job):
+    """Update the thumbnails of every image of a user to their new tier, one chunk of images per transaction"""
+    reconciliation = TierReconciliation.objects.select_related("user").filter(pk=job.payload["reconciliation"]).first()
+    if reconciliation is None or reconciliation.status == TierReconciliation.DONE:
+        return None
+
+    user = reconciliation.user
+    thumbnail_height_ids = list(user.tier.thumbnail_heights.values_list("id", flat=True))
+    ladder_height_ids = list(ThumbnailHeight.objects.filter(height__in=user.tier.ladder_heights()).values_list("id", flat=True))
+    while True:
+        image_ids = list(
+            user.images.filter(id__gt=reconciliation.last_image_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:settings.RECONCILIATION_CHUNK_SIZE]
+        )
+        if not image_ids:
+            break
+        with transaction.atomic(), batched_file_removal():
+            reconcile_thumbnails(image_ids, thumbnail_height_ids, ladder_height_ids)
+            # the progress is committed together with the chunk, so a retried job skips the finished chunks
+            reconciliation.last_image_id = image_ids[-1]
+            reconciliation.images_done += len(image_ids)
+            reconciliation.save(update_fields=["last_image_id", "images_done", "datetime_updated"])
+            # keep the job locked while chunks are left, so it isn't claimed again as abandoned
+            Job.objects.filter(pk=job.pk).update(locked_at=timezone.now())
+
+    reconciliation.status = TierReconciliation.DONE
+    reconciliation.save(update_fields=["status", "datetime_updated"])
+    return None
+
+
+@job_handler(Job.DELETE_FILES)
+def delete_files(job):
+    return remove_paths, (job.payload["paths"],), lambda result: None
@@ -0,0 +1,35 @@
+"""
+Checkpoints of long running commands, JSON files saved after every batch, so an interrupted run continues where it stopped.
+"""
+from django.core.management.base import CommandError
+
+import json
+import os
+
+
+def load_checkpoint(path, identity, progress):
+    """
+    The progress saved in the checkpoint, or the initial progress if there's none yet.
+    Identity tells runs apart, a checkpoint saved by a run with another identity isn't used.
+    """
+    if not os.path.exists(path):
+        return {**identity, **progress}
+    with open(path) as file:
+        checkpoint = json.load(file)
+    for key, value in identity.items():
+        if checkpoint.get(key) != value:
+            raise CommandError(f"{path} is the checkpoint of another run, with {key} {checkpoint.get(key)}")
+    return {**identity, **progress, **checkpoint}
+
+
+def save_checkpoint(path, progress):
+    """Replace the checkpoint in one rename, so an interrupted write never leaves half of it"""
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(progress, file)
+    os.replace(f"{path}.tmp", path)
+
+
+def remove_checkpoint(path):
+    """Remove the checkpoint of a finished run, so running the command again starts over"""
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+from django.db.models import ProtectedError
+from image_api.models import Blob, remove_paths
+
+import time
+
+
+class Command(BaseCommand):
+    help = "Deletes blobs no image or thumbnail references anymore, along with their files, optionally in a loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="number of blobs deleted per transaction")
+        parser.add_argument("--loop", action="store_true", help="keep running, collecting every --interval seconds")
+        parser.add_argument("--interval", type=float, default=300.0, help="seconds between collections when running in a loop")
+
+    def handle(self, *args, **options):
+        while True:
+            self.stdout.write(f"Collected {self.collect(options['batch_size'])} blobs")
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
+
+    def collect(self, batch_size):
+        """
+        Delete unreferenced blobs one batch at a time. The rows go first, and the files only once they're committed,
+        so a blob that's referenced again in the meantime makes the batch fail instead of losing its file.
+        Collected renditions can leave their originals unreferenced, which are collected by the following batches.
+        """
+        collected = 0
+        while True:
+            try:
+                with transaction.atomic():
+                    blobs = list(Blob.objects.unreferenced().select_for_update(skip_locked=True).values_list("pk", "file")[:batch_size])
+                    if not blobs:
+                        return collected
+                    Blob.objects.filter(pk__in=[pk for pk, _ in blobs]).delete()
+            except (ProtectedError, IntegrityError):
+                # referenced while the batch was being collected, it won't be picked up again,
+                # databases checking foreign keys at commit, like Postgres, raise IntegrityError instead of ProtectedError
+                continue
+            remove_paths([file for _, file in blobs])
+            collected += len(blobs)
@@ -0,0 +1,233 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django import db
+from image_api.capabilities import TierCapabilities
+from image_api.jobs import InlineExecutor, render_thumbnail_files
+from image_api.management.checkpoints import load_checkpoint, remove_checkpoint, save_checkpoint
+from image_api.models import Blob, Image, ImageAPIUser, Thumbnail, blob_path
+from image_api.rendering import rendered_files
+from image_api.storage import store_file
+from image_api.uploads import CHUNK_SIZE, RejectedImage, check_image_size, sniff_image_format
+from image_api import metrics
+from itertools import islice
+from pathlib import Path
+
+import csv
+import django
+import hashlib
+import os
+import re
+import tempfile
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+INVALID_NAME_CHARACTERS = re.compile(r"[/.]")  # image names are looked up in URLs, where they can't have these
+
+
+def spool_import_file(path, max_pixels, max_dimension):
+    """
+    Check the header of a file to import and copy it to UPLOAD_TEMP_DIR, hashing it on the way.
+    This runs in the process pool, so it must not touch the DB, and errors are returned instead of raised,
+    as the API exceptions don't survive pickling. Returns (temporary path, sha256, size, error).
+    """
+    try:
+        with open(path, "rb") as file:
+            if sniff_image_format(file) not in ("PNG", "JPEG"):
+                return None, None, None, "Image must be a PNG or a JPEG"
+            check_image_size(file, max_pixels, max_dimension)
+            os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+            digest = hashlib.sha256()
+            with tempfile.NamedTemporaryFile(suffix=".import", dir=settings.UPLOAD_TEMP_DIR, delete=False) as spooled:
+                while chunk := file.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    spooled.write(chunk)
+    except RejectedImage as e:
+        return None, None, None, " ".join(str(value) for value in e.detail.values())
+    except OSError as e:
+        return None, None, None, str(e)
+    return spooled.name, digest.hexdigest(), os.path.getsize(spooled.name), None
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports a directory of images, or a CSV manifest of paths and names, for one user. "
+        "Files are checked and rendered in a process pool, rows are inserted in bulk one batch per transaction, "
+        "and the progress is checkpointed after every batch, so an interrupted import continues where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", help="a directory, imported recursively, or a CSV file of paths (relative to it) and optional names")
+        parser.add_argument("--user", required=True, help="username of the owner of the imported images")
+        parser.add_argument("--processes", type=int, default=os.cpu_count(), help="size of the process pool, 0 runs everything in this process")
+        parser.add_argument("--batch-size", type=int, default=500, help="number of files imported per transaction")
+        parser.add_argument("--checkpoint", default=None, help="file keeping the progress of the import, defaults to import_images-<user>.json")
+
+    def handle(self, *args, **options):
+        source = os.path.abspath(options["source"])
+        if not os.path.exists(source):
+            raise CommandError(f"{source} doesn't exist")
+        image_api_user = ImageAPIUser.objects.select_related("tier", "auth_user").filter(auth_user__username=options["user"]).first()
+        if image_api_user is None:
+            raise CommandError(f"User {options['user']} has no ImageAPIUser")
+
+        checkpoint_path = options["checkpoint"] or f"import_images-{options['user']}.json"
+        progress = load_checkpoint(checkpoint_path, {"source": source, "user": options["user"]}, {"done": 0, "imported": 0, "skipped": 0, "failed": 0})
+        if progress["done"]:
+            self.stdout.write(f"Resuming after {progress['done']} files")
+
+        entries = islice(self.manifest_entries(source) if os.path.isfile(source) else self.directory_entries(source), progress["done"], None)
+        if options["processes"]:
+            db.connections.close_all()  # don't let the pool processes inherit the DB connections
+            executor = ProcessPoolExecutor(max_workers=options["processes"], initializer=django.setup)
+        else:
+            executor = InlineExecutor()
+        try:
+            while batch := list(islice(entries, options["batch_size"])):
+                imported, skipped, failed = self.import_batch(batch, image_api_user, executor)
+                progress["done"] += len(batch)
+                progress["imported"] += imported
+                progress["skipped"] += skipped
+                progress["failed"] += failed
+                save_checkpoint(checkpoint_path, progress)
+                self.stdout.write(f"{progress['done']} files: {progress['imported']} imported, {progress['skipped']} skipped, {progress['failed']} failed")
+        finally:
+            if options["processes"]:
+                executor.shutdown()
+        remove_checkpoint(checkpoint_path)  # a finished import starts over if it's run again, skipping the images it already created
+        self.stdout.write(f"Imported {progress['imported']} images")
+
+    def directory_entries(self, directory):
+        """(path, name) of every image in the directory tree, in an order that doesn't change between runs, so it can be resumed"""
+        for root, directories, files in os.walk(directory):
+            directories.sort()
+            for filename in sorted(files):
+                if filename.lower().endswith(IMAGE_EXTENSIONS) and not filename.startswith("."):
+                    yield os.path.join(root, filename), INVALID_NAME_CHARACTERS.sub("_", Path(filename).stem)[:100]
+
+    def manifest_entries(self, manifest):
+        """(path, name) of every row of the manifest, names default to the file name like for directories"""
+        directory = os.path.dirname(manifest)
+        with open(manifest, newline="") as file:
+            for row in csv.reader(file):
+                if not row or not row[0].strip():
+                    continue
+                path = os.path.join(directory, row[0].strip())
+                name = row[1].strip() if len(row) > 1 and row[1].strip() else INVALID_NAME_CHARACTERS.sub("_", Path(path).stem)[:100]
+                yield path, name
+
+    def import_batch(self, batch, image_api_user, executor):
+        """
+        Import one batch of files, returns the number of images imported, skipped and failed.
+        Blobs are stored before the transaction, like uploads do, so an interrupted batch only leaves blobs
+        that nothing references, which collect_blobs removes. Running a batch again skips the images it already created.
+        """
+        capabilities = TierCapabilities.for_image_api_user(image_api_user)
+        existing_names = set(Image.objects.filter(user=image_api_user, name__in=[name for _, name in batch]).values_list("name", flat=True))
+        entries, skipped, failed = [], 0, 0
+        for path, name in batch:
+            if not name or INVALID_NAME_CHARACTERS.search(name) or len(name) > 100:
+                self.stderr.write(f"{path}: invalid image name {name!r}")
+                failed += 1
+            elif name in existing_names:
+                skipped += 1
+            else:
+                existing_names.add(name)  # later files with the same name are skipped too
+                entries.append((path, name))
+
+        futures = [executor.submit(spool_import_file, path, capabilities.max_pixels, capabilities.max_dimension) for path, _ in entries]
+        spooled = []
+        for (path, name), future in zip(entries, futures):
+            temporary_path, sha256, size, error = future.result()
+            if error is not None:
+                self.stderr.write(f"{path}: {error}")
+                failed += 1
+            else:
+                spooled.append((path, name, temporary_path, sha256, size))
+
+        blobs = self.store_originals(spooled)
+        thumbnails = self.render_thumbnails(set(blobs.values()), image_api_user, executor)
+        images = []
+        for _, name, _, sha256, _ in spooled:
+            image = Image(name=name, user=image_api_user)
+            image.use_blob(blobs[sha256])
+            images.append(image)
+        with transaction.atomic():
+            Image.objects.bulk_create(images)
+            images = Image.objects.filter(user=image_api_user, name__in=[name for _, name, _, _, _ in spooled])
+            Thumbnail.objects.bulk_create([
+                self.thumbnail(image, thumbnail_height_id, rendition)
+                for image in images
+                for thumbnail_height_id, rendition in thumbnails.get(image.blob_id, {}).items()
+            ])
+        return len(spooled), skipped, failed
+
+    def store_originals(self, spooled):
+        """
+        Store the spooled files as blobs in bulk, moving them to their place, returns the blobs by hash.
+        Files that are already stored, under any name or user, are dropped.
+        """
+        blobs = {blob.sha256: blob for blob in Blob.objects.filter(sha256__in=[sha256 for _, _, _, sha256, _ in spooled], source=None)}
+        Blob.objects.filter(pk__in=[blob.pk for blob in blobs.values()]).update(datetime_referenced=timezone.now())
+        new_blobs = {}
+        for path, _, temporary_path, sha256, size in spooled:
+            if sha256 in blobs or sha256 in new_blobs:
+                os.remove(temporary_path)
+                continue
+            blob = Blob(sha256=sha256, size=size)
+            blob.file = blob_path(blob, path)
+            store_file(temporary_path, blob.file.name)  # the path is derived from the content, so it's never another file
+            new_blobs[sha256] = blob
+        Blob.objects.bulk_create(new_blobs.values(), ignore_conflicts=True)  # a concurrent upload may have stored the same file
+        blobs.update((blob.sha256, blob) for blob in Blob.objects.filter(sha256__in=list(new_blobs), source=None))
+        return blobs
+
+    def render_thumbnails(self, blobs, image_api_user, executor):
+        """
+        Render the JPEG thumbnails of the tier in the process pool, reusing the stored renditions,
+        returns {blob id: {thumbnail height id: rendition blob or None if it couldn't be rendered}}.
+        With lazy rendering thumbnails are left for the first request that needs them.
+        """
+        if settings.THUMBNAIL_RENDERING == "lazy" or not blobs:
+            return {}
+        heights = dict(image_api_user.tier.thumbnail_heights.values_list("height", "id"))
+        if not heights:
+            return {}
+        quality = image_api_user.tier.thumbnail_quality or settings.THUMBNAIL_QUALITY
+
+        renditions = {blob.pk: {} for blob in blobs}
+        stored = Blob.objects.filter(source__in=blobs, height__in=heights, format=Thumbnail.JPEG, quality=quality)
+        for rendition in stored:
+            renditions[rendition.source_id][heights[rendition.height]] = rendition
+        Blob.objects.filter(pk__in=[rendition.pk for rendition in stored]).update(datetime_referenced=timezone.now())
+
+        futures = {}
+        for blob in blobs:
+            missing = [height for height, height_id in heights.items() if height_id not in renditions[blob.pk]]
+            if missing:
+                futures[blob] = executor.submit(render_thumbnail_files, blob.file.name, missing, quality)
+        for blob, future in futures.items():
+            try:
+                rendered, observations = future.result()
+            except Exception as e:  # a file with a valid header can still be broken, its thumbnails fail like they do for uploads
+                self.stderr.write(f"Rendering the thumbnails of blob {blob.sha256} failed: {e}")
+                rendered, observations = {}, []
+            metrics.replay(observations)
+            with rendered_files(rendered) as files:
+                for height, height_id in heights.items():
+                    if height_id in renditions[blob.pk]:
+                        continue
+                    if height in files:
+                        renditions[blob.pk][height_id] = Blob.store(files[height], "thumbnail.jpg", blob, height, Thumbnail.JPEG, quality)
+                    else:
+                        renditions[blob.pk][height_id] = None
+        return renditions
+
+    def thumbnail(self, image, thumbnail_height_id, rendition):
+        thumbnail = Thumbnail(image=image, thumbnail_height_id=thumbnail_height_id)
+        if rendition is None:
+            thumbnail.status = Thumbnail.FAILED
+        else:
+            thumbnail.use_blob(rendition)
+        return thumbnail
@@ -0,0 +1,197 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from django import db
+from image_api.jobs import InlineExecutor
+from image_api.management.checkpoints import load_checkpoint, remove_checkpoint, save_checkpoint
+from image_api.models import Blob, Image, Job, TemporaryLink, Thumbnail, blob_path, remove_paths
+from image_api.storage import filesystem_storage
+from image_api.uploads import CHUNK_SIZE
+
+import django
+import hashlib
+import os
+
+
+def link_files(moves):
+    """
+    Give files their new names as hard links, runs in the process pool.
+    The old names are only removed once the DB uses the new ones, so every file can be served during the move.
+    Returns whether each file was linked, missing files aren't.
+    """
+    linked = []
+    for old_name, new_name in moves:
+        new_path = default_storage.path(new_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        try:
+            os.link(default_storage.path(old_name), new_path)
+        except FileExistsError:  # linked by an interrupted run, names of blobs are their hash, so it's the same content
+            pass
+        except FileNotFoundError:
+            linked.append(False)
+            continue
+        linked.append(True)
+    return linked
+
+
+def hash_files(names):
+    """(sha256, size) of every file, or None for missing ones, runs in the process pool"""
+    hashes = []
+    for name in names:
+        digest = hashlib.sha256()
+        try:
+            with open(default_storage.path(name), "rb") as file:
+                while chunk := file.read(CHUNK_SIZE):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            hashes.append(None)
+            continue
+        hashes.append((digest.hexdigest(), os.path.getsize(default_storage.path(name))))
+    return hashes
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the media files to the layout of BLOB_SHARD_DEPTH while the app keeps serving them: "
+        "blobs stored with another depth are moved to their new directories, and images and thumbnails stored "
+        "before blobs existed become blobs. Files are linked and hashed in a process pool, paths are updated in bulk "
+        "one batch per transaction, and the progress is checkpointed after every batch. "
+        "Signed links embed the path of the original, so the old names of originals are kept until every link signed "
+        "before the move has expired: they're removed by a job of run_worker, once the longest a temporary link lasts has passed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=os.cpu_count(), help="size of the process pool, 0 runs everything in this process")
+        parser.add_argument("--batch-size", type=int, default=500, help="number of files moved per transaction")
+        parser.add_argument("--checkpoint", default="migrate_media_layout.json", help="file keeping the progress of the migration")
+
+    def handle(self, *args, **options):
+        if not filesystem_storage():
+            raise CommandError("Only media files stored in MEDIA_ROOT have a layout to migrate")
+        self.batch_size = options["batch_size"]
+        self.processes = options["processes"]
+        self.progress = load_checkpoint(options["checkpoint"], {"shard_depth": settings.BLOB_SHARD_DEPTH}, {"blobs": 0, "images": 0, "thumbnails": 0})
+        if self.processes:
+            db.connections.close_all()  # don't let the pool processes inherit the DB connections
+            self.executor = ProcessPoolExecutor(max_workers=self.processes, initializer=django.setup)
+        else:
+            self.executor = InlineExecutor()
+        try:
+            # originals first, as the renditions of older thumbnails need the blob of their image
+            for phase, queryset, migrate in (
+                ("blobs", Blob.objects.all(), self.move_blobs),
+                ("images", Image.objects.filter(blob=None), self.store_images),
+                ("thumbnails", Thumbnail.objects.filter(blob=None, image__blob__isnull=False).exclude(file="").select_related("image", "thumbnail_height"), self.store_thumbnails),
+            ):
+                moved = 0
+                while batch := list(queryset.filter(pk__gt=self.progress[phase]).order_by("pk")[:self.batch_size]):
+                    moved += migrate(batch)
+                    self.progress[phase] = batch[-1].pk
+                    save_checkpoint(options["checkpoint"], self.progress)
+                self.stdout.write(f"Moved {moved} {phase}")
+        finally:
+            if self.processes:
+                self.executor.shutdown()
+        remove_checkpoint(options["checkpoint"])
+
+    def in_pool(self, function, items):
+        """Run the function on the items split in one chunk per process, returns its results in the order of the items"""
+        chunk_count = self.processes or 1
+        futures = [self.executor.submit(function, items[start::chunk_count]) for start in range(chunk_count) if items[start::chunk_count]]
+        results = [None] * len(items)
+        for start, future in enumerate(futures):
+            results[start::chunk_count] = future.result()
+        return results
+
+    def link(self, moves):
+        """Link the files to their new names, returns the moves of the files that aren't missing"""
+        return [move for move, linked in zip(moves, self.in_pool(link_files, moves)) if linked]
+
+    def remove_old_names(self, moves, signed=False):
+        """
+        Remove the old names, once the DB doesn't use them anymore.
+        Names signed links can point to, those of originals, are left to a job that runs once the links have expired.
+        """
+        old_names = [old_name for old_name, _ in moves]
+        if signed and old_names:
+            Job.objects.create(kind=Job.DELETE_FILES, payload={"paths": old_names}, available_at=timezone.now() + TemporaryLink.MAX_DURATION)
+        elif old_names:
+            remove_paths(old_names)
+
+    def move_blobs(self, blobs):
+        """Move the blobs of the batch that aren't where blob_path puts them, and the images and thumbnails using them"""
+        blobs = {blob.file.name: blob for blob in blobs if blob.file.name != blob_path(blob, blob.file.name)}
+        moves = self.link([(name, blob_path(blob, name)) for name, blob in blobs.items()])
+        moved = [blobs[old_name] for old_name, _ in moves]
+        for blob, (_, new_name) in zip(moved, moves):
+            blob.file = new_name
+        with transaction.atomic():
+            Blob.objects.bulk_update(moved, ["file"])
+            self.update_file_names([blob.pk for blob in moved])
+        # images saved with a blob read before the batch was committed get its new name too
+        self.update_file_names([blob.pk for blob in moved])
+        self.remove_old_names([move for blob, move in zip(moved, moves) if blob.source_id is None], signed=True)
+        self.remove_old_names([move for blob, move in zip(moved, moves) if blob.source_id is not None])
+        return len(moves)
+
+    def update_file_names(self, blob_ids):
+        """Images and thumbnails keep the name of their blob's file, so nginx can be sent to it without another query"""
+        new_name = Subquery(Blob.objects.filter(pk=OuterRef("blob_id")).values("file"))
+        Image.objects.filter(blob_id__in=blob_ids).update(file=new_name)
+        Thumbnail.objects.filter(blob_id__in=blob_ids).update(file=new_name)
+
+    def store_blobs(self, objects, source_of):
+        """
+        Turn the files of images or thumbnails stored before blobs existed into blobs, linked to the name blob_path gives them.
+        Files with the content of a blob that already exists become that blob, their own file is dropped.
+        Returns the moves, and the blob of every object, None for objects whose file is missing.
+        """
+        hashes = self.in_pool(hash_files, [obj.file.name for obj in objects])
+        originals = source_of is None
+        existing = Blob.objects.filter(sha256__in=[file_hash[0] for file_hash in hashes if file_hash], source__isnull=originals)
+        blobs = {blob.sha256: blob for blob in existing}
+        new_blobs = {}
+        for obj, file_hash in zip(objects, hashes):
+            if file_hash is not None and file_hash[0] not in blobs and file_hash[0] not in new_blobs:
+                sha256, size = file_hash
+                blob = Blob(sha256=sha256, size=size)
+                if not originals:
+                    # the quality they were rendered with isn't known, so they're never reused for other thumbnails
+                    blob.source_id, blob.height, blob.format = source_of(obj), obj.thumbnail_height.height, obj.format
+                blob.file = blob_path(blob, obj.file.name)
+                new_blobs[sha256] = (obj.file.name, blob)
+        moves = self.link([(name, blob.file.name) for name, blob in new_blobs.values()])
+        linked = set(new_name for _, new_name in moves)
+        Blob.objects.bulk_create([blob for _, blob in new_blobs.values() if blob.file.name in linked], ignore_conflicts=True)
+        blobs.update((blob.sha256, blob) for blob in Blob.objects.filter(sha256__in=list(new_blobs), source__isnull=originals))
+        # files whose content was already stored lose their name too, once the DB uses the blob
+        dropped = [(obj.file.name, None) for obj, file_hash in zip(objects, hashes) if file_hash is not None and obj.file.name not in dict(moves)]
+        return moves + dropped, [blobs.get(file_hash[0]) if file_hash else None for file_hash in hashes]
+
+    def store_images(self, images):
+        moves, blobs = self.store_blobs(images, None)
+        for image, blob in zip(images, blobs):
+            if blob is None:
+                self.stderr.write(f"The file {image.file.name} of image {image.pk} is missing")
+            else:
+                image.blob, image.file, image.content_hash = blob, blob.file.name, blob.sha256
+        with transaction.atomic():
+            Image.objects.bulk_update([image for image in images if image.blob_id is not None], ["blob", "file", "content_hash"])
+        self.remove_old_names(moves, signed=True)
+        return len(moves)
+
+    def store_thumbnails(self, thumbnails):
+        moves, blobs = self.store_blobs(thumbnails, lambda thumbnail: thumbnail.image.blob_id)
+        for thumbnail, blob in zip(thumbnails, blobs):
+            if blob is None:
+                self.stderr.write(f"The file {thumbnail.file.name} of thumbnail {thumbnail.pk} is missing")
+            else:
+                thumbnail.blob, thumbnail.file, thumbnail.content_hash, thumbnail.size = blob, blob.file.name, blob.sha256, blob.size
+        with transaction.atomic():
+            Thumbnail.objects.bulk_update([thumbnail for thumbnail in thumbnails if thumbnail.blob_id is not None], ["blob", "file", "content_hash", "size"])
+        self.remove_old_names(moves)
+        return len(moves)
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db.models import DateTimeField, ExpressionWrapper, F
+from image_api.models import TemporaryLink, UploadSession
+
+import time
+
+
+class Command(BaseCommand):
+    help = "Deletes expired temporary links and abandoned uploads in bounded batches, optionally in a loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="number of links deleted per query")
+        parser.add_argument("--loop", action="store_true", help="keep running, purging every --interval seconds")
+        parser.add_argument("--interval", type=float, default=60.0, help="seconds between purges when running in a loop")
+        parser.add_argument("--backfill", action="store_true", help="first fill in expires_at of links created before it existed")
+
+    def handle(self, *args, **options):
+        if options["backfill"]:
+            self.stdout.write(f"Backfilled {self.backfill(options['batch_size'])} links")
+
+        while True:
+            self.stdout.write(f"Purged {self.purge(TemporaryLink, options['batch_size'])} expired links")
+            self.stdout.write(f"Purged {self.purge(UploadSession, options['batch_size'])} expired uploads")
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
+
+    def purge(self, model, batch_size):
+        """Delete expired objects one batch at a time, so a big backlog never holds locks on the whole table"""
+        purged = 0
+        while True:
+            pks = list(model.objects.expired().values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                return purged
+            model.objects.filter(pk__in=pks).delete()
+            purged += len(pks)
+
+    def backfill(self, batch_size):
+        expires_at = ExpressionWrapper(F("datetime_created") + F("duration"), output_field=DateTimeField())
+        backfilled = 0
+        while True:
+            pks = list(TemporaryLink.objects.filter(expires_at__isnull=True).values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                return backfilled
+            TemporaryLink.objects.filter(pk__in=pks).update(expires_at=expires_at)
+            backfilled += len(pks)
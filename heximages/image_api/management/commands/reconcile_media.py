@@ -0,0 +1,140 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django import db
+from image_api.jobs import InlineExecutor
+from image_api.models import Blob, Image, Job, Thumbnail, ThumbnailHeight, Tier, reconcile_thumbnails, remove_paths
+from image_api.storage import filesystem_storage
+from pathlib import Path
+
+import django
+import os
+import time
+
+# the files directly in blobs/, stored with a BLOB_SHARD_DEPTH of 0, and the 256 directories of the first level of blob_path
+BLOB_SHARDS = ["blobs", *(f"blobs/{prefix:02x}" for prefix in range(256))]
+
+
+def referenced_files(shard):
+    """The files the DB references under a shard, {name: (blob id, whether it's a rendition)}, blob id is None for older files"""
+    if shard == "blobs":
+        blobs = Blob.objects.filter(file__regex=r"^blobs/[^/]+$").values_list("file", "pk", "source_id")
+        return {name: (pk, source_id is not None) for name, pk, source_id in blobs.iterator()}
+    if shard.startswith("blobs/"):
+        blobs = Blob.objects.filter(file__startswith=f"{shard}/").values_list("file", "pk", "source_id")
+        return {name: (pk, source_id is not None) for name, pk, source_id in blobs.iterator()}
+    # images and thumbnails stored before blobs existed, in a directory per user
+    names = Image.objects.filter(blob=None, file__startswith=f"{shard}/").values_list("file", flat=True)
+    thumbnail_names = Thumbnail.objects.filter(blob=None, file__startswith=f"{shard}/").values_list("file", flat=True)
+    return {name: (None, False) for name in [*names.iterator(), *thumbnail_names.iterator()]}
+
+
+def pending_removals():
+    """Files queued jobs will remove, like the old names migrate_media_layout keeps until the signed links to them expire"""
+    payloads = Job.objects.filter(kind=Job.DELETE_FILES, status=Job.QUEUED).values_list("payload", flat=True)
+    return set(path for payload in payloads for path in payload["paths"])
+
+
+def scan_shard(shard, min_age):
+    """
+    Compare the files of a shard of the media directory with the ones the DB references there.
+    This runs in the process pool, returns (orphaned files older than min_age seconds, referenced files that are missing),
+    each sorted by name, missing files with their blob id and whether it's a rendition.
+    """
+    root = Path(settings.MEDIA_ROOT)
+    stored = set()
+    for directory, directories, files in os.walk(root / shard):
+        if shard == "blobs":
+            directories.clear()  # the shards are scanned on their own
+        stored.update(str((Path(directory) / filename).relative_to(root)) for filename in files)
+    referenced = referenced_files(shard)
+
+    now = time.time()
+    orphaned = []
+    for name in sorted(stored.difference(referenced, pending_removals())):
+        try:
+            if os.stat(root / name).st_mtime < now - min_age:  # younger files can belong to a blob that's being stored
+                orphaned.append(name)
+        except FileNotFoundError:
+            pass
+    missing = [(name, *referenced[name]) for name in sorted(set(referenced).difference(stored))]
+    db.connections.close_all()  # the pool processes don't keep their connections between shards
+    return orphaned, missing
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the media directory with the DB, one shard of it at a time in a process pool, "
+        "and reports files nothing references, referenced files that are missing and thumbnails without files. "
+        "With --fix, orphaned files are deleted, and thumbnails whose files are missing are rendered again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="repair what can be repaired, instead of only reporting it")
+        parser.add_argument("--processes", type=int, default=os.cpu_count(), help="size of the process pool, 0 scans in this process")
+        parser.add_argument("--min-age", type=int, default=None, help="seconds before an unreferenced file counts as orphaned, defaults to BLOB_GC_GRACE")
+
+    def handle(self, *args, **options):
+        if not filesystem_storage():
+            raise CommandError("Only media files stored in MEDIA_ROOT can be reconciled")
+        min_age = settings.BLOB_GC_GRACE if options["min_age"] is None else options["min_age"]
+        shards = self.shards()
+        if options["processes"]:
+            db.connections.close_all()  # don't let the pool processes inherit the DB connections
+            executor = ProcessPoolExecutor(max_workers=options["processes"], initializer=django.setup)
+        else:
+            executor = InlineExecutor()
+        try:
+            futures = [executor.submit(scan_shard, shard, min_age) for shard in shards]
+            orphaned, missing = 0, []
+            for future in futures:
+                shard_orphaned, shard_missing = future.result()
+                for name in shard_orphaned:
+                    self.stdout.write(f"Orphaned file {name}")
+                for name, blob_id, rendition in shard_missing:
+                    kind = "rendition" if rendition else "original" if blob_id is not None else "file stored before blobs"
+                    self.stdout.write(f"Missing {kind} {name}")
+                if options["fix"]:
+                    remove_paths(shard_orphaned)
+                orphaned += len(shard_orphaned)
+                missing.extend(shard_missing)
+        finally:
+            if options["processes"]:
+                executor.shutdown()
+
+        broken_thumbnails = Thumbnail.objects.filter(status=Thumbnail.READY, file="")
+        for thumbnail_id, image_id in broken_thumbnails.values_list("pk", "image_id"):
+            self.stdout.write(f"Thumbnail {thumbnail_id} of image {image_id} is ready without a file")
+        missing_renditions = [blob_id for _, blob_id, rendition in missing if rendition]
+        thumbnails_to_render = broken_thumbnails | Thumbnail.objects.filter(blob_id__in=missing_renditions)
+        if options["fix"]:
+            self.render_again(thumbnails_to_render, missing_renditions)
+
+        action = "Removed" if options["fix"] else "Found"
+        self.stdout.write(f"{action} {orphaned} orphaned files, {len(missing)} files are missing, {len(missing_renditions)} of them renditions")
+
+    def shards(self):
+        """Every blob shard, and the directory of every user with files stored before blobs existed, on disk or in the DB"""
+        user_directories = set(
+            entry.name for entry in os.scandir(settings.MEDIA_ROOT)
+            if entry.is_dir() and entry.name != "blobs" and not entry.name.startswith(".")  # uploads, locks and caches
+        ) if os.path.isdir(settings.MEDIA_ROOT) else set()
+        user_directories.update(Image.objects.filter(blob=None).values_list("user__auth_user__username", flat=True).distinct())
+        return [*BLOB_SHARDS, *sorted(user_directories)]
+
+    def render_again(self, thumbnails, missing_renditions):
+        """
+        Delete the thumbnails and the blobs of the missing renditions, and schedule the thumbnails of the tiers again,
+        the ones rendered on demand are rendered by their next request
+        """
+        images = list(Image.objects.filter(pk__in=thumbnails.values("image_id")).values_list("pk", "user__tier_id"))
+        with transaction.atomic():
+            thumbnails.delete()
+            Blob.objects.filter(pk__in=missing_renditions).delete()
+            for tier in Tier.objects.filter(pk__in=set(tier_id for _, tier_id in images)):
+                thumbnail_height_ids = list(tier.thumbnail_heights.values_list("id", flat=True))
+                ladder_height_ids = list(ThumbnailHeight.objects.filter(height__in=tier.ladder_heights()).values_list("id", flat=True))
+                image_ids = [image_id for image_id, tier_id in images if tier_id == tier.pk]
+                reconcile_thumbnails(image_ids, thumbnail_height_ids, ladder_height_ids)
+        self.stdout.write(f"Scheduled the thumbnails of {len(images)} images to be rendered again")
@@ -0,0 +1,38 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.core.management.base import BaseCommand
+from django import db
+from image_api.jobs import claim_jobs, run_jobs
+from image_api import metrics
+
+import django
+import os
+import time
+
+
+class Command(BaseCommand):
+    help = "Runs background jobs, rendering thumbnails in a process pool"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=os.cpu_count(), help="size of the rendering process pool")
+        parser.add_argument("--batch-size", type=int, default=None, help="number of jobs claimed at once, defaults to twice the pool size")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds to wait when the queue is empty")
+        parser.add_argument("--once", action="store_true", help="exit as soon as the queue is empty")
+        parser.add_argument("--metrics-port", type=int, default=None, help="serve the worker's metrics on this port, see METRICS_ENABLED")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"] or options["processes"] * 2
+        if options["metrics_port"]:
+            metrics.serve(options["metrics_port"])
+
+        db.connections.close_all()  # don't let the pool processes inherit the DB connections
+        with ProcessPoolExecutor(max_workers=options["processes"], initializer=django.setup) as executor:
+            self.stdout.write(f"Worker started with {options['processes']} processes")
+            while True:
+                jobs = claim_jobs(batch_size)
+                if jobs:
+                    run_jobs(jobs, executor)
+                    self.stdout.write(f"Ran {len(jobs)} jobs")
+                elif options["once"]:
+                    break
+                else:
+                    time.sleep(options["poll_interval"])
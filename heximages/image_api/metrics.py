@@ -0,0 +1,189 @@
+"""
+Metrics of the process, exposed in the Prometheus text format at /metrics (and by `run_worker --metrics-port`).
+
+Counters of the thumbnail cache are always kept, as /thumbnail_cache/ shows them. Histograms are only recorded
+with METRICS_ENABLED, otherwise observing one is a settings lookup. Everything is local to the process,
+so every gunicorn worker reports its own requests, while gauges are computed from the DB when they're scraped.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import threading
+import time
+
+REGISTRY = {}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (1_000, 5_000, 10_000, 25_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 5_000_000)  # bytes
+
+_recording = threading.local()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A thread safe counter, local to the process"""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield f"# HELP {self.name}_total {self.description}"
+        yield f"# TYPE {self.name}_total counter"
+        yield f"{self.name}_total {self.value}"
+
+
+class Histogram:
+    """A histogram with labels, local to the process, observations are dropped unless METRICS_ENABLED is set"""
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._series = {}  # sorted labels: (bucket counts, sum, count)
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def observe(self, value, **labels):
+        if not settings.METRICS_ENABLED:
+            return
+        observations = getattr(_recording, "observations", None)
+        if observations is not None:
+            observations.append((self.name, value, labels))
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._series.get(key) or ([0] * (len(self.buckets) + 1), 0, 0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._series[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{format_labels((*key, ('le', bound)))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(key)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(key)} {count}"
+
+
+class Gauge:
+    """A gauge computed when it's scraped, the function returns a dict of label tuples to values"""
+
+    def __init__(self, name, description, function):
+        self.name = name
+        self.description = description
+        self.function = function
+        REGISTRY[name] = self
+
+    def samples(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} gauge"
+        for key, value in sorted(self.function().items()):
+            yield f"{self.name}{format_labels(key)} {format_value(value)}"
+
+
+@contextmanager
+def timer(histogram, **labels):
+    """Observe the time the block took, in seconds"""
+    if not settings.METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def recording():
+    """
+    Collect the observations made in this thread instead of recording them, for code running in a pool process,
+    whose metrics nobody scrapes: the list is sent back with the result, and replay() records it in the worker.
+    """
+    observations = []
+    _recording.observations = observations
+    try:
+        yield observations
+    finally:
+        _recording.observations = None
+
+
+def replay(observations):
+    for name, value, labels in observations:
+        REGISTRY[name].observe(value, **labels)
+
+
+def job_queue_depth():
+    """Background jobs waiting for a worker or running, by kind and status"""
+    from django.db.models import Count
+    from image_api.models import Job  # models record metrics too, so they're imported on use
+    rows = Job.objects.filter(status__in=[Job.QUEUED, Job.RUNNING]).order_by().values_list("kind", "status").annotate(count=Count("id"))
+    return {(("kind", kind), ("status", status)): count for kind, status, count in rows}
+
+
+def render():
+    """Every metric of the registry, in the Prometheus text format"""
+    return "".join(f"{line}\n" for metric in REGISTRY.values() for line in metric.samples())
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the metrics, for processes that don't serve HTTP themselves"""
+
+    def do_GET(self):
+        try:
+            body = render().encode()
+        finally:
+            connections.close_all()  # every request runs in a thread of its own, its connection would never be reused
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes aren't worth a log line each
+
+
+def serve(port):
+    """Serve the metrics on the given port from a daemon thread"""
+    server = ThreadingHTTPServer(("", port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+thumbnail_cache_hits = Counter("thumbnail_cache_hits", "Thumbnail requests served from an already rendered file")
+thumbnail_cache_misses = Counter("thumbnail_cache_misses", "Thumbnail requests that rendered the thumbnail")
+thumbnail_cache_evictions = Counter("thumbnail_cache_evictions", "Thumbnails deleted to stay within the disk budget")
+
+request_duration = Histogram("http_request_duration_seconds", "Time to respond to a request, by view, method and status")
+request_queries = Histogram("http_request_db_queries", "Database queries made by a request, by view", COUNT_BUCKETS)
+request_query_duration = Histogram("http_request_db_duration_seconds", "Time a request spent in database queries, by view")
+pillow_duration = Histogram("pillow_duration_seconds", "Time Pillow spent rendering thumbnails, by stage (decode, resize, encode) and format")
+rendition_bytes = Histogram("rendition_bytes", "Size of the rendered thumbnails written to the blob storage, by format", SIZE_BUCKETS)
+
+job_queue = Gauge("job_queue_depth", "Background jobs waiting or running, by status and kind", job_queue_depth)
@@ -0,0 +1,134 @@
+"""
+Opt-in instrumentation, installed by the settings only when METRICS_ENABLED or PROFILING_ENABLED are set,
+so when they aren't, requests don't go through any of it.
+"""
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils import timezone
+from image_api import metrics
+
+import asyncio
+import cProfile
+import os
+import re
+import time
+
+# the QueryStats of the request being handled, a context variable follows the request into the threads of sync_to_async,
+# where views run their queries on connections of their own under ASGI
+request_queries = ContextVar("request_queries", default=None)
+
+
+class QueryStats:
+    """Database execute wrapper counting the queries of a request, and the time they took"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+def view_name(request):
+    """The URL name of the view that handled the request, so histograms have one series per endpoint, not per URL"""
+    match = getattr(request, "resolver_match", None)
+    return match.view_name if match is not None else "unmatched"
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper of every connection, counting the query for the request being handled, if there's one"""
+    queries = request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    return queries(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+@receiver(request_started)
+def install_query_recorder(sender, connection=None, **kwargs):
+    """
+    Wrap the connections of the thread with record_query, when they're opened, and when a request starts,
+    which under ASGI is signalled from the thread that runs the sync parts of the request
+    """
+    for wrapped in [connection] if connection is not None else connections.all():
+        if record_query not in wrapped.execute_wrappers:
+            wrapped.execute_wrappers.append(record_query)
+
+
+class MetricsMiddleware:
+    """
+    Record the latency, query count and query time of every request, by view.
+    They're also sent in a Server-Timing header, which browsers show next to the request.
+    It runs natively under both WSGI and ASGI, and counts the queries of every thread working on the request.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine  # marks __call__ as a coroutine function, like MiddlewareMixin does
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = QueryStats()
+        token = request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        return self.record(request, response, queries, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        queries = QueryStats()
+        token = request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        return self.record(request, response, queries, time.perf_counter() - start)
+
+    def record(self, request, response, queries, duration):
+        view = view_name(request)
+        metrics.request_duration.observe(duration, view=view, method=request.method, status=response.status_code)
+        metrics.request_queries.observe(queries.count, view=view)
+        metrics.request_query_duration.observe(queries.duration, view=view)
+        response["Server-Timing"] = f'app;dur={duration * 1000:.1f}, db;dur={queries.duration * 1000:.1f};desc="{queries.count} queries"'
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profile requests of staff users that have a PROFILING_HEADER header, with cProfile.
+    The stats are written to PROFILING_DIR, and their file name is sent back in the same header,
+    open them with `python -m pstats` or snakeviz.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # only the session is checked, as the API's authentication runs in the view, when the profile is already running
+        if not request.headers.get(settings.PROFILING_HEADER) or not request.user.is_staff:
+            return self.get_response(request)
+
+        profile = cProfile.Profile()
+        response = profile.runcall(self.get_response, request)
+        os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+        path = re.sub(r"[^\w-]+", "_", request.path).strip("_") or "root"
+        name = f"{timezone.now():%Y%m%d-%H%M%S-%f}-{request.method}-{path}.prof"
+        profile.dump_stats(os.path.join(settings.PROFILING_DIR, name))
+        response[settings.PROFILING_HEADER] = name
+        return response
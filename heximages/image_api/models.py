@@ -1,61 +1,135 @@
 from datetime import timedelta
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.core.files.base import ContentFile
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.dispatch import receiver
+from django.utils import timezone
 
-from io import BytesIO
+from contextlib import contextmanager
 from pathlib import Path
-from PIL import Image as PILImage
+from image_api.rendering import FORMATS, snap_to_ladder
+from image_api.storage import filesystem_storage
+from image_api import metrics
 
+import hashlib
 import os
 import shutil
 import random
 import string
+import threading
 
 
 def original_image_path(instance, filename):
-    """Helper function to generate the path that original images should be uploaded to"""
+    """Helper function to generate the path that original images were uploaded to before they were stored as blobs"""
     return f"{instance.user.auth_user.username}/{instance.name}/original/{filename}"
 
 
 def thumbnail_path(instance, filename):
-    """Helper function to generate the path that thumbnails should be uploaded to"""
+    """Helper function to generate the path that thumbnails were uploaded to before they were stored as blobs"""
     return f"{instance.image.user.auth_user.username}/{instance.image.name}/{instance.thumbnail_height.height}/{filename}"
 
 
-def resize_image_to_thumbnail(original_image, height):
-    """Resize the original image and save it to a ContentFile"""
-    original_image_pil = PILImage.open(original_image)
-    if original_image_pil.size[1] > height:
-        scale = height / original_image_pil.size[1]  # calculate the scale by which the height is being resized
-        new_width = round(original_image_pil.size[0] * scale)  # resize the width by the same scale
-        new_image_pil = original_image_pil.resize((new_width, height))
+def blob_path(instance, filename):
+    """Helper function to generate the path of a blob from its hash, sharded over BLOB_SHARD_DEPTH levels so no directory gets too big"""
+    shards = [instance.sha256[level * 2:level * 2 + 2] for level in range(settings.BLOB_SHARD_DEPTH)]
+    return "/".join(["blobs", *shards, f"{instance.sha256}{Path(filename).suffix.lower()}"])
+
+
+def reconcile_thumbnails(image_ids, thumbnail_height_ids, kept_thumbnail_height_ids=()):
+    """
+    Make the thumbnails of the given images match the given thumbnail heights with a constant number of queries.
+    Thumbnails of other heights are deleted, unless they're in kept_thumbnail_height_ids (renditions of the height ladder),
+    and the missing ones are created as pending and queued for rendering.
+    With lazy rendering, missing thumbnails are left for the first request that needs them.
+    """
+    Thumbnail.objects.filter(image_id__in=image_ids).exclude(thumbnail_height_id__in=[*thumbnail_height_ids, *kept_thumbnail_height_ids]).delete()
+    if settings.THUMBNAIL_RENDERING == "lazy":
+        return
+
+    existing_thumbnails = set(Thumbnail.objects.filter(image_id__in=image_ids, format=Thumbnail.JPEG).values_list("image_id", "thumbnail_height_id"))
+    missing_thumbnails = [
+        Thumbnail(image_id=image_id, thumbnail_height_id=thumbnail_height_id)
+        for image_id in image_ids
+        for thumbnail_height_id in thumbnail_height_ids
+        if (image_id, thumbnail_height_id) not in existing_thumbnails
+    ]
+    Thumbnail.objects.bulk_create(missing_thumbnails, ignore_conflicts=True)  # the same thumbnails could be scheduled concurrently
+
+    # one job per image, so that each job decodes its original only once
+    image_ids_to_render = sorted(set(thumbnail.image_id for thumbnail in missing_thumbnails))
+    Job.objects.bulk_create([Job(kind=Job.RENDER_THUMBNAILS, payload={"image": image_id}) for image_id in image_ids_to_render])
+
+
+def schedule_thumbnails(image):
+    """
+    Create pending Thumbnail objects for every height of the user's tier that the image is missing,
+    and queue them for rendering by the background worker. Renditions of the tier's height ladder are kept.
+    """
+    tier = image.user.tier
+    ladder_height_ids = list(ThumbnailHeight.objects.filter(height__in=tier.ladder_heights()).values_list("id", flat=True))
+    reconcile_thumbnails([image.pk], list(tier.thumbnail_heights.values_list("id", flat=True)), ladder_height_ids)
+
+
+_file_removals = threading.local()
+
+
+@contextmanager
+def batched_file_removal():
+    """
+    Inside this block, the files of deleted images and thumbnails aren't removed right away,
+    but collected and handed to a single background job, which is queued only if the block succeeds
+    """
+    _file_removals.paths = []
+    try:
+        yield
+        if _file_removals.paths:
+            Job.enqueue(Job.DELETE_FILES, paths=_file_removals.paths)
+    finally:
+        _file_removals.paths = None
+
+
+def remove_path(path):
+    """
+    Remove a file or directory of the media storage once the current transaction is committed,
+    so files are never lost to deletions that are rolled back, or leave it to the background job of the current batch
+    """
+    paths = getattr(_file_removals, "paths", None)
+    if paths is not None:
+        paths.append(path)
     else:
-        new_image_pil = original_image_pil
-    if new_image_pil.mode in ("RGBA", "P"):
-        new_image_pil = new_image_pil.convert("RGB")
-    buffer = BytesIO()  # temporary buffer to save the image to
-    new_image_pil.save(fp=buffer, format="JPEG")
-    return ContentFile(buffer.getvalue())
-
-
-def create_thumbnail(image, height):
-    """Create a new Thumbnail object with the specified height"""
-    thumbnail_height = ThumbnailHeight.objects.get(height=height)
-    thumbnail_pil = resize_image_to_thumbnail(image.file, height)
-    new_thumbnail = Thumbnail.objects.create(thumbnail_height=thumbnail_height, image=image)
-    new_thumbnail.file.save(f"{Path(image.file.name).stem}.jpg", InMemoryUploadedFile(
-        thumbnail_pil,
-        None,
-        f"{Path(image.file.name).stem}.jpg",
-        'image/jpeg',
-        thumbnail_pil.tell,
-        None
-    ))
-    new_thumbnail.save()
+        transaction.on_commit(lambda: remove_paths([path]))
+
+
+def remove_paths(paths):
+    """Remove files and directories of the media storage, along with directories left empty by removed files"""
+    if not filesystem_storage():
+        # object storages have no directories, and every file written to one is a blob
+        default_storage.delete_many(paths)
+        return
+    for path in paths:
+        full_path = default_storage.path(path)
+        if os.path.isdir(full_path):
+            shutil.rmtree(full_path)
+        elif os.path.isfile(full_path):
+            os.remove(full_path)
+            directory = Path(full_path).parent
+            while directory != Path(settings.MEDIA_ROOT):
+                try:
+                    directory.rmdir()
+                except OSError:  # other files are still in the directory
+                    break
+                directory = directory.parent
+
+
+def content_hash(file):
+    """SHA-256 of a file's content, stored to be used as its ETag"""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
 
 
 def create_random_slug():
@@ -65,7 +139,7 @@ def create_random_slug():
 
 class ThumbnailHeight(models.Model):
     """Model to store possible thumbnail heights"""
-    height = models.IntegerField(validators=[MinValueValidator(0)])
+    height = models.IntegerField(unique=True, validators=[MinValueValidator(0)])
 
     def __str__(self):
         return f"{self.height}px"
@@ -77,10 +151,118 @@ class Tier(models.Model):
     thumbnail_heights = models.ManyToManyField(ThumbnailHeight)  # thumbnail heights available to users with this tier
     can_get_original = models.BooleanField(default=False)  # if True, users with this tier can get the link to the original image
     can_get_temporary = models.BooleanField(default=False)  # if True, users with this tier can generate a temporary link to their image
+    # if both are set, users with this tier can also request thumbnails of any height in this range, see THUMBNAIL_HEIGHT_LADDER
+    min_thumbnail_height = models.PositiveIntegerField(null=True, blank=True)
+    max_thumbnail_height = models.PositiveIntegerField(null=True, blank=True)
+    # formats thumbnails can be served in, in order of preference, the first one accepted by the client is used
+    thumbnail_formats = models.CharField(max_length=50, default="jpeg", help_text="Space separated, from jpeg, webp and avif")
+    thumbnail_quality = models.PositiveSmallIntegerField(null=True, blank=True, validators=[MinValueValidator(1), MaxValueValidator(100)])
+    # seconds clients may reuse images and thumbnails without revalidating them, IMAGE_CACHE_MAX_AGE if empty
+    cache_max_age = models.PositiveIntegerField(null=True, blank=True)
+    # limits of uploaded images, checked from their header before they're decoded, MAX_IMAGE_PIXELS and MAX_IMAGE_DIMENSION if empty
+    max_pixels = models.PositiveBigIntegerField(null=True, blank=True)
+    max_dimension = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.name}"
 
+    def clean(self):
+        for format in self.thumbnail_formats.split():
+            if format not in FORMATS:
+                raise ValidationError(f"Unknown thumbnail format {format}")
+        if (self.min_thumbnail_height is None) != (self.max_thumbnail_height is None):
+            raise ValidationError("Set both the minimum and the maximum thumbnail height, or neither of them")
+        if self.min_thumbnail_height is not None and self.min_thumbnail_height > self.max_thumbnail_height:
+            raise ValidationError("The minimum thumbnail height can't be bigger than the maximum")
+
+    def ladder_heights(self):
+        """Heights of the ladder that requests for arbitrary heights of this tier are snapped to"""
+        if self.min_thumbnail_height is None or self.max_thumbnail_height is None:
+            return set()
+        lowest, highest = snap_to_ladder(self.min_thumbnail_height), snap_to_ladder(self.max_thumbnail_height)
+        return set(height for height in settings.THUMBNAIL_HEIGHT_LADDER if lowest <= height <= highest)
+
+
+class BlobQuerySet(models.QuerySet):
+
+    def unreferenced(self):
+        """Blobs used by no image, thumbnail or rendition, and not reused for BLOB_GC_GRACE seconds"""
+        return self.filter(
+            ~models.Exists(Image.objects.filter(blob=models.OuterRef("pk"))),
+            ~models.Exists(Thumbnail.objects.filter(blob=models.OuterRef("pk"))),
+            ~models.Exists(Blob.objects.filter(source=models.OuterRef("pk"))),
+            datetime_referenced__lt=timezone.now() - timedelta(seconds=settings.BLOB_GC_GRACE),
+        )
+
+
+class Blob(models.Model):
+    """
+    Model to store a file of the content addressed storage, shared by every image or thumbnail with the same content.
+    Originals are stored once per SHA-256, whoever uploads them under whatever name,
+    and renditions once per original, height, format and quality, so they're rendered only once.
+    Blobs aren't deleted with their images and thumbnails, but by `manage.py collect_blobs` once nothing references them.
+    """
+    sha256 = models.CharField(max_length=64, db_index=True)
+    file = models.FileField(upload_to=blob_path)
+    size = models.PositiveBigIntegerField(default=0)
+    # the rendition key, empty for originals
+    source = models.ForeignKey("self", related_name="renditions", null=True, blank=True, on_delete=models.PROTECT)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    format = models.CharField(max_length=10, blank=True)
+    quality = models.PositiveSmallIntegerField(null=True, blank=True)
+    # updated whenever the blob is reused, blobs are only collected a while after that, see BLOB_GC_GRACE
+    datetime_referenced = models.DateTimeField(default=timezone.now)
+
+    objects = BlobQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["sha256"], condition=models.Q(source__isnull=True), name="unique_original_blob"),
+            models.UniqueConstraint(fields=["source", "height", "format", "quality"], name="unique_rendition_blob"),
+        ]
+
+    def __str__(self):
+        if self.source_id is None:
+            return f"Blob {self.sha256}"
+        return f"Blob {self.sha256}, {self.height}px {self.format} rendition of blob {self.source_id}"
+
+    @classmethod
+    def find_renditions(cls, source, heights, format, quality):
+        """Return the stored renditions of an original, keyed by height"""
+        if source is None:  # images stored before blobs existed have no renditions
+            return {}
+        renditions = {blob.height: blob for blob in cls.objects.filter(source=source, height__in=heights, format=format, quality=quality)}
+        cls.objects.filter(pk__in=[blob.pk for blob in renditions.values()]).update(datetime_referenced=timezone.now())
+        return renditions
+
+    @classmethod
+    def store(cls, content, filename, source=None, height=None, format="", quality=None):
+        """Return the blob with the given content (or rendition key), the content is only written if it isn't stored yet"""
+        if source is None and height is not None:
+            raise ValueError("Renditions are keyed by the blob of their original")
+        sha256 = content_hash(content)
+        if source is None:
+            key = {"sha256": sha256, "source": None}
+        else:
+            key = {"source": source, "height": height, "format": format, "quality": quality}
+        if cls.objects.filter(**key).update(datetime_referenced=timezone.now()):
+            return cls.objects.get(**key)
+
+        blob = cls(sha256=sha256, size=content.size, source=source, height=height, format=format, quality=quality)
+        blob.file.save(filename, content, save=False)
+        try:
+            with transaction.atomic():
+                blob.save()
+        except IntegrityError:
+            # stored by a concurrent upload or render in the meantime
+            existing = cls.objects.get(**key)
+            if existing.file.name != blob.file.name:
+                remove_paths([blob.file.name])
+            return existing
+        if source is not None:
+            metrics.rendition_bytes.observe(blob.size, format=format)
+        return blob
+
 
 class ImageAPIUser(models.Model):
     """Model to store the tier of the account"""
@@ -93,85 +275,275 @@ class ImageAPIUser(models.Model):
     def save(self, *args, **kwargs):
         """
         The save function is overridden to update all thumbnails when the user switches tiers.
-        This could probably be heavily optimized, but switching tiers shouldn't occur often
-        enough to cause issues.
+        Users can have a lot of images, so the update runs in the background, see TierReconciliation.
         """
+        previous_tier_id = None
+        if self.pk is not None:
+            previous_tier_id = ImageAPIUser.objects.filter(pk=self.pk).values_list("tier_id", flat=True).first()
+
         super().save(*args, **kwargs)
 
-        images = self.images
-        for image in images.all():
-            thumbnails = image.thumbnails.all()
-            existing_heights = set(map(lambda x: x.thumbnail_height.height, thumbnails))
-            correct_heights = set(map(lambda x: x.height, self.tier.thumbnail_heights.all()))
-            added_heights = list(correct_heights - existing_heights)  # get all the thumbnail heights that the user gained access to
-            removed_resolutions = list(existing_heights - correct_heights)  # get all the thumbnail heights that the user lost access to
-            for thumbnail in thumbnails:
-                if thumbnail.thumbnail_height.height in removed_resolutions:
-                    thumbnail.delete()
-            for height in added_heights:
-                create_thumbnail(image, height)
+        if previous_tier_id is not None and previous_tier_id != self.tier_id:
+            reconciliation = TierReconciliation.objects.create(user=self, images_total=self.images.count())
+            Job.enqueue(Job.RECONCILE_TIER, reconciliation=reconciliation.pk)
 
 
 class Image(models.Model):
     """Model to store the original image and all related thumbnails"""
     name = models.CharField(max_length=100)
     user = models.ForeignKey(ImageAPIUser, related_name="images", on_delete=models.CASCADE)
-    file = models.ImageField(upload_to=original_image_path)
+    file = models.ImageField(upload_to=original_image_path)  # the file of the blob, images uploaded before blobs existed have their own
+    blob = models.ForeignKey(Blob, related_name="images", null=True, blank=True, editable=False, on_delete=models.PROTECT)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)  # SHA-256 of the file, used for ETags and ?v= URLs
+    datetime_uploaded = models.DateTimeField(default=timezone.now, editable=False)  # used for Last-Modified
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "id"])]  # used by the keyset pagination of the image list
 
     def __str__(self):
         return f"Image {self.name} uploaded by {self.user.auth_user.username}"
 
     def save(self, *args, **kwargs):
         """
-        The save function is overridden to create thumbnails whenever the image is uploaded.
-        It also makes sure the state of the thumbnails is synchronized between the DB and the filesystem
+        The save function is overridden to schedule thumbnails whenever the image is uploaded.
+        Rendering happens in the background worker, so the upload request doesn't wait for it.
+        Newly uploaded files are stored as blobs, so a file that's already stored isn't written again.
         """
+        if self.file and not self.file._committed:
+            self.use_blob(Blob.store(self.file.file, self.file.name))  # the uploaded file itself, so temporary files are moved instead of copied
 
         super().save(*args, **kwargs)
 
-        existing_thumbnail_heights = map(lambda x: x.thumbnail_height, self.thumbnails.all())
-
-        correct_thumbnail_heights = self.user.tier.thumbnail_heights.all()
-        if existing_thumbnail_heights != correct_thumbnail_heights:
-            for thumbnail_height in correct_thumbnail_heights:
-                if thumbnail_height not in existing_thumbnail_heights:
-                    create_thumbnail(self, thumbnail_height.height)
+        schedule_thumbnails(self)
+
+    def use_blob(self, blob):
+        """Make the original stored in the blob the file of this image, without saving it, used for images created in bulk"""
+        self.blob = blob
+        self.file = blob.file.name
+        self.content_hash = blob.sha256
+        self.datetime_uploaded = timezone.now()
+
+
+class TierReconciliation(models.Model):
+    """
+    Model to store the progress of updating the thumbnails of all images of a user after a tier change.
+    Images are processed in chunks ordered by id, and the id of the last processed image is stored,
+    so an interrupted reconciliation continues where it stopped.
+    """
+    RUNNING = "running"
+    DONE = "done"
+    STATUS_CHOICES = [
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+    ]
+
+    user = models.ForeignKey(ImageAPIUser, related_name="tier_reconciliations", on_delete=models.CASCADE)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=RUNNING)
+    last_image_id = models.BigIntegerField(default=0)
+    images_done = models.PositiveIntegerField(default=0)
+    images_total = models.PositiveIntegerField(default=0)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+    datetime_updated = models.DateTimeField(auto_now=True)
 
-            for thumbnail_height in existing_thumbnail_heights:
-                if thumbnail_height not in correct_thumbnail_heights:
-                    self.thumbnails.get(thumbnail_height=thumbnail_height).delete()
+    def __str__(self):
+        return f"Tier reconciliation of {self.user.auth_user.username}: {self.images_done}/{self.images_total} images"
 
 
 class Thumbnail(models.Model):
     """Model to store a thumbnail of an image"""
+    PENDING = "pending"
+    READY = "ready"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (READY, "Ready"),
+        (FAILED, "Failed"),
+    ]
+
+    JPEG = "jpeg"
+    WEBP = "webp"
+    AVIF = "avif"
+    FORMAT_CHOICES = [
+        (JPEG, "JPEG"),
+        (WEBP, "WebP"),
+        (AVIF, "AVIF"),
+    ]
+
     thumbnail_height = models.ForeignKey(ThumbnailHeight, on_delete=models.PROTECT)
     image = models.ForeignKey(Image, related_name="thumbnails", on_delete=models.CASCADE)
-    file = models.ImageField(upload_to=thumbnail_path)
+    file = models.ImageField(upload_to=thumbnail_path, blank=True)  # the file of the blob, empty until the thumbnail is rendered
+    blob = models.ForeignKey(Blob, related_name="thumbnails", null=True, blank=True, on_delete=models.PROTECT)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default=JPEG)  # only JPEGs are rendered eagerly, other formats on first request
+    size = models.PositiveBigIntegerField(default=0)  # size of the file in bytes, counted against THUMBNAIL_CACHE_MAX_BYTES
+    last_accessed = models.DateTimeField(null=True, blank=True, db_index=True)  # used to evict the least recently used thumbnails
+    content_hash = models.CharField(max_length=64, blank=True)  # SHA-256 of the file, used for ETags
+    datetime_rendered = models.DateTimeField(null=True, blank=True)  # used for Last-Modified
+
+    class Meta:
+        constraints = [
+            # concurrent uploads, tier changes and requests rendering on demand can't create the same thumbnail twice
+            models.UniqueConstraint(fields=["image", "thumbnail_height", "format"], name="unique_thumbnail"),
+        ]
 
     def __str__(self):
-        return f"{self.thumbnail_height.__str__()} thumbnail of image {self.image.name}"
+        return f"{self.thumbnail_height.__str__()} {self.get_format_display()} thumbnail of image {self.image.name}"
+
+    def use_blob(self, blob):
+        """Make the rendition stored in the blob the file of this thumbnail, without saving it"""
+        self.blob = blob
+        self.file = blob.file.name
+        self.content_hash = blob.sha256
+        self.size = blob.size
+        self.status = Thumbnail.READY
+        self.datetime_rendered = timezone.now()
+
+    def use_file(self, content, filename):
+        """
+        Store the rendition of an image stored before blobs existed as a file of this thumbnail, without saving it.
+        Renditions are keyed by the blob of their original, which it doesn't have, `manage.py migrate_media_layout` makes both blobs.
+        """
+        self.blob = None
+        self.content_hash = content_hash(content)
+        self.size = content.size
+        self.file.save(filename, content, save=False)
+        self.status = Thumbnail.READY
+        self.datetime_rendered = timezone.now()
+
+
+class TemporaryLinkQuerySet(models.QuerySet):
+
+    def active(self):
+        return self.filter(expires_at__gt=timezone.now())
+
+    def expired(self):
+        return self.filter(expires_at__lte=timezone.now())
 
 
 class TemporaryLink(models.Model):
+    MAX_DURATION = timedelta(seconds=30000)  # also the longest a signed link stays valid
+
     image = models.ForeignKey(Image, related_name="temporary_links", on_delete=models.CASCADE)
-    datetime_created = models.DateTimeField(auto_now_add=True)
-    duration = models.DurationField(verbose_name="duration in seconds", validators=[MinValueValidator(timedelta(seconds=300)), MaxValueValidator(timedelta(seconds=30000))])
+    datetime_created = models.DateTimeField(default=timezone.now, editable=False)  # not auto_now_add, so expires_at can be derived from it before saving
+    duration = models.DurationField(verbose_name="duration in seconds", validators=[MinValueValidator(timedelta(seconds=300)), MaxValueValidator(MAX_DURATION)])
     slug = models.SlugField(editable=False, default=create_random_slug)
+    # stored so that expired links can be filtered with an index, it's only empty for links
+    # created before the column existed, until `manage.py purge_expired_links --backfill` is run
+    expires_at = models.DateTimeField(null=True, editable=False, db_index=True)
+
+    objects = TemporaryLinkQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=["datetime_created", "id"])]  # used by the keyset pagination of the temporary link list
+
+    def save(self, *args, **kwargs):
+        self.expires_at = self.datetime_created + self.duration
+        super().save(*args, **kwargs)
+
+
+class UploadSessionQuerySet(models.QuerySet):
+
+    def active(self):
+        return self.filter(expires_at__gt=timezone.now())
+
+    def expired(self):
+        return self.filter(expires_at__lte=timezone.now())
+
+
+class UploadSession(models.Model):
+    """
+    Model to store a resumable upload. The image is sent in chunks with Content-Range,
+    and after a failed request the client asks how much was received, to send only the rest.
+    The received bytes are kept in a part file in UPLOAD_TEMP_DIR, until the upload is complete and becomes an Image.
+    """
+    user = models.ForeignKey(ImageAPIUser, related_name="upload_sessions", on_delete=models.CASCADE)
+    name = models.CharField(max_length=100)  # of the image created when the upload completes
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField(null=True, blank=True)  # total size, if it's not known up front it's sent with the last chunk
+    received = models.PositiveBigIntegerField(default=0)
+    slug = models.SlugField(editable=False, default=create_random_slug, unique=True)
+    datetime_created = models.DateTimeField(default=timezone.now, editable=False)
+    expires_at = models.DateTimeField(editable=False, db_index=True)  # unfinished uploads are deleted by `manage.py purge_expired_links`
+
+    objects = UploadSessionQuerySet.as_manager()
+
+    def __str__(self):
+        return f"Upload of {self.name} by {self.user.auth_user.username}: {self.received}/{self.size or '?'} bytes"
+
+    @property
+    def part_path(self):
+        return os.path.join(settings.UPLOAD_TEMP_DIR, f"{self.slug}.part")
+
+    def save(self, *args, **kwargs):
+        if self.expires_at is None:
+            self.expires_at = self.datetime_created + timedelta(seconds=settings.UPLOAD_SESSION_MAX_AGE)
+        super().save(*args, **kwargs)
+
+
+class Job(models.Model):
+    """Model to store background jobs, so that slow work like rendering thumbnails doesn't block requests"""
+    RENDER_THUMBNAILS = "render_thumbnails"
+    RECONCILE_TIER = "reconcile_tier"
+    DELETE_FILES = "delete_files"
+    KIND_CHOICES = [
+        (RENDER_THUMBNAILS, "Render thumbnails"),
+        (RECONCILE_TIER, "Reconcile tier"),
+        (DELETE_FILES, "Delete files"),
+    ]
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    kind = models.CharField(max_length=50, choices=KIND_CHOICES)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)  # the job won't be picked up before this time, used for retry backoff
+    locked_at = models.DateTimeField(null=True, blank=True)  # when a worker claimed the job, used to recover jobs of crashed workers
+    last_error = models.TextField(blank=True)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "available_at"])]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} job {self.pk} ({self.status})"
+
+    @classmethod
+    def enqueue(cls, kind, **payload):
+        """Add a new job to the queue"""
+        return cls.objects.create(kind=kind, payload=payload)
 
 
 @receiver(models.signals.post_delete, sender=Thumbnail)
 def delete_thumbnails_on_delete(sender, instance, **kwargs):
-    """This function deletes a thumbnail file and it's corresponding folder when a thumbnail is deleted"""
-    directory = Path(instance.file.path).parent
-    if instance.file:
-        if os.path.isdir(directory):
-            shutil.rmtree(directory)
+    """
+    This function deletes the file of a thumbnail rendered before blobs existed, and it's corresponding folder if it's left empty.
+    Blobs are shared, so they're left to `manage.py collect_blobs`.
+    """
+    if instance.file and instance.blob_id is None:  # pending thumbnails don't have a file yet
+        remove_path(instance.file.name)
 
 
 @receiver(models.signals.post_delete, sender=Image)
 def delete_image_on_delete(sender, instance, **kwargs):
-    """This function deletes every file related to an image that has been deleted"""
-    directory = Path(instance.file.path).parents[1]
-    if instance.file:
-        if os.path.isdir(directory):
-            shutil.rmtree(directory)
+    """This function deletes every file related to an image uploaded before blobs existed, blobs are left to `manage.py collect_blobs`"""
+    if instance.file and instance.blob_id is None:
+        remove_path(str(Path(instance.file.name).parents[1]))
+
+
+@receiver(models.signals.post_delete, sender=UploadSession)
+def delete_upload_part_on_delete(sender, instance, **kwargs):
+    """This function deletes the received part of an upload that was completed or abandoned"""
+    try:
+        os.remove(instance.part_path)
+    except FileNotFoundError:  # completed uploads are moved to the blob storage
+        pass
@@ -0,0 +1,47 @@
+"""
+Media storage in an S3 compatible object storage, used with MEDIA_STORAGE set to "s3".
+
+It needs django-storages and boto3, which are only imported when it's configured. Files are served from presigned URLs,
+either by redirecting clients to them, or by nginx fetching them (MEDIA_DELIVERY), so any number of hosts can serve
+the same media without sharing a disk. Uploads are streamed in multipart chunks of S3_MULTIPART_CHUNK_SIZE.
+"""
+from boto3.s3.transfer import TransferConfig
+from django.conf import settings
+from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
+
+DELETE_BATCH_SIZE = 1000  # the most objects S3 deletes in one request
+
+
+class ObjectStorage(S3Boto3Storage):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._transfer_config = TransferConfig(
+            multipart_threshold=settings.S3_MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=settings.S3_MULTIPART_CHUNK_SIZE,
+            use_threads=self.use_threads,
+        )
+
+    @property
+    def public_client(self):
+        """A client signing URLs for S3_PUBLIC_ENDPOINT_URL, the endpoint clients reach, which can differ from the one the app uses"""
+        client = getattr(self._connections, "public_client", None)
+        if client is None:
+            client = self._create_session().client(
+                "s3", region_name=self.region_name, endpoint_url=settings.S3_PUBLIC_ENDPOINT_URL or self.endpoint_url, config=self.config,
+            )
+            self._connections.public_client = client
+        return client
+
+    def public_url(self, name):
+        """A presigned URL of the file for clients, valid for AWS_QUERYSTRING_EXPIRE seconds, signing it makes no request"""
+        params = {"Bucket": self.bucket_name, "Key": self._normalize_name(clean_name(name))}
+        return self.public_client.generate_presigned_url("get_object", Params=params, ExpiresIn=self.querystring_expire)
+
+    def delete_many(self, names):
+        """Delete files in batches of DELETE_BATCH_SIZE, a request each, names that don't exist are ignored"""
+        keys = [self._normalize_name(clean_name(name)) for name in names]
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            objects = [{"Key": key} for key in keys[start:start + DELETE_BATCH_SIZE]]
+            self.bucket.delete_objects(Delete={"Objects": objects, "Quiet": True})
@@ -0,0 +1,19 @@
+from rest_framework.pagination import CursorPagination
+
+
+class ImageCursorPagination(CursorPagination):
+    """Keyset pagination over image ids, so every page costs the same however big the library is"""
+    ordering = "id"
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+class TemporaryLinkCursorPagination(CursorPagination):
+    """
+    Keyset pagination over temporary links, newest first.
+    The cursor only holds the creation time, links created at the same time are paged with an offset,
+    which the id keeps stable.
+    """
+    ordering = ("-datetime_created", "-id")
+    page_size_query_param = "page_size"
+    max_page_size = 1000
@@ -1,4 +1,5 @@
 from rest_framework import permissions
+from image_api.capabilities import get_capabilities
 
 
 class IsImageOwnerOrReadOnly(permissions.BasePermission):
@@ -28,4 +29,4 @@ class IsTemporaryLinkCapableOrReadOnly(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return True
 
-        return request.user.image_api_user.tier.can_get_temporary
+        return get_capabilities(request).can_get_temporary
@@ -0,0 +1,189 @@
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image as PILImage, features
+from image_api.storage import filesystem_storage
+from image_api.uploads import SpooledFile
+from image_api import metrics
+
+import mmap
+import os
+import tempfile
+import weakref
+
+REDUCING_GAP = 2  # reduce() is only used while the image is at least this many times bigger than the target
+
+# thumbnail formats: Pillow format name, content type and file extension
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+    "avif": ("AVIF", "image/avif", ".avif"),
+}
+
+
+def format_supported(format):
+    """JPEG is always available, WebP and AVIF depend on how Pillow was built"""
+    return format == "jpeg" or features.check(format)
+
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:  # moved to its place by the storage
+        pass
+
+
+class RenderedFile(SpooledFile):
+    """
+    A thumbnail encoded straight into a temporary file in UPLOAD_TEMP_DIR, on the media volume, so storing it is a rename,
+    and the encoded image is never held in memory. The temporary file is deleted when the file is closed or garbage collected,
+    unless the storage moved it.
+    """
+
+    def __init__(self, path, name):
+        super().__init__(path, name)
+        self._remove = weakref.finalize(self, remove_if_exists, path)
+
+    def close(self):
+        super().close()
+        self._remove()
+
+    def keep(self):
+        """Close the file without deleting it, so another process can store it, returns its path"""
+        super().close()
+        self._remove.detach()
+        return self.path
+
+
+@contextmanager
+def rendered_files(paths, format="jpeg"):
+    """Open the files rendered by another process, kept with RenderedFile.keep(), and delete the ones not stored afterwards"""
+    files = {key: RenderedFile(path, f"thumbnail{FORMATS[format][2]}") for key, path in paths.items()}
+    try:
+        yield files
+    finally:
+        for file in files.values():
+            file.close()
+
+
+class MappedFile(mmap.mmap):
+    """A read only memory map that can seek past its end like a file, which Pillow does probing files it can't identify"""
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        position = {os.SEEK_SET: 0, os.SEEK_CUR: self.tell(), os.SEEK_END: len(self)}[whence] + offset
+        return super().seek(min(position, len(self)))
+
+
+@contextmanager
+def open_original(name):
+    """
+    Open a media file to render thumbnails from. Files on the local filesystem are memory mapped,
+    so Pillow reads them straight from the page cache, without a buffered copy of every chunk.
+    """
+    if not filesystem_storage():
+        with default_storage.open(name) as file:
+            yield file
+        return
+    with open(default_storage.path(name), "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:  # empty files can't be mapped, Pillow fails to identify them anyway
+            yield file
+            return
+        with MappedFile(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def snap_to_ladder(height):
+    """Return the smallest height of THUMBNAIL_HEIGHT_LADDER that's at least the given height, or the biggest one"""
+    ladder = sorted(settings.THUMBNAIL_HEIGHT_LADDER)
+    for rung in ladder:
+        if rung >= height:
+            return rung
+    return ladder[-1]
+
+
+def size_for_height(size, height):
+    """Calculate the size of an image resized to the given height, keeping its aspect ratio"""
+    width, original_height = size
+    scale = height / original_height  # calculate the scale by which the height is being resized
+    return round(width * scale), height  # resize the width by the same scale
+
+
+def open_for_heights(original_image, max_height):
+    """
+    Open the original image and decode it, letting the decoder skip as much work as possible.
+    For JPEGs draft() makes the decoder downscale by a power of two while decoding,
+    as long as the result isn't smaller than the biggest thumbnail.
+    Images over MAX_IMAGE_PIXELS are refused before they're decoded, uploads are checked against the limits
+    of their tier, this guards the worker against files that got in some other way.
+    """
+    original_image_pil = PILImage.open(original_image)
+    original_size = original_image_pil.size
+    if original_size[0] * original_size[1] > settings.MAX_IMAGE_PIXELS:
+        raise PILImage.DecompressionBombError(f"Image of {original_size[0]}x{original_size[1]} pixels is over MAX_IMAGE_PIXELS")
+    if original_image_pil.format == "JPEG" and original_size[1] > max_height:
+        original_image_pil.draft("RGB", size_for_height(original_size, max_height))
+    with metrics.timer(metrics.pillow_duration, stage="decode", format=original_image_pil.format.lower()):
+        original_image_pil.load()
+    if original_image_pil.mode not in ("RGB", "RGBA", "L"):
+        # transparency is kept for the formats that support it, JPEGs drop it when they're encoded
+        has_alpha = "A" in original_image_pil.mode or "transparency" in original_image_pil.info
+        original_image_pil = original_image_pil.convert("RGBA" if has_alpha else "RGB")
+    return original_image_pil, original_size
+
+
+def resize_to_height(image_pil, original_size, height):
+    """Resize an already decoded image, using reduce() for the bulk of big downscales as it's much cheaper"""
+    target_size = size_for_height(original_size, height)
+    factor = image_pil.size[1] // (height * REDUCING_GAP)
+    with metrics.timer(metrics.pillow_duration, stage="resize"):
+        if factor > 1:
+            image_pil = image_pil.reduce(factor)
+        return image_pil.resize(target_size)
+
+
+def encode_thumbnail(image_pil, format="jpeg", quality=None):
+    """Encode a thumbnail in one of FORMATS, with the given quality or the default of settings.THUMBNAIL_QUALITY"""
+    quality = quality or settings.THUMBNAIL_QUALITY
+    os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".render" + FORMATS[format][2], dir=settings.UPLOAD_TEMP_DIR)
+    try:
+        # Pillow encodes into a real file with the encoder writing to its descriptor, without Python buffers in between
+        with os.fdopen(fd, "wb") as file, metrics.timer(metrics.pillow_duration, stage="encode", format=format):
+            if format == "jpeg":
+                if image_pil.mode == "RGBA":
+                    image_pil = image_pil.convert("RGB")
+                image_pil.save(fp=file, format="JPEG", quality=quality, optimize=True, progressive=True)
+            else:
+                image_pil.save(fp=file, format=FORMATS[format][0], quality=quality)
+    except BaseException:
+        os.remove(path)
+        raise
+    return RenderedFile(path, f"thumbnail{FORMATS[format][2]}")
+
+
+def render_thumbnails(original_image, heights, format="jpeg", quality=None):
+    """
+    Render thumbnails of all the given heights, decoding the original image only once.
+    Thumbnails are rendered from the biggest to the smallest one, and every thumbnail
+    is derived from the previous one instead of the full size original.
+    Returns a dict mapping heights to RenderedFiles.
+    """
+    heights = sorted(set(heights), reverse=True)
+    if not heights:
+        return {}
+    image_pil, original_size = open_for_heights(original_image, heights[0])
+
+    thumbnails = {}
+    for height in heights:
+        if original_size[1] > height:
+            image_pil = resize_to_height(image_pil, original_size, height)
+        thumbnails[height] = encode_thumbnail(image_pil, format, quality)
+    return thumbnails
+
+
+def resize_image_to_thumbnail(original_image, height):
+    """
+    Resize the original image to a JPEG thumbnail, returned as a RenderedFile in UPLOAD_TEMP_DIR.
+    Callers must close it, in a with block or a finally, so its temporary file is removed if it isn't stored.
+    """
+    return render_thumbnails(original_image, [height])[height]
@@ -1,27 +1,45 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth.models import User
-from image_api.models import Image, ImageAPIUser, TemporaryLink
+from image_api.models import Image, ImageAPIUser, TemporaryLink, UploadSession
+from image_api.uploads import check_image_size, check_upload_size, sniff_image_format
+from image_api.capabilities import TierCapabilities, get_capabilities
+from image_api.signing import signed_link_url
+from image_api.http_cache import versioned_url
 from rest_framework.reverse import reverse
 from datetime import timedelta
 from django.utils import timezone
 
 
-class ThumbnailHyperlink(serializers.HyperlinkedRelatedField):
+def capabilities_from_context(context, image_api_user):
+    """Get the capabilities the view put in the serializer context, or resolve them if the serializer is used on its own"""
+    if "capabilities" in context:
+        return context["capabilities"]
+    return TierCapabilities.for_image_api_user(image_api_user)
+
+
+class ThumbnailHyperlinks(serializers.ReadOnlyField):
     """
     Custom class for generating links for thumbnails.
-    It's necessary because thumbnails have a custom link structure defined in the ImageViewSet.
+    It's necessary because thumbnails have a custom link structure defined in the ImageViewSet,
+    and with lazy rendering the links are generated for every height of the tier,
+    as the thumbnails don't exist until they're first requested.
     """
 
-    view_name = 'image-thumbnail'
+    def __init__(self, **kwargs):
+        super().__init__(source="*", **kwargs)
 
-    def get_url(self, obj, view_name, request, format):
-
-        url_kwargs = {
-            "name": obj.image.name,
-            "height": obj.thumbnail_height.height
-        }
+    def to_representation(self, obj):
+        if settings.THUMBNAIL_RENDERING == "lazy":
+            heights = sorted(capabilities_from_context(self.context, obj.user).thumbnail_heights)
+        else:
+            heights = sorted(set(thumbnail.thumbnail_height.height for thumbnail in obj.thumbnails.all()))
 
-        return reverse(view_name, kwargs=url_kwargs, request=request, format=format)
+        request = self.context.get("request")
+        return [
+            versioned_url(reverse('image-thumbnail', kwargs={"name": obj.name, "height": height}, request=request), obj.content_hash)
+            for height in heights
+        ]
 
 
 class ImageDetailHyperlink(serializers.HyperlinkedIdentityField):
@@ -36,8 +54,8 @@ class ImageDetailHyperlink(serializers.HyperlinkedIdentityField):
             "name": obj.name
         }
 
-        if obj.user.tier.can_get_temporary:
-            return reverse(view_name, kwargs=url_kwargs, request=request, format=format)
+        if capabilities_from_context(self.context, obj.user).can_get_temporary:
+            return versioned_url(reverse(view_name, kwargs=url_kwargs, request=request, format=format), obj.content_hash)
         else:
             return ""
 
@@ -54,7 +72,7 @@ class TemporaryLinkHyperlink(serializers.HyperlinkedRelatedField):
             "slug": obj.slug
         }
 
-        if obj.image.user.tier.can_get_temporary:
+        if capabilities_from_context(self.context, obj.image.user).can_get_temporary:
             return reverse(view_name, kwargs=url_kwargs, request=request, format=format)
         else:
             return ""
@@ -62,10 +80,10 @@ class TemporaryLinkHyperlink(serializers.HyperlinkedRelatedField):
 
 class ImageSerializer(serializers.HyperlinkedModelSerializer):
 
-    file = serializers.ImageField(write_only=True)
+    file = serializers.FileField(write_only=True)
     url = ImageDetailHyperlink(read_only=True, view_name="image-detail")
     user = serializers.ReadOnlyField(source='user.auth_user.username')
-    thumbnails = ThumbnailHyperlink(many=True, read_only=True)
+    thumbnails = ThumbnailHyperlinks()
     temporary_links = TemporaryLinkHyperlink(many=True, read_only=True, view_name="temporarylink-detail", lookup_field="slug")
 
     class Meta:
@@ -73,11 +91,15 @@ class ImageSerializer(serializers.HyperlinkedModelSerializer):
         fields = ['name', 'user', 'file', 'url', 'thumbnails', 'temporary_links']
 
     def validate_file(self, image):
-        """Makes sure the uploaded image is a PNG or a JPEG as required by the project specification"""
-        if image.image.format in ('PNG', 'JPEG'):
-            return image
-        else:
+        """
+        Makes sure the uploaded image is a PNG or a JPEG as required by the project specification, and within the limits of the tier.
+        Only the header of the file is read, images that turn out to be broken get failed thumbnails.
+        """
+        if sniff_image_format(image) not in ('PNG', 'JPEG'):
             raise serializers.ValidationError("Image must be a PNG or a JPEG")
+        capabilities = get_capabilities(self.context['request'])
+        check_image_size(image, capabilities.max_pixels, capabilities.max_dimension)
+        return image
 
     def validate(self, data):
         """
@@ -109,10 +131,11 @@ class TemporaryLinkSerializer(serializers.HyperlinkedModelSerializer):
     duration = serializers.SerializerMethodField()
     time_left = serializers.SerializerMethodField()
     url = serializers.HyperlinkedIdentityField(view_name="temporarylink-detail", lookup_field="slug")
+    signed_url = serializers.SerializerMethodField()
 
     class Meta:
         model = TemporaryLink
-        fields = ['image', 'datetime_created', 'duration_write', 'duration', 'time_left', 'url']
+        fields = ['image', 'datetime_created', 'duration_write', 'duration', 'time_left', 'url', 'signed_url']
         extra_kwargs = {'duration_write': {'write_only': True, 'source': 'duration'}}
 
     def validate_duration(self, duration):
@@ -125,7 +148,46 @@ class TemporaryLinkSerializer(serializers.HyperlinkedModelSerializer):
     def get_duration(self, obj):
         return f"{round(obj.duration.total_seconds())}"
 
+    def get_signed_url(self, obj):
+        """A link that works without authentication and is served without any DB queries"""
+        url = signed_link_url(obj.image.file.name, None, obj.expires_at, obj.slug)
+        return self.context["request"].build_absolute_uri(url)
+
     def get_time_left(self, obj):
-        end_time = obj.datetime_created + obj.duration
-        time_left = end_time - timezone.now()
+        time_left = obj.expires_at - timezone.now()
         return f"{round(time_left.total_seconds())}"
+
+
+class TemporaryLinkBatchItemSerializer(serializers.Serializer):
+    """An item of POST /temporary_links/batch/, the images of the whole batch are looked up by name in one query"""
+
+    image = serializers.CharField(max_length=100)
+    duration = serializers.DurationField()
+
+    def validate_duration(self, duration):
+        if duration >= timedelta(seconds=300) and duration <= timedelta(seconds=30000):
+            return duration
+        else:
+            raise serializers.ValidationError("Duration must be between 300 and 30000 seconds!")
+
+
+class UploadSessionSerializer(serializers.HyperlinkedModelSerializer):
+
+    url = serializers.HyperlinkedIdentityField(view_name="upload-detail", lookup_field="slug")
+
+    class Meta:
+        model = UploadSession
+        fields = ['url', 'name', 'filename', 'size', 'received', 'expires_at']
+        read_only_fields = ['received', 'expires_at']
+
+    def validate_size(self, size):
+        if size is not None:
+            check_upload_size(size, settings.UPLOAD_SESSION_MAX_SIZE)
+        return size
+
+    def validate(self, data):
+        """Makes sure the image name is unique for this user, the same check as ImageSerializer's, done before anything is uploaded"""
+        if Image.objects.filter(name=data['name'], user__auth_user=self.context['request'].user).exists():
+            raise serializers.ValidationError({"name": "That image already exists!"})
+        else:
+            return data
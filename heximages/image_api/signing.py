@@ -0,0 +1,54 @@
+"""
+Stateless temporary links.
+
+A signed link carries everything needed to serve the image: the media path, the thumbnail height
+(None for the original) and the expiry time, signed with HMAC, so it can be verified without a DB query.
+With SIGNED_LINK_BACKEND set to "nginx", links are instead signed in the format of nginx's secure_link module,
+and verified by nginx itself without reaching Django at all. nginx serves those from the media volume,
+so with files in an object storage links are always signed for Django.
+"""
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+from image_api.storage import filesystem_storage
+from urllib.parse import quote, urlencode
+
+import base64
+import hashlib
+import time
+
+SALT = "image_api.signed_link"
+
+
+class SignedLinkExpired(signing.BadSignature):
+    """The signature is valid, but the link has expired"""
+
+
+def sign_link(path, height, expires_at, slug=None):
+    """Create a token for the given media path, the slug of the TemporaryLink is kept for revocation checks"""
+    payload = {"p": path, "h": height, "e": int(expires_at.timestamp()), "s": slug}
+    return signing.dumps(payload, key=settings.SIGNED_LINK_SECRET, salt=SALT, compress=True)
+
+
+def unsign_link(token):
+    """Verify a token and return its payload, raises BadSignature or SignedLinkExpired for invalid tokens"""
+    payload = signing.loads(token, key=settings.SIGNED_LINK_SECRET, salt=SALT)
+    if payload["e"] <= time.time():
+        raise SignedLinkExpired("Link has expired")
+    return payload
+
+
+def nginx_secure_link(path, expires_at):
+    """Create a link verified by nginx, the hash has to match secure_link_md5 in nginx.conf"""
+    uri = f"{settings.SIGNED_LINK_NGINX_PREFIX}{path}"
+    expires = int(expires_at.timestamp())
+    digest = hashlib.md5(f"{expires}{uri} {settings.SIGNED_LINK_SECRET}".encode()).digest()
+    md5 = base64.urlsafe_b64encode(digest).decode().rstrip("=")
+    return f"{quote(uri)}?{urlencode({'md5': md5, 'expires': expires})}"
+
+
+def signed_link_url(path, height, expires_at, slug=None):
+    """Create a signed link using the configured backend, the returned URL is relative to the host"""
+    if settings.SIGNED_LINK_BACKEND == "nginx" and filesystem_storage():
+        return nginx_secure_link(path, expires_at)
+    return reverse("signed-media", kwargs={"token": sign_link(path, height, expires_at, slug)})
@@ -0,0 +1,64 @@
+"""
+The media storage, which never leaves partly written files where readers, or reconcile_media, would find them.
+
+Files are stored in MEDIA_ROOT by default. With MEDIA_STORAGE set to "s3" they're stored in an object storage instead,
+see image_api/object_storage.py, and the code touching files goes through default_storage, or checks filesystem_storage().
+"""
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage
+
+import os
+import tempfile
+
+TEMPORARY_PREFIX = ".writing-"  # files being written, reconcile_media removes the ones left by crashed processes
+
+
+class AtomicFileSystemStorage(FileSystemStorage):
+    """
+    File system storage writing every file to a temporary file in its directory, which gets its name only once
+    it's complete and synced to disk, so a crash leaves a temporary file behind instead of a truncated image.
+    Files spooled to a temporary file already, like uploads, are moved with a rename, which is atomic too.
+    """
+
+    def _save(self, name, content):
+        if hasattr(content, "temporary_file_path"):
+            return super()._save(name, content)
+
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary_path = tempfile.mkstemp(prefix=TEMPORARY_PREFIX, dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in content.chunks():
+                    file.write(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary_path, self.file_permissions_mode)
+            while True:
+                try:
+                    os.link(temporary_path, full_path)  # unlike a rename, it never replaces a file that's already there
+                    break
+                except FileExistsError:
+                    name = self.get_available_name(name)
+                    full_path = self.path(name)
+        finally:
+            os.remove(temporary_path)
+        return str(name).replace("\\", "/")
+
+
+def filesystem_storage():
+    """Whether media files are stored in MEDIA_ROOT, where they can be linked, moved and walked directly"""
+    return isinstance(default_storage, FileSystemStorage)
+
+
+def store_file(temporary_path, name):
+    """Move a complete local temporary file to a name of the media storage, whose content is known not to change"""
+    if filesystem_storage():
+        os.makedirs(os.path.dirname(default_storage.path(name)), exist_ok=True)
+        os.replace(temporary_path, default_storage.path(name))
+        return
+    with open(temporary_path, "rb") as file:
+        default_storage.save(name, File(file))
+    os.remove(temporary_path)
@@ -1,14 +1,60 @@
 from django.test import TestCase
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth.models import User
-from image_api.models import ThumbnailHeight, Tier, ImageAPIUser, Image, Thumbnail
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import IntegrityError, connection, transaction
+from django.db.models import QuerySet
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.urls import include, path
+from django.core.files.move import file_move_safe
+from django.utils import timezone
+from image_api.models import ThumbnailHeight, Tier, ImageAPIUser, Image, Thumbnail, Job, TierReconciliation, TemporaryLink, Blob, UploadSession, remove_paths
+from image_api.jobs import claim_jobs, reconcile_tier, run_pending_jobs
+from image_api.capabilities import cached_capabilities, tier_fields, user_tiers
+from image_api.rendering import open_original, render_thumbnails
+from image_api.signing import sign_link, signed_link_url
+from unittest import mock, skipUnless
+from image_api.thumbnail_cache import cache_size, estimated_cache_size, evict_cold_thumbnails, get_or_render_thumbnail, key_lock
+from image_api import metrics
+from image_api.middleware import MetricsMiddleware, install_query_recorder
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from datetime import timedelta
+from io import BytesIO, StringIO
+import asyncio
+import base64
+import fcntl
+import hashlib
+import importlib.util
+import json
 import os
+import pstats
+import re
 import shutil
-from PIL import Image as PILImage
+import struct
+import threading
+import time
+import tracemalloc
+import zlib
+from PIL import Image as PILImage, features
 from rest_framework.test import APIClient
 
 
+def remove_blob_files():
+    """Remove the files of the blobs created by a test, leaving the rest of the media directory alone"""
+    remove_paths(Blob.objects.values_list("file", flat=True))
+
+
+# the URLs of ASGI mode, heximages.urls only includes the async views when SERVER_MODE is "asgi" at startup
+urlpatterns = [
+    path('', include('image_api.async_urls')),
+    path('', include('image_api.urls')),
+]
+
+
 class CreateThumbnailsTestCase(TestCase):
     def setUp(self):
         th200 = ThumbnailHeight.objects.create(height=200)
@@ -20,20 +66,23 @@ class CreateThumbnailsTestCase(TestCase):
         image = Image(name="testimage", user=iapiu)
         image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
         image.save()
+        run_pending_jobs()
 
     def tearDown(self):
-        shutil.rmtree(settings.MEDIA_ROOT / "testuser")
+        remove_blob_files()
 
     def test_image_uploaded(self):
-        self.assertTrue(os.path.isdir(settings.MEDIA_ROOT / "testuser/testimage/original"))
-        self.assertTrue(os.path.isfile(settings.MEDIA_ROOT / "testuser/testimage/original/TestImage.png"))
+        image = Image.objects.get(name="testimage")
+        self.assertEqual(image.file.name, f"blobs/{image.content_hash[:2]}/{image.content_hash[2:4]}/{image.content_hash}.png")
+        self.assertTrue(os.path.isfile(image.file.path))
 
     def test_thumbnail_created(self):
         pil_file = PILImage.open(Thumbnail.objects.get(image__name="testimage").file)
         self.assertTrue(pil_file.size[1] == 200)
         self.assertTrue(pil_file.format == "JPEG")
-        self.assertTrue(os.path.isdir(settings.MEDIA_ROOT / "testuser/testimage/200"))
-        self.assertTrue(os.path.isfile(settings.MEDIA_ROOT / "testuser/testimage/200/TestImage.jpg"))
+        thumbnail = Thumbnail.objects.get(image__name="testimage")
+        self.assertEqual(thumbnail.blob.source, Image.objects.get(name="testimage").blob)
+        self.assertTrue(os.path.isfile(thumbnail.file.path))
 
     def test_tier_switch(self):
         th400 = ThumbnailHeight.objects.create(height=400)
@@ -41,12 +90,79 @@ class CreateThumbnailsTestCase(TestCase):
         tier.thumbnail_heights.add(th400)
         tier.save()
         iapiu = ImageAPIUser.objects.get(auth_user__username="testuser")
+        old_thumbnail = Thumbnail.objects.get(image__name="testimage")
         iapiu.tier = tier
         iapiu.save()
+        run_pending_jobs()
+
+        thumbnail = Thumbnail.objects.get(image__name="testimage")
+        self.assertEqual(thumbnail.thumbnail_height, th400)
+        self.assertTrue(os.path.isfile(thumbnail.file.path))
+        with override_settings(BLOB_GC_GRACE=0):
+            call_command("collect_blobs", stdout=StringIO())
+        self.assertFalse(os.path.isfile(old_thumbnail.file.path))
+        self.assertTrue(os.path.isfile(thumbnail.file.path))
+
+
+class TierReconciliationTestCase(TestCase):
+    def setUp(self):
+        self.th200 = ThumbnailHeight.objects.create(height=200)
+        self.th400 = ThumbnailHeight.objects.create(height=400)
+        tier = Tier.objects.create(name="testtier")
+        tier.thumbnail_heights.add(self.th200)
+        self.tier2 = Tier.objects.create(name="testtier2")
+        self.tier2.thumbnail_heights.add(self.th400)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+        for name in ("testimage1", "testimage2", "testimage3"):
+            image = Image(name=name, user=self.iapiu)
+            image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+            image.save()
+        run_pending_jobs()
+
+    def tearDown(self):
+        remove_blob_files()
+
+    @override_settings(RECONCILIATION_CHUNK_SIZE=2)
+    def test_reconciliation_progress(self):
+        self.iapiu.tier = self.tier2
+        self.iapiu.save()
+        run_pending_jobs()
+
+        reconciliation = TierReconciliation.objects.get()
+        self.assertEqual(reconciliation.status, TierReconciliation.DONE)
+        self.assertEqual(reconciliation.images_done, 3)
+        self.assertEqual(reconciliation.images_total, 3)
+        self.assertFalse(Thumbnail.objects.filter(thumbnail_height=self.th200).exists())
+        self.assertEqual(Thumbnail.objects.filter(thumbnail_height=self.th400, status=Thumbnail.READY).count(), 3)
 
-        self.assertFalse(os.path.isdir(settings.MEDIA_ROOT / "testuser/testimage/200"))
-        self.assertTrue(os.path.isdir(settings.MEDIA_ROOT / "testuser/testimage/400"))
-        self.assertTrue(os.path.isfile(settings.MEDIA_ROOT / "testuser/testimage/400/TestImage.jpg"))
+    def test_reconciliation_resumes_after_last_image(self):
+        self.iapiu.tier = self.tier2
+        self.iapiu.save()
+        first_image = Image.objects.get(name="testimage1")
+        TierReconciliation.objects.update(last_image_id=first_image.pk, images_done=1)  # as if the job stopped after the first chunk
+        run_pending_jobs()
+
+        self.assertEqual(TierReconciliation.objects.get().images_done, 3)
+        self.assertTrue(first_image.thumbnails.filter(thumbnail_height=self.th200).exists())
+        self.assertTrue(Thumbnail.objects.filter(image__name="testimage2", thumbnail_height=self.th400).exists())
+
+    @override_settings(RECONCILIATION_CHUNK_SIZE=1, JOB_LOCK_TIMEOUT=60)
+    def test_reconciliation_keeps_job_locked(self):
+        self.iapiu.tier = self.tier2
+        self.iapiu.save()
+        Job.objects.exclude(kind=Job.RECONCILE_TIER).delete()
+        job = claim_jobs(1)[0]
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(seconds=120))  # as if the earlier chunks took long
+        reconcile_tier(job)
+
+        self.assertNotIn(job, claim_jobs(10))
+
+    def test_saving_without_tier_change_does_nothing(self):
+        self.iapiu.save()
+
+        self.assertFalse(TierReconciliation.objects.exists())
+        self.assertFalse(Job.objects.filter(status=Job.QUEUED).exists())
 
 
 class ImageAPITestCase(TestCase):
@@ -62,15 +178,1409 @@ class ImageAPITestCase(TestCase):
         image = Image(name="testimage", user=iapiu)
         image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
         image.save()
+        run_pending_jobs()
 
     def tearDown(self):
-        shutil.rmtree(settings.MEDIA_ROOT / "testuser")
+        remove_blob_files()
 
     def test_post(self):
         image_file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
         self.client.post('/images/', {"name": "testimage2", "file": image_file})
 
-        self.assertTrue(os.path.isdir(settings.MEDIA_ROOT / "testuser/testimage2/original"))
-        self.assertTrue(os.path.isfile(settings.MEDIA_ROOT / "testuser/testimage2/original/TestImage.png"))
-        self.assertTrue(os.path.isdir(settings.MEDIA_ROOT / "testuser/testimage/200"))
-        self.assertTrue(os.path.isfile(settings.MEDIA_ROOT / "testuser/testimage/200/TestImage.jpg"))
+        image = Image.objects.get(name="testimage2")
+        self.assertTrue(os.path.isfile(image.file.path))
+        self.assertTrue(os.path.isfile(Thumbnail.objects.get(image__name="testimage").file.path))
+
+    def test_post_moves_spooled_upload(self):
+        buffer = BytesIO()
+        PILImage.new("RGB", (300, 300), "blue").save(buffer, format="PNG")
+        image_file = SimpleUploadedFile(name='Blue.png', content=buffer.getvalue(), content_type='image/png')
+
+        with mock.patch("django.core.files.storage.file_move_safe", wraps=file_move_safe) as move:
+            response = self.client.post('/images/', {"name": "blueimage", "file": image_file})
+
+        self.assertEqual(response.status_code, 201)
+        move.assert_called_once()
+        self.assertTrue(move.call_args.args[0].startswith(str(settings.UPLOAD_TEMP_DIR)))
+
+    def test_post_rejects_other_formats_by_header(self):
+        image_file = SimpleUploadedFile(name='TestImage.png', content=b"GIF89a" + bytes(100), content_type='image/png')
+        response = self.client.post('/images/', {"name": "testimage2", "file": image_file})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Image.objects.filter(name="testimage2").exists())
+
+    def test_thumbnail_rendered_in_background(self):
+        image_file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        self.client.post('/images/', {"name": "testimage2", "file": image_file})
+
+        thumbnail = Thumbnail.objects.get(image__name="testimage2")
+        self.assertEqual(thumbnail.status, Thumbnail.PENDING)
+        response = self.client.get('/images/testimage2/thumbnail/200/')
+        self.assertEqual(response.status_code, 202)
+        self.assertIn("Retry-After", response)
+
+        run_pending_jobs()
+
+        thumbnail.refresh_from_db()
+        self.assertEqual(thumbnail.status, Thumbnail.READY)
+        response = self.client.get('/images/testimage2/thumbnail/200/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], thumbnail.file.url)
+
+
+class ImageListQueriesTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        th200 = ThumbnailHeight.objects.create(height=200)
+        th400 = ThumbnailHeight.objects.create(height=400)
+        tier = Tier.objects.create(name="testtier", can_get_original=True, can_get_temporary=True)
+        tier.thumbnail_heights.add(th200, th400)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        self.iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+
+    def tearDown(self):
+        remove_blob_files()
+
+    def create_images(self, count):
+        for i in range(Image.objects.count(), Image.objects.count() + count):
+            image = Image(name=f"testimage{i}", user=self.iapiu)
+            image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+            image.save()
+            TemporaryLink.objects.create(image=image, duration=timedelta(seconds=3000))
+
+    def test_list_query_count_is_constant(self):
+        self.create_images(1)
+        with self.assertNumQueries(5):
+            response = self.client.get('/images/')
+        self.assertEqual(len(response.data["results"]), 1)
+
+        self.create_images(9)
+        with self.assertNumQueries(3):  # the capabilities are cached by the first request
+            response = self.client.get('/images/')
+        self.assertEqual(len(response.data["results"]), 10)
+        self.assertEqual(len(response.data["results"][0]["thumbnails"]), 2)
+        self.assertEqual(len(response.data["results"][0]["temporary_links"]), 1)
+        self.assertNotEqual(response.data["results"][0]["url"], "")
+
+    def test_list_is_paginated_by_cursor(self):
+        self.create_images(3)
+
+        response = self.client.get('/images/', {"page_size": 2})
+        self.assertEqual([image["name"] for image in response.data["results"]], ["testimage0", "testimage1"])
+
+        response = self.client.get(response.data["next"])
+        self.assertEqual([image["name"] for image in response.data["results"]], ["testimage2"])
+        self.assertIsNone(response.data["next"])
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_export_streams_ndjson(self):
+        self.create_images(3)
+
+        response = self.client.get('/images/export/')
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual([row["name"] for row in rows], ["testimage0", "testimage1", "testimage2"])
+        self.assertEqual(len(rows[0]["thumbnails"]), 2)
+
+
+class TemporaryLinkExpiryTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        tier = Tier.objects.create(name="testtier", can_get_original=True, can_get_temporary=True)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+        self.image = Image(name="testimage", user=iapiu)
+        self.image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        self.image.save()
+        self.active_link = TemporaryLink.objects.create(image=self.image, duration=timedelta(seconds=3000))
+        self.expired_link = TemporaryLink.objects.create(image=self.image, duration=timedelta(seconds=300))
+        TemporaryLink.objects.filter(pk=self.expired_link.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def tearDown(self):
+        remove_blob_files()
+
+    def test_expires_at_set_on_create(self):
+        self.assertEqual(self.active_link.expires_at, self.active_link.datetime_created + timedelta(seconds=3000))
+
+    def test_expired_links_hidden(self):
+        response = self.client.get('/temporary_links/')
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertEqual(self.client.get(f'/temporary_links/{self.expired_link.slug}/').status_code, 404)
+        self.assertEqual(self.client.get(f'/temporary_links/{self.active_link.slug}/').status_code, 200)
+        self.assertEqual(len(self.client.get('/images/').data["results"][0]["temporary_links"]), 1)
+
+    def test_purge_deletes_only_expired_links(self):
+        for _ in range(3):
+            link = TemporaryLink.objects.create(image=self.image, duration=timedelta(seconds=300))
+            TemporaryLink.objects.filter(pk=link.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        call_command("purge_expired_links", "--batch-size", "2", stdout=StringIO())
+
+        self.assertEqual(list(TemporaryLink.objects.all()), [self.active_link])
+
+    def test_backfill(self):
+        TemporaryLink.objects.filter(pk=self.active_link.pk).update(expires_at=None)
+
+        call_command("purge_expired_links", "--backfill", stdout=StringIO())
+
+        self.active_link.refresh_from_db()
+        self.assertEqual(self.active_link.expires_at, self.active_link.datetime_created + timedelta(seconds=3000))
+
+
+class SignedLinkTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        tier = Tier.objects.create(name="testtier", can_get_original=True, can_get_temporary=True)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+        self.image = Image(name="testimage", user=iapiu)
+        self.image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        self.image.save()
+        self.link = TemporaryLink.objects.create(image=self.image, duration=timedelta(seconds=3000))
+
+    def tearDown(self):
+        remove_blob_files()
+
+    def test_signed_link_served_without_queries(self):
+        signed_url = self.client.get('/temporary_links/').data["results"][0]["signed_url"]
+
+        with self.assertNumQueries(0):
+            response = APIClient().get(signed_url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], self.image.file.url)
+        self.assertEqual(response["Content-Type"], "image/png")
+
+    def test_tampered_and_expired_links_rejected(self):
+        token = sign_link(self.image.file.name, None, self.link.expires_at, self.link.slug)
+        self.assertEqual(self.client.get(f'/signed/{token}x').status_code, 404)
+
+        expired_token = sign_link(self.image.file.name, None, timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.client.get(f'/signed/{expired_token}').status_code, 404)
+
+    @override_settings(SIGNED_LINK_CHECK_REVOCATION=1)
+    def test_revoked_link_rejected(self):
+        token = sign_link(self.image.file.name, None, self.link.expires_at, self.link.slug)
+        self.assertEqual(self.client.get(f'/signed/{token}').status_code, 200)
+
+        self.link.delete()
+
+        self.assertEqual(self.client.get(f'/signed/{token}').status_code, 404)
+
+    @override_settings(SIGNED_LINK_BACKEND="nginx", SIGNED_LINK_SECRET="secret")
+    def test_nginx_secure_link(self):
+        url = signed_link_url("testuser/testimage/original/TestImage.png", None, self.link.expires_at)
+
+        expires = int(self.link.expires_at.timestamp())
+        digest = hashlib.md5(f"{expires}/secure/testuser/testimage/original/TestImage.png secret".encode()).digest()
+        md5 = base64.urlsafe_b64encode(digest).decode().rstrip("=")
+        self.assertEqual(url, f"/secure/testuser/testimage/original/TestImage.png?md5={md5}&expires={expires}")
+
+
+@override_settings(THUMBNAIL_RENDERING="lazy")
+class LazyThumbnailTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        th200 = ThumbnailHeight.objects.create(height=200)
+        th400 = ThumbnailHeight.objects.create(height=400)
+        tier = Tier.objects.create(name="testtier")
+        tier.thumbnail_heights.add(th200, th400)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+        for name in ("testimage1", "testimage2"):
+            image = Image(name=name, user=iapiu)
+            image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+            image.save()
+
+    def tearDown(self):
+        remove_blob_files()
+        shutil.rmtree(settings.THUMBNAIL_LOCK_DIR, ignore_errors=True)
+
+    def test_thumbnails_not_rendered_on_upload(self):
+        self.assertFalse(Thumbnail.objects.exists())
+        self.assertFalse(Job.objects.exists())
+        thumbnails = self.client.get('/images/').data["results"][0]["thumbnails"]
+        version = Image.objects.get(name="testimage1").content_hash[:16]
+        self.assertEqual(thumbnails, [f"http://testserver/images/testimage1/thumbnail/200/?v={version}", f"http://testserver/images/testimage1/thumbnail/400/?v={version}"])
+
+    def test_rendered_on_first_request(self):
+        response = self.client.get('/images/testimage1/thumbnail/200/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Thumbnail-Cache"], "MISS")
+        self.assertTrue(os.path.isfile(Thumbnail.objects.get().file.path))
+
+        response = self.client.get('/images/testimage1/thumbnail/200/')
+        self.assertEqual(response["X-Thumbnail-Cache"], "HIT")
+        thumbnail = Thumbnail.objects.get()
+        self.assertEqual(thumbnail.status, Thumbnail.READY)
+        self.assertEqual(thumbnail.size, os.path.getsize(thumbnail.file.path))
+
+    def test_height_outside_tier(self):
+        ThumbnailHeight.objects.create(height=800)
+        self.assertEqual(self.client.get('/images/testimage1/thumbnail/800/').status_code, 404)
+        self.assertEqual(self.client.get('/images/testimage1/thumbnail/100/').status_code, 404)
+
+    def test_least_recently_used_evicted(self):
+        self.client.get('/images/testimage1/thumbnail/200/')
+        self.client.get('/images/testimage2/thumbnail/200/')
+        self.client.get('/images/testimage2/thumbnail/400/')
+        Thumbnail.objects.filter(image__name="testimage1").update(last_accessed=timezone.now() - timedelta(days=1))
+        evictions = metrics.thumbnail_cache_evictions.value
+
+        # the images share their original, so their 200 pixel thumbnails are one blob, freed with the second of them
+        with override_settings(THUMBNAIL_CACHE_MAX_BYTES=cache_size() - 1):
+            self.assertEqual(evict_cold_thumbnails(), 2)
+
+        self.assertEqual(list(Thumbnail.objects.values_list("image__name", "thumbnail_height__height")), [("testimage2", 400)])
+        self.assertEqual(metrics.thumbnail_cache_evictions.value, evictions + 2)
+
+    def test_shared_blob_counted_once(self):
+        self.client.get('/images/testimage1/thumbnail/200/')
+        self.client.get('/images/testimage2/thumbnail/200/')
+
+        self.assertEqual(Blob.objects.filter(thumbnails__isnull=False).distinct().count(), 1)
+        self.assertEqual(cache_size(), Thumbnail.objects.get(image__name="testimage1").size)
+
+    def test_background_renders_not_evicted(self):
+        self.client.get('/images/testimage1/thumbnail/200/')
+        self.client.get('/images/testimage2/thumbnail/200/')
+        # served without the cache, like the JPEGs rendered in the background, so never rendered again
+        Thumbnail.objects.filter(image__name="testimage1").update(last_accessed=None)
+        size = cache_size()
+        self.assertEqual(size, Thumbnail.objects.get(image__name="testimage2").size)
+
+        with override_settings(THUMBNAIL_CACHE_MAX_BYTES=size - 1):
+            self.assertEqual(evict_cold_thumbnails(), 1)
+
+        self.assertEqual(list(Thumbnail.objects.values_list("image__name", flat=True)), ["testimage1"])
+
+    def test_misses_measure_size_once_per_interval(self):
+        with override_settings(THUMBNAIL_CACHE_MAX_BYTES=10 ** 9), \
+                mock.patch("image_api.thumbnail_cache.cache_size", wraps=cache_size) as measure, \
+                mock.patch.dict("image_api.thumbnail_cache.size_estimate", {"size": 0, "measured_at": None}):
+            self.client.get('/images/testimage1/thumbnail/200/')
+            self.client.get('/images/testimage2/thumbnail/200/')
+            self.client.get('/images/testimage2/thumbnail/400/')
+            self.assertEqual(measure.call_count, 1)
+            self.assertEqual(estimated_cache_size(), cache_size())
+
+    def test_key_lock_excludes_other_threads(self):
+        acquired = threading.Event()
+
+        def lock_same_key():
+            with key_lock("1/200"):
+                acquired.set()
+
+        with key_lock("1/200"):
+            thread = threading.Thread(target=lock_same_key)
+            thread.start()
+            self.assertFalse(acquired.wait(0.2))
+        thread.join()
+        self.assertTrue(acquired.is_set())
+
+
+@override_settings(THUMBNAIL_HEIGHT_LADDER=[100, 200, 400, 800])
+class ArbitraryHeightTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        th200 = ThumbnailHeight.objects.create(height=200)
+        self.tier = Tier.objects.create(name="testtier", min_thumbnail_height=50, max_thumbnail_height=500)
+        self.tier.thumbnail_heights.add(th200)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        self.iapiu = ImageAPIUser.objects.create(auth_user=user, tier=self.tier)
+        self.image = Image(name="testimage", user=self.iapiu)
+        self.image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        self.image.save()
+        run_pending_jobs()
+
+    def tearDown(self):
+        remove_blob_files()
+        shutil.rmtree(settings.THUMBNAIL_LOCK_DIR, ignore_errors=True)
+
+    def test_height_snapped_to_ladder(self):
+        response = self.client.get('/images/testimage/thumbnail/350/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Thumbnail-Height"], "400")
+
+        response = self.client.get('/images/testimage/thumbnail/301/')
+        self.assertEqual(response["X-Thumbnail-Cache"], "HIT")
+        self.assertEqual(PILImage.open(self.image.thumbnails.get(thumbnail_height__height=400).file).size[1], 400)
+
+    def test_renditions_kept_when_image_saved(self):
+        self.client.get('/images/testimage/thumbnail/350/')
+        self.image.save()
+
+        self.assertEqual(sorted(self.image.thumbnails.values_list("thumbnail_height__height", flat=True)), [200, 400])
+        self.assertEqual(self.client.get('/images/testimage/thumbnail/350/')["X-Thumbnail-Cache"], "HIT")
+
+    def test_rendered_from_bigger_rendition(self):
+        self.client.get('/images/testimage/thumbnail/350/')
+        rendition = self.image.thumbnails.get(thumbnail_height__height=200)  # the closest bigger one, not the 400px one
+
+        with mock.patch("image_api.thumbnail_cache.render_thumbnails", wraps=render_thumbnails) as render, \
+                mock.patch("image_api.thumbnail_cache.open_original", wraps=open_original) as source:
+            response = self.client.get('/images/testimage/thumbnail/60/')
+
+        self.assertEqual(response["X-Thumbnail-Height"], "100")
+        render.assert_called_once()
+        self.assertEqual(render.call_args.args[1], [100])
+        source.assert_called_once_with(rendition.file.name)
+
+    def test_not_rendered_from_other_quality(self):
+        thumbnail_height = ThumbnailHeight.objects.create(height=100)
+
+        with mock.patch("image_api.thumbnail_cache.open_original", wraps=open_original) as source:
+            thumbnail, hit = get_or_render_thumbnail(self.image, thumbnail_height, Thumbnail.JPEG, settings.THUMBNAIL_QUALITY - 30)
+
+        self.assertFalse(hit)
+        source.assert_called_once_with(self.image.file.name)  # the 200px rendition is of another quality
+        self.assertEqual(thumbnail.blob.quality, settings.THUMBNAIL_QUALITY - 30)
+
+    def test_height_outside_range(self):
+        self.assertEqual(self.client.get('/images/testimage/thumbnail/600/').status_code, 404)
+        self.assertEqual(self.client.get('/images/testimage/thumbnail/20/').status_code, 404)
+
+    def test_tier_change_keeps_renditions_in_range(self):
+        self.client.get('/images/testimage/thumbnail/350/')
+        self.client.get('/images/testimage/thumbnail/150/')
+        tier = Tier.objects.create(name="testtier2", min_thumbnail_height=300, max_thumbnail_height=400)
+        self.iapiu.tier = tier
+        self.iapiu.save()
+        run_pending_jobs()
+
+        self.assertEqual(list(self.image.thumbnails.values_list("thumbnail_height__height", flat=True)), [400])
+
+
+class ThumbnailFormatTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier", thumbnail_formats="avif webp jpeg", thumbnail_quality=70)
+        tier.thumbnail_heights.add(th200)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+        image = Image(name="testimage", user=iapiu)
+        buffer = BytesIO()
+        PILImage.new("RGBA", (600, 400), (255, 0, 0, 128)).save(buffer, format="PNG")
+        image.file = SimpleUploadedFile(name='TestImage.png', content=buffer.getvalue(), content_type='image/png')
+        image.save()
+        run_pending_jobs()
+
+    def tearDown(self):
+        remove_blob_files()
+        shutil.rmtree(settings.THUMBNAIL_LOCK_DIR, ignore_errors=True)
+
+    def test_jpeg_without_accept(self):
+        response = self.client.get('/images/testimage/thumbnail/200/', HTTP_ACCEPT="*/*")
+
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertIn("Accept", response["Vary"])
+        self.assertFalse(Thumbnail.objects.exclude(format=Thumbnail.JPEG).exists())
+
+    def test_webp_rendered_on_first_request(self):
+        response = self.client.get('/images/testimage/thumbnail/200/', HTTP_ACCEPT="image/webp,image/*;q=0.8")
+
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertEqual(response["X-Thumbnail-Cache"], "MISS")
+        thumbnail = Thumbnail.objects.get(format=Thumbnail.WEBP)
+        self.assertEqual(response["X-Accel-Redirect"], thumbnail.file.url)
+        thumbnail_pil = PILImage.open(thumbnail.file.path)
+        self.assertEqual(thumbnail_pil.format, "WEBP")
+        self.assertEqual(thumbnail_pil.mode, "RGBA")  # transparency isn't thrown away
+
+    @skipUnless(features.check("avif"), "Pillow was built without AVIF support")
+    def test_avif_preferred(self):
+        response = self.client.get('/images/testimage/thumbnail/200/', HTTP_ACCEPT="image/avif,image/webp,*/*")
+
+        self.assertEqual(response["Content-Type"], "image/avif")
+
+    def test_rejected_format_skipped(self):
+        response = self.client.get('/images/testimage/thumbnail/200/', HTTP_ACCEPT="image/avif;q=0, image/webp")
+
+        self.assertEqual(response["Content-Type"], "image/webp")
+
+    def test_deleting_one_format_keeps_the_other(self):
+        self.client.get('/images/testimage/thumbnail/200/', HTTP_ACCEPT="image/webp")
+        webp_thumbnail = Thumbnail.objects.get(format=Thumbnail.WEBP)
+        webp_thumbnail.delete()
+        with override_settings(BLOB_GC_GRACE=0):
+            call_command("collect_blobs", stdout=StringIO())
+
+        self.assertTrue(os.path.isfile(Thumbnail.objects.get(format=Thumbnail.JPEG).file.path))
+        self.assertFalse(os.path.isfile(webp_thumbnail.file.path))
+
+
+class HTTPCachingTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier", can_get_original=True, can_get_temporary=True, cache_max_age=600)
+        tier.thumbnail_heights.add(th200)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+        self.image = Image(name="testimage", user=iapiu)
+        self.image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        self.image.save()
+        run_pending_jobs()
+
+    def tearDown(self):
+        remove_blob_files()
+
+    def test_hashes_stored_on_write(self):
+        thumbnail = Thumbnail.objects.get()
+        with open(self.image.file.path, "rb") as image_file, open(thumbnail.file.path, "rb") as thumbnail_file:
+            self.assertEqual(self.image.content_hash, hashlib.sha256(image_file.read()).hexdigest())
+            self.assertEqual(thumbnail.content_hash, hashlib.sha256(thumbnail_file.read()).hexdigest())
+        self.assertIsNotNone(thumbnail.datetime_rendered)
+
+    def test_thumbnail_not_modified(self):
+        response = self.client.get('/images/testimage/thumbnail/200/')
+        self.assertEqual(response["ETag"], f'"{Thumbnail.objects.get().content_hash}"')
+        self.assertIn("max-age=600", response["Cache-Control"])
+        self.assertIn("private", response["Cache-Control"])
+
+        response = self.client.get('/images/testimage/thumbnail/200/', HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn("X-Accel-Redirect", response)
+        self.assertIn("ETag", response)
+
+    def test_original_not_modified_since(self):
+        response = self.client.get('/images/testimage/')
+        self.assertEqual(response["Content-Type"], "image/png")
+
+        response = self.client.get('/images/testimage/', HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_versioned_urls_immutable(self):
+        url = self.client.get('/images/').data["results"][0]["url"]
+        self.assertTrue(url.endswith(f"?v={self.image.content_hash[:16]}"))
+
+        self.assertIn("immutable", self.client.get(url)["Cache-Control"])
+        self.assertIn("immutable", self.client.get(f"/images/testimage/thumbnail/200/?v={self.image.content_hash[:16]}")["Cache-Control"])
+        self.assertNotIn("immutable", self.client.get("/images/testimage/?v=outdated")["Cache-Control"])
+
+    def test_temporary_link_bounded_by_expiry(self):
+        link = TemporaryLink.objects.create(image=self.image, duration=timedelta(seconds=300))
+
+        response = self.client.get(f'/temporary_links/{link.slug}/')
+        max_age = int(response["Cache-Control"].split("max-age=")[1].split(",")[0])
+        self.assertLessEqual(max_age, 300)
+        self.assertLessEqual(int(response["X-Accel-Expires"]), max_age)
+
+
+class BlobTestCase(TestCase):
+    def setUp(self):
+        th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier")
+        tier.thumbnail_heights.add(th200)
+        self.images = []
+        for username in ("testuser1", "testuser2"):
+            user = User.objects.create(username=username, password="testuserpw")
+            iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+            image = Image(name=f"image of {username}", user=iapiu)
+            image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+            image.save()
+            self.images.append(image)
+
+    def tearDown(self):
+        remove_blob_files()
+
+    def test_identical_uploads_stored_and_rendered_once(self):
+        with mock.patch("image_api.jobs.render_thumbnails", wraps=render_thumbnails) as render:
+            run_pending_jobs(batch_size=1)  # jobs of one batch render in parallel, so they can't reuse each other's renditions
+
+        render.assert_called_once()
+        self.assertEqual(self.images[0].blob, self.images[1].blob)
+        self.assertEqual(Blob.objects.count(), 2)  # the original and its rendition
+        self.assertEqual(len(set(Thumbnail.objects.values_list("blob", flat=True))), 1)
+
+    @override_settings(BLOB_GC_GRACE=0)
+    def test_blobs_collected_once_unreferenced(self):
+        run_pending_jobs()
+        paths = [blob.file.path for blob in Blob.objects.all()]
+
+        self.images[0].delete()
+        call_command("collect_blobs", stdout=StringIO())
+        self.assertEqual(Blob.objects.count(), 2)
+        self.assertTrue(all(os.path.isfile(path) for path in paths))
+
+        self.images[1].delete()
+        call_command("collect_blobs", stdout=StringIO())
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(any(os.path.isfile(path) for path in paths))
+
+    @override_settings(BLOB_GC_GRACE=0)
+    def test_batch_referenced_at_commit_retried(self):
+        run_pending_jobs()
+        paths = [blob.file.path for blob in Blob.objects.all()]
+        Image.objects.all().delete()
+        delete = QuerySet.delete
+
+        def referenced_at_commit(queryset):
+            queryset_delete.side_effect = delete  # a row started using the blob, the next batch doesn't select it
+            raise IntegrityError("insert or update on table violates foreign key constraint")
+
+        with mock.patch.object(QuerySet, "delete", autospec=True, side_effect=referenced_at_commit) as queryset_delete:
+            call_command("collect_blobs", stdout=StringIO())
+
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(any(os.path.isfile(path) for path in paths))
+
+    def test_recently_used_blobs_kept(self):
+        run_pending_jobs()
+        path = self.images[0].file.path
+        Image.objects.all().delete()
+
+        call_command("collect_blobs", stdout=StringIO())
+
+        self.assertEqual(Blob.objects.count(), 2)
+        self.assertTrue(os.path.isfile(path))
+
+
+class UploadSessionTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier")
+        tier.thumbnail_heights.add(th200)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        ImageAPIUser.objects.create(auth_user=user, tier=tier)
+        self.content = open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read()
+        self.url = self.client.post('/uploads/', {"name": "testimage", "filename": "TestImage.png"}).data["url"]
+        self.part_path = UploadSession.objects.get().part_path
+
+    def tearDown(self):
+        UploadSession.objects.all().delete()
+        remove_blob_files()
+
+    def put_chunk(self, start, end, total="*"):
+        return self.client.put(self.url, data=self.content[start:end + 1], content_type="application/octet-stream", HTTP_CONTENT_RANGE=f"bytes {start}-{end}/{total}")
+
+    def test_upload_in_chunks(self):
+        half = len(self.content) // 2
+        response = self.put_chunk(0, half - 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["received"], half)
+        self.assertEqual(response["Range"], f"bytes=0-{half - 1}")
+
+        response = self.put_chunk(half, len(self.content) - 1, len(self.content))
+        self.assertEqual(response.status_code, 201)
+        image = Image.objects.get(name="testimage")
+        self.assertEqual(image.content_hash, hashlib.sha256(self.content).hexdigest())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(self.part_path))
+
+    def test_retried_chunk_not_appended_twice(self):
+        self.put_chunk(0, 99)
+        response = self.put_chunk(50, 149)
+
+        self.assertEqual(response.data["received"], 150)
+        self.put_chunk(150, len(self.content) - 1, len(self.content))
+        with Image.objects.get(name="testimage").file.open("rb") as image_file:
+            self.assertEqual(image_file.read(), self.content)
+
+    def test_gap_rejected(self):
+        self.put_chunk(0, 99)
+        response = self.put_chunk(200, 299)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response["Range"], "bytes=0-99")
+        self.assertEqual(self.client.get(self.url).data["received"], 100)
+
+    def test_other_formats_rejected_when_complete(self):
+        self.content = b"GIF89a" + bytes(100)
+        response = self.put_chunk(0, len(self.content) - 1, len(self.content))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Image.objects.exists())
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_progress_saved_while_locked(self):
+        def assert_locked(session, *args, **kwargs):
+            with open(self.part_path, "rb") as part:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return save(session, *args, **kwargs)
+
+        save = UploadSession.save
+        with mock.patch.object(UploadSession, "save", autospec=True, side_effect=assert_locked) as locked_save:
+            self.assertEqual(self.put_chunk(0, 99).status_code, 200)
+        locked_save.assert_called()
+
+    def test_completed_upload_not_completed_again(self):
+        stale_session = UploadSession.objects.get()
+        self.assertEqual(self.put_chunk(0, len(self.content) - 1, len(self.content)).status_code, 201)
+
+        # a request that looked the session up before the first one completed it, and got the lock afterwards
+        with mock.patch("image_api.views.UploadSessionViewSet.get_object", return_value=stale_session):
+            response = self.put_chunk(0, len(self.content) - 1, len(self.content))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Image.objects.count(), 1)
+        self.assertFalse(os.path.exists(self.part_path))
+
+    @override_settings(UPLOAD_SESSION_MAX_SIZE=100)
+    def test_size_over_limit_rejected(self):
+        response = self.client.post('/uploads/', {"name": "otherimage", "filename": "TestImage.png", "size": 101})
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.data["code"], "upload_too_large")
+
+        self.assertEqual(self.put_chunk(0, 99).status_code, 200)
+        response = self.put_chunk(100, 199)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.data["max_size"], 100)
+        self.assertEqual(self.put_chunk(100, 100, len(self.content)).status_code, 413)
+        self.assertEqual(self.client.get(self.url).data["received"], 100)
+        self.assertEqual(os.path.getsize(self.part_path), 100)
+
+    @override_settings(MAX_IMAGE_PIXELS=10000)
+    def test_pixel_limit_checked_before_upload_completes(self):
+        self.assertEqual(self.put_chunk(0, 9).status_code, 200)  # not the whole header yet
+        response = self.put_chunk(10, 1023)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.data["code"], "image_too_large")
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(self.part_path))
+
+
+def png_header(width, height):
+    """A PNG that only declares its size, it can't be decoded"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", b"") + chunk(b"IEND", b"")
+
+
+class ImageLimitsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.tier = Tier.objects.create(name="testtier", max_dimension=800)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        ImageAPIUser.objects.create(auth_user=user, tier=self.tier)
+
+    def tearDown(self):
+        remove_blob_files()
+
+    def post(self, content):
+        image_file = SimpleUploadedFile(name='TestImage.png', content=content, content_type='image/png')
+        return self.client.post('/images/', {"name": "testimage", "file": image_file})
+
+    def test_over_tier_dimension(self):
+        response = self.post(open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read())
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.data["code"], "image_too_large")
+        self.assertEqual((response.data["width"], response.data["height"], response.data["max_dimension"]), (1000, 1000, 800))
+        self.assertFalse(Image.objects.exists())
+
+    def test_decompression_bomb_rejected_from_header(self):
+        self.tier.max_dimension = None
+        self.tier.save()
+
+        with mock.patch("PIL.ImageFile.ImageFile.load") as load:
+            response = self.post(png_header(30000, 30000))
+
+        self.assertEqual(response.status_code, 413)
+        load.assert_not_called()
+
+    def test_unreadable_header(self):
+        response = self.post(b"\x89PNG\r\n\x1a\n" + bytes(100))
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.data["code"], "unreadable_image")
+
+    @override_settings(MAX_IMAGE_PIXELS=10000)
+    def test_worker_refuses_images_over_the_global_limit(self):
+        with self.assertRaises(PILImage.DecompressionBombError):
+            render_thumbnails(settings.BASE_DIR / "image_api/test_files/TestImage.png", [50])
+
+
+class CrashConsistencyTestCase(TestCase):
+    def setUp(self):
+        th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier")
+        tier.thumbnail_heights.add(th200)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+        self.image = Image(name="testimage", user=iapiu)
+        self.image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        self.image.save()
+        run_pending_jobs()
+
+    def tearDown(self):
+        remove_blob_files()
+        remove_paths(["blobs/ff"])
+
+    def reconcile_media(self, *args):
+        output = StringIO()
+        call_command("reconcile_media", *args, processes=0, min_age=60, stdout=output)
+        return output.getvalue()
+
+    def test_files_written_atomically(self):
+        with mock.patch("os.fsync", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                default_storage.save("blobs/ff/ff/interrupted.jpg", ContentFile(b"thumbnail"))
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT / "blobs/ff/ff"), [])  # neither the file nor its temporary file
+
+        name = default_storage.save("blobs/ff/ff/written.jpg", ContentFile(b"thumbnail"))
+        self.assertNotEqual(default_storage.save("blobs/ff/ff/written.jpg", ContentFile(b"other")), name)
+        self.assertEqual(len(os.listdir(settings.MEDIA_ROOT / "blobs/ff/ff")), 2)
+        with default_storage.open(name) as file:
+            self.assertEqual(file.read(), b"thumbnail")
+
+    def test_thumbnails_unique(self):
+        thumbnail = Thumbnail.objects.get()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Thumbnail.objects.create(image=self.image, thumbnail_height=thumbnail.thumbnail_height, format=thumbnail.format)
+
+    def test_legacy_files_removed_on_commit(self):
+        Image.objects.filter(pk=self.image.pk).update(blob=None)
+        with self.captureOnCommitCallbacks() as callbacks:
+            Image.objects.get(pk=self.image.pk).delete()
+        self.assertEqual(len(callbacks), 1)
+
+    def test_drift_reported_and_repaired(self):
+        os.makedirs(settings.MEDIA_ROOT / "blobs/ff/ff", exist_ok=True)
+        for name, age in (("old.png", 3600), ("new.png", 0)):
+            with open(settings.MEDIA_ROOT / "blobs/ff/ff" / name, "wb") as file:
+                file.write(b"orphan")
+            os.utime(settings.MEDIA_ROOT / "blobs/ff/ff" / name, (time.time() - age, time.time() - age))
+        rendition_path = Thumbnail.objects.get().file.path
+        os.remove(rendition_path)
+
+        output = self.reconcile_media()
+        self.assertIn("Orphaned file blobs/ff/ff/old.png", output)
+        self.assertNotIn("new.png", output)
+        self.assertIn("Missing rendition", output)
+        self.assertTrue(os.path.isfile(settings.MEDIA_ROOT / "blobs/ff/ff/old.png"))
+
+        self.reconcile_media("--fix")
+        self.assertFalse(os.path.exists(settings.MEDIA_ROOT / "blobs/ff/ff/old.png"))
+        self.assertTrue(os.path.isfile(settings.MEDIA_ROOT / "blobs/ff/ff/new.png"))
+        self.assertEqual(Thumbnail.objects.get().status, Thumbnail.PENDING)
+        run_pending_jobs()
+        self.assertTrue(os.path.isfile(Thumbnail.objects.get().file.path))
+        self.assertNotIn("Missing", self.reconcile_media())
+
+
+class ImportImagesTestCase(TestCase):
+    def setUp(self):
+        th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier")
+        tier.thumbnail_heights.add(th200)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.image_api_user = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+
+        self.directory = settings.MEDIA_ROOT / ".import-test"
+        os.makedirs(self.directory / "album", exist_ok=True)
+        shutil.copy(settings.BASE_DIR / "image_api/test_files/TestImage.png", self.directory / "first.png")
+        shutil.copy(settings.BASE_DIR / "image_api/test_files/TestImage.png", self.directory / "album/second.v2.PNG")
+        with open(self.directory / "broken.jpg", "wb") as file:
+            file.write(b"not an image")
+        self.checkpoint = str(self.directory / "checkpoint.json")
+
+    def tearDown(self):
+        remove_blob_files()
+        shutil.rmtree(self.directory)
+
+    def import_images(self, source, **options):
+        call_command("import_images", str(source), user="testuser", processes=0, checkpoint=self.checkpoint, stdout=StringIO(), stderr=StringIO(), **options)
+
+    def test_directory_imported(self):
+        with mock.patch("image_api.jobs.render_thumbnails", wraps=render_thumbnails) as render:
+            self.import_images(self.directory, batch_size=2)
+
+        self.assertEqual(sorted(Image.objects.values_list("name", flat=True)), ["first", "second_v2"])
+        self.assertEqual(Blob.objects.count(), 2)  # both files have the same content, they share the original and its rendition
+        render.assert_called_once()
+        self.assertEqual(Thumbnail.objects.filter(status=Thumbnail.READY).count(), 2)
+        for image in Image.objects.all():
+            self.assertTrue(os.path.isfile(image.file.path))
+            self.assertEqual(PILImage.open(image.thumbnails.get().file.path).size[1], 200)
+        self.assertFalse(Job.objects.exists())
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertFalse(os.listdir(settings.UPLOAD_TEMP_DIR))
+
+    def test_manifest_and_existing_names(self):
+        with open(self.directory / "manifest.csv", "w") as file:
+            file.write("first.png,existing\nalbum/second.v2.PNG,named\n")
+        self.import_images(self.directory / "manifest.csv")
+        self.import_images(self.directory / "manifest.csv")
+
+        self.assertEqual(sorted(Image.objects.values_list("name", flat=True)), ["existing", "named"])
+
+    def test_resumed_from_checkpoint(self):
+        with open(self.checkpoint, "w") as file:
+            json.dump({"source": str(self.directory), "user": "testuser", "done": 2, "imported": 1, "skipped": 0, "failed": 1}, file)
+
+        self.import_images(self.directory)
+
+        # the files of a directory come before its subdirectories, broken.jpg and first.png were done
+        self.assertEqual(list(Image.objects.values_list("name", flat=True)), ["second_v2"])
+
+
+class MediaLayoutTestCase(TestCase):
+    def setUp(self):
+        self.th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier")
+        tier.thumbnail_heights.add(self.th200)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+        self.image = Image(name="testimage", user=self.iapiu)
+        self.image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        self.image.save()
+        run_pending_jobs()
+        self.checkpoint = str(settings.MEDIA_ROOT / ".migrate_media_layout-test.json")
+
+    def tearDown(self):
+        remove_blob_files()
+        remove_paths(["testuser/legacy"])
+
+    def migrate_media_layout(self):
+        call_command("migrate_media_layout", processes=0, batch_size=1, checkpoint=self.checkpoint, stdout=StringIO(), stderr=StringIO())
+
+    @override_settings(BLOB_SHARD_DEPTH=1)
+    def test_blobs_moved_to_new_depth(self):
+        old_names = list(Blob.objects.order_by("pk").values_list("file", flat=True))
+        self.migrate_media_layout()
+
+        for blob in Blob.objects.all():
+            self.assertEqual(blob.file.name.count("/"), 2)
+            self.assertTrue(os.path.isfile(blob.file.path))
+        self.assertEqual(Image.objects.get().file.name, Image.objects.get().blob.file.name)
+        self.assertEqual(Thumbnail.objects.get().file.name, Thumbnail.objects.get().blob.file.name)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertFalse(os.path.exists(settings.MEDIA_ROOT / old_names[1]))
+        # signed links can still point to the old name of the original
+        self.assertTrue(os.path.isfile(settings.MEDIA_ROOT / old_names[0]))
+        self.assertEqual(run_pending_jobs(), 0)
+        Job.objects.update(available_at=timezone.now())
+        run_pending_jobs()
+        for name in old_names:
+            self.assertFalse(os.path.exists(settings.MEDIA_ROOT / name))
+
+    @override_settings(BLOB_SHARD_DEPTH=1)
+    def test_signed_links_outlive_move(self):
+        link = TemporaryLink.objects.create(image=self.image, duration=timedelta(seconds=300))
+        url = signed_link_url(self.image.file.name, None, link.expires_at, link.slug)
+        self.migrate_media_layout()
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(os.path.isfile(settings.MEDIA_ROOT / response["X-Accel-Redirect"][len(settings.MEDIA_URL):]))
+        out = StringIO()
+        call_command("reconcile_media", processes=0, min_age=0, stdout=out)
+        self.assertIn("Found 0 orphaned files", out.getvalue())
+        Job.objects.update(available_at=timezone.now())
+        run_pending_jobs()
+
+    def test_legacy_files_stored_as_blobs(self):
+        os.makedirs(settings.MEDIA_ROOT / "testuser/legacy/original", exist_ok=True)
+        os.makedirs(settings.MEDIA_ROOT / "testuser/legacy/200", exist_ok=True)
+        shutil.copy(self.image.file.path, settings.MEDIA_ROOT / "testuser/legacy/original/TestImage.png")
+        shutil.copy(Thumbnail.objects.get().file.path, settings.MEDIA_ROOT / "testuser/legacy/200/TestImage.jpg")
+        legacy = Image.objects.bulk_create([Image(name="legacy", user=self.iapiu, file="testuser/legacy/original/TestImage.png")])[0]
+        Thumbnail.objects.bulk_create([Thumbnail(image=legacy, thumbnail_height=self.th200, file="testuser/legacy/200/TestImage.jpg", status=Thumbnail.READY)])
+
+        self.migrate_media_layout()
+
+        legacy = Image.objects.get(name="legacy")
+        self.assertEqual(legacy.blob, self.image.blob)  # the same content is stored once
+        self.assertEqual(legacy.file.name, self.image.file.name)
+        thumbnail = legacy.thumbnails.get()
+        self.assertEqual(thumbnail.blob, Thumbnail.objects.get(image=self.image).blob)
+        self.assertEqual(thumbnail.content_hash, thumbnail.blob.sha256)
+        self.assertFalse(os.path.exists(settings.MEDIA_ROOT / "testuser/legacy/200"))
+        Job.objects.update(available_at=timezone.now())
+        run_pending_jobs()
+        self.assertFalse(os.path.exists(settings.MEDIA_ROOT / "testuser/legacy"))
+
+    def test_legacy_image_renditions_stored_as_files(self):
+        os.makedirs(settings.MEDIA_ROOT / "testuser/legacy/original", exist_ok=True)
+        shutil.copy(self.image.file.path, settings.MEDIA_ROOT / "testuser/legacy/original/TestImage.png")
+        legacy = Image.objects.bulk_create([Image(name="legacy", user=self.iapiu, file="testuser/legacy/original/TestImage.png")])[0]
+        Thumbnail.objects.bulk_create([Thumbnail(image=legacy, thumbnail_height=self.th200)])
+        Job.enqueue(Job.RENDER_THUMBNAILS, image=legacy.pk)
+        blobs = Blob.objects.count()
+
+        run_pending_jobs()
+        thumbnail, hit = get_or_render_thumbnail(legacy, ThumbnailHeight.objects.create(height=100))
+
+        self.assertEqual(Blob.objects.count(), blobs)
+        for thumbnail in legacy.thumbnails.all():
+            self.assertEqual((thumbnail.status, thumbnail.blob), (Thumbnail.READY, None))
+            self.assertTrue(thumbnail.file.name.startswith("testuser/legacy/"))
+            self.assertEqual(thumbnail.size, os.path.getsize(thumbnail.file.path))
+
+        self.migrate_media_layout()
+        self.assertFalse(legacy.thumbnails.filter(blob=None).exists())
+        Job.objects.update(available_at=timezone.now())  # the old name of the original, kept for signed links
+        run_pending_jobs()
+        shutil.rmtree(settings.THUMBNAIL_LOCK_DIR, ignore_errors=True)
+
+    @override_settings(BLOB_SHARD_DEPTH=1)
+    def test_resumed_from_checkpoint(self):
+        with open(self.checkpoint, "w") as file:
+            json.dump({"shard_depth": 1, "blobs": Blob.objects.order_by("pk").first().pk, "images": 0, "thumbnails": 0}, file)
+
+        self.migrate_media_layout()
+
+        original, rendition = Blob.objects.order_by("pk")
+        self.assertEqual(original.file.name.count("/"), 3)  # done before the interruption, so left alone
+        self.assertEqual(rendition.file.name.count("/"), 2)
+        self.assertTrue(os.path.isfile(rendition.file.path))
+
+
+@skipUnless(all(importlib.util.find_spec(module) for module in ("storages", "boto3", "moto")), "django-storages, boto3 and moto aren't installed")
+class ObjectStorageTestCase(TestCase):
+    def setUp(self):
+        from moto import mock_s3
+        s3_mock = mock_s3()
+        s3_mock.start()
+        self.addCleanup(s3_mock.stop)
+        object_storage = override_settings(
+            DEFAULT_FILE_STORAGE="image_api.object_storage.ObjectStorage", AWS_STORAGE_BUCKET_NAME="heximages-test",
+            AWS_S3_ENDPOINT_URL=None, S3_PUBLIC_ENDPOINT_URL=None, AWS_ACCESS_KEY_ID="test", AWS_SECRET_ACCESS_KEY="test",
+        )
+        object_storage.enable()
+        self.addCleanup(object_storage.disable)  # cleanups run after tearDown, which still deletes from the bucket
+        default_storage.bucket.create()
+
+        self.client = APIClient()
+        th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier")
+        tier.thumbnail_heights.add(th200)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+        self.image = Image(name="testimage", user=iapiu)
+        self.image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        self.image.save()
+        run_pending_jobs()
+
+    def tearDown(self):
+        remove_blob_files()
+
+    def stored_names(self):
+        return sorted(obj.key for obj in default_storage.bucket.objects.all())
+
+    def test_files_stored_in_bucket(self):
+        thumbnail = Thumbnail.objects.get()
+        self.assertEqual(thumbnail.status, Thumbnail.READY)  # rendered from the original in the bucket
+        self.assertEqual(self.stored_names(), sorted(Blob.objects.values_list("file", flat=True)))
+        self.assertFalse(os.path.exists(settings.MEDIA_ROOT / thumbnail.file.name))
+        with default_storage.open(thumbnail.file.name) as file:
+            self.assertEqual(PILImage.open(file).size[1], 200)
+
+    def test_redirected_to_presigned_url(self):
+        response = self.client.get('/images/testimage/')
+
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(f"/{self.image.file.name}?", response["Location"])
+        self.assertIn("X-Amz-Signature=", response["Location"])
+        self.assertIn("max-age=1800", response["Cache-Control"])  # half the lifetime of the URL
+        self.assertFalse(response.has_header("ETag"))
+        self.assertEqual(self.client.get('/images/testimage/thumbnail/200/').status_code, 302)
+
+    @override_settings(MEDIA_DELIVERY="nginx")
+    def test_fetched_by_nginx(self):
+        response = self.client.get('/images/testimage/')
+
+        self.assertTrue(response["X-Accel-Redirect"].startswith("/object_storage/https/"))
+        self.assertIn(f"/{self.image.file.name}?", response["X-Accel-Redirect"])
+        self.assertEqual(response["ETag"], f'"{self.image.content_hash}"')
+
+    @override_settings(BLOB_GC_GRACE=0)
+    def test_blobs_collected(self):
+        self.image.delete()
+        call_command("collect_blobs", stdout=StringIO())
+
+        self.assertEqual(self.stored_names(), [])
+
+    def test_file_commands_refused(self):
+        with self.assertRaises(CommandError):
+            call_command("reconcile_media", processes=0, stdout=StringIO())
+
+
+class CapabilityCacheTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.th200 = ThumbnailHeight.objects.create(height=200)
+        self.tier = Tier.objects.create(name="testtier")
+        self.tier.thumbnail_heights.add(self.th200)
+        self.user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=self.user)
+        self.iapiu = ImageAPIUser.objects.create(auth_user=self.user, tier=self.tier)
+
+    def tearDown(self):
+        user_tiers.clear()
+        tier_fields.clear()
+
+    def post_link(self):
+        return self.client.post('/temporary_links/', {"image": "", "duration_write": 600})
+
+    def test_cached_permission_check_makes_no_queries(self):
+        self.assertEqual(self.post_link().status_code, 403)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.post_link().status_code, 403)
+
+    def test_tier_changes_invalidate(self):
+        self.assertEqual(cached_capabilities(self.user.pk).thumbnail_heights, {200})
+
+        self.tier.can_get_temporary = True
+        self.tier.save()
+        self.tier.thumbnail_heights.add(ThumbnailHeight.objects.create(height=400))
+        self.th200.tier_set.remove(self.tier)
+
+        capabilities = cached_capabilities(self.user.pk)
+        self.assertTrue(capabilities.can_get_temporary)
+        self.assertEqual(capabilities.thumbnail_heights, {400})
+
+    def test_user_tier_change_invalidates(self):
+        cached_capabilities(self.user.pk)
+        tier = Tier.objects.create(name="testtier2", can_get_temporary=True)
+
+        self.iapiu.tier = tier
+        self.iapiu.save()
+
+        self.assertEqual(cached_capabilities(self.user.pk).tier_id, tier.pk)
+
+    @override_settings(CACHES={**settings.CACHES, "shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_shared_cache(self):
+        cached_capabilities(self.user.pk)
+        user_tiers.clear()  # as if the next request went to another process
+        tier_fields.clear()
+        with self.assertNumQueries(0):
+            cached_capabilities(self.user.pk)
+
+        self.tier.can_get_original = True
+        self.tier.save()
+        user_tiers.clear()
+        tier_fields.clear()
+
+        self.assertTrue(cached_capabilities(self.user.pk).can_get_original)
+
+
+class BatchTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        th200 = ThumbnailHeight.objects.create(height=200)
+        self.tier = Tier.objects.create(name="testtier", can_get_temporary=True)
+        self.tier.thumbnail_heights.add(th200)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=user)
+        iapiu = ImageAPIUser.objects.create(auth_user=user, tier=self.tier)
+        image = Image(name="testimage", user=iapiu)
+        image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        image.save()
+
+    def tearDown(self):
+        remove_blob_files()
+
+    def image_file(self, content=None):
+        content = content or open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read()
+        return SimpleUploadedFile(name='TestImage.png', content=content, content_type='image/png')
+
+    def test_image_batch(self):
+        response = self.client.post('/images/batch/', {
+            "file": [self.image_file(), self.image_file(), self.image_file(b"GIF89a" + bytes(100)), self.image_file()],
+            "name": ["first", "testimage", "gif", "second"],
+        })
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([result["status"] for result in response.data["results"]], [201, 400, 400, 201])
+        self.assertIn("name", response.data["results"][1]["errors"])
+        self.assertIn("file", response.data["results"][2]["errors"])
+        self.assertEqual(response.data["results"][3]["data"]["name"], "second")
+        self.assertEqual(Thumbnail.objects.filter(image__name__in=["first", "second"], status=Thumbnail.PENDING).count(), 2)
+
+        run_pending_jobs()
+        self.assertTrue(os.path.isfile(Thumbnail.objects.get(image__name="second").file.path))
+
+    def test_link_batch_queries_independent_of_size(self):
+        for name in ("first", "second", "third"):
+            image = Image(name=name, user=ImageAPIUser.objects.get())
+            image.file = self.image_file()
+            image.save()
+
+        self.client.get('/temporary_links/')  # caches the capabilities, so both batches find them there
+        query_counts = []
+        for names in (["testimage"], ["testimage", "first", "second", "third"]):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/temporary_links/batch/', [{"image": name, "duration": 600} for name in names], format="json")
+            self.assertEqual(response.status_code, 201)
+            query_counts.append(len(queries))
+
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(TemporaryLink.objects.active().count(), 5)
+
+    def test_link_batch_errors(self):
+        response = self.client.post('/temporary_links/batch/', [
+            {"image": "testimage", "duration": 600},
+            {"image": "missing", "duration": 600},
+            {"image": "testimage", "duration": 10},
+        ], format="json")
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([result["status"] for result in response.data["results"]], [201, 400, 400])
+        self.assertEqual(response.data["results"][0]["data"]["duration"], "600")
+        self.assertIn("image", response.data["results"][1]["errors"])
+        self.assertIn("duration", response.data["results"][2]["errors"])
+        self.assertEqual(TemporaryLink.objects.count(), 1)
+
+    def test_link_batch_needs_temporary_links(self):
+        self.tier.can_get_temporary = False
+        self.tier.save()
+
+        response = self.client.post('/temporary_links/batch/', [{"image": "testimage", "duration": 600}], format="json")
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(TemporaryLink.objects.exists())
+
+
+@override_settings(ROOT_URLCONF="image_api.tests")
+class AsyncServingTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier", thumbnail_formats="webp jpeg", cache_max_age=600)
+        tier.thumbnail_heights.add(th200)
+        self.user = User.objects.create(username="testuser", password="testuserpw")
+        self.client.force_authenticate(user=self.user)
+        iapiu = ImageAPIUser.objects.create(auth_user=self.user, tier=tier)
+        self.image = Image(name="testimage", user=iapiu)
+        self.image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        self.image.save()
+
+    def tearDown(self):
+        remove_blob_files()
+        shutil.rmtree(settings.THUMBNAIL_LOCK_DIR, ignore_errors=True)
+
+    def test_original_served(self):
+        response = self.client.get('/images/testimage/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], self.image.file.url)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertIn("max-age=600", response["Cache-Control"])
+
+        response = self.client.get('/images/testimage/', HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_thumbnail_pending_then_served(self):
+        response = self.client.get('/images/testimage/thumbnail/200/')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {"detail": "Thumbnail is being rendered."})
+
+        run_pending_jobs()
+
+        response = self.client.get('/images/testimage/thumbnail/200/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], Thumbnail.objects.get().file.url)
+
+    @skipUnless(features.check("webp"), "Pillow built without WebP")
+    def test_other_formats_rendered_on_request(self):
+        response = self.client.get('/images/testimage/thumbnail/200/', HTTP_ACCEPT="image/webp")
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertEqual(response["X-Thumbnail-Cache"], "MISS")
+        self.assertEqual(self.client.get('/images/testimage/thumbnail/200/', HTTP_ACCEPT="image/webp")["X-Thumbnail-Cache"], "HIT")
+
+    def test_errors_like_api_views(self):
+        self.assertEqual(self.client.get('/images/otherimage/').json(), {"detail": "Not found."})
+        self.assertEqual(self.client.get('/images/testimage/thumbnail/400/').status_code, 404)
+        self.client.force_authenticate(user=None)
+        self.assertEqual(self.client.get('/images/testimage/').status_code, 403)
+
+    def test_temporary_link_served(self):
+        link = TemporaryLink.objects.create(image=self.image, duration=timedelta(seconds=300))
+
+        response = self.client.get(f'/temporary_links/{link.slug}/')
+        self.assertEqual(response["X-Accel-Redirect"], self.image.file.url)
+        self.assertLessEqual(int(response["Cache-Control"].split("max-age=")[1].split(",")[0]), 300)
+
+    def test_list_actions_not_shadowed(self):
+        self.assertEqual(self.client.get('/images/export/').status_code, 200)
+        self.assertEqual(self.client.get('/temporary_links/export/').status_code, 200)
+        self.assertNotEqual(self.client.post('/images/batch/', {}).status_code, 405)
+        self.assertNotEqual(self.client.post('/temporary_links/batch/', [], format="json").status_code, 405)
+
+    def test_other_methods_handled_by_api_views(self):
+        response = self.client.options('/images/testimage/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("application/json", response.json()["renders"])
+
+
+@override_settings(
+    METRICS_ENABLED=1, PROFILING_ENABLED=1, PROFILING_DIR=settings.MEDIA_ROOT / ".profiles",
+    MIDDLEWARE=["image_api.middleware.MetricsMiddleware", *settings.MIDDLEWARE, "image_api.middleware.ProfilingMiddleware"],
+)
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier")
+        tier.thumbnail_heights.add(th200)
+        self.user = User.objects.create(username="testuser", password="testuserpw", is_staff=True)
+        self.client.force_login(self.user)  # the profiler only knows the user from the session
+        iapiu = ImageAPIUser.objects.create(auth_user=self.user, tier=tier)
+        image = Image(name="testimage", user=iapiu)
+        image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        image.save()
+
+    def tearDown(self):
+        remove_blob_files()
+        shutil.rmtree(settings.MEDIA_ROOT / ".profiles", ignore_errors=True)
+
+    def test_rendering_and_queue_metrics(self):
+        self.assertIn('job_queue_depth{kind="render_thumbnails",status="queued"} 1', self.client.get('/metrics').content.decode())
+
+        run_pending_jobs()
+
+        exposition = self.client.get('/metrics').content.decode()
+        self.assertIn('pillow_duration_seconds_count{format="png",stage="decode"}', exposition)
+        self.assertIn('pillow_duration_seconds_count{format="jpeg",stage="encode"}', exposition)
+        self.assertIn('rendition_bytes_count{format="jpeg"}', exposition)
+        self.assertNotIn('job_queue_depth{kind="render_thumbnails"', exposition)
+
+    def test_request_metrics(self):
+        run_pending_jobs()
+        response = self.client.get('/images/testimage/thumbnail/200/')
+        self.assertIn("db;dur=", response["Server-Timing"])
+
+        exposition = self.client.get('/metrics').content.decode()
+        self.assertIn('http_request_duration_seconds_count{method="GET",status="200",view="image-thumbnail"}', exposition)
+        self.assertIn('http_request_db_queries_bucket{view="image-thumbnail",le="+Inf"}', exposition)
+
+    # without the sync only profiler, so the whole chain runs as coroutines
+    @override_settings(ROOT_URLCONF="image_api.tests", MIDDLEWARE=["image_api.middleware.MetricsMiddleware", *settings.MIDDLEWARE])
+    async def test_queries_counted_under_asgi(self):
+        await sync_to_async(run_pending_jobs)()
+        await sync_to_async(self.async_client.force_login)(self.user)
+        # the test client signals request_started from a thread of its own, servers do it from the one running the queries
+        await sync_to_async(install_query_recorder)(None)
+
+        response = await self.async_client.get('/images/testimage/thumbnail/200/')
+
+        self.assertEqual(response.status_code, 200)
+        queries = int(re.search(r'desc="(\d+) queries"', response["Server-Timing"]).group(1))
+        self.assertGreater(queries, 0)
+        self.assertTrue(asyncio.iscoroutinefunction(MetricsMiddleware(self.async_client.handler.get_response_async)))
+
+    @override_settings(METRICS_ENABLED=0)
+    def test_metrics_disabled(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    def test_staff_requests_profiled(self):
+        response = self.client.get('/images/', HTTP_X_PROFILE="1")
+        stats = pstats.Stats(str(settings.MEDIA_ROOT / ".profiles" / response["X-Profile"]))
+        self.assertIn("list", {function for filename, line, function in stats.stats if filename.endswith("mixins.py")})
+
+        self.user.is_staff = False
+        self.user.save()
+        self.assertNotIn("X-Profile", self.client.get('/images/', HTTP_X_PROFILE="1"))
+
+
+class JobTestCase(TestCase):
+    def setUp(self):
+        th200 = ThumbnailHeight.objects.create(height=200)
+        tier = Tier.objects.create(name="testtier")
+        tier.thumbnail_heights.add(th200)
+        user = User.objects.create(username="testuser", password="testuserpw")
+        self.iapiu = ImageAPIUser.objects.create(auth_user=user, tier=tier)
+
+    def tearDown(self):
+        remove_blob_files()
+
+    @override_settings(JOB_MAX_ATTEMPTS=1)
+    def test_broken_image_marks_thumbnails_failed(self):
+        image = Image(name="brokenimage", user=self.iapiu)
+        image.file = SimpleUploadedFile(name='Broken.png', content=b"not an image", content_type='image/png')
+        image.save()
+
+        run_pending_jobs()
+
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+        self.assertEqual(Thumbnail.objects.get().status, Thumbnail.FAILED)
+
+    def test_failed_job_is_retried(self):
+        image = Image(name="brokenimage", user=self.iapiu)
+        image.file = SimpleUploadedFile(name='Broken.png', content=b"not an image", content_type='image/png')
+        image.save()
+
+        run_pending_jobs()
+
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(Thumbnail.objects.get().status, Thumbnail.PENDING)
+
+    def test_worker_command_renders_in_process_pool(self):
+        image = Image(name="testimage", user=self.iapiu)
+        image.file = SimpleUploadedFile(name='TestImage.png', content=open(settings.BASE_DIR / "image_api/test_files/TestImage.png", 'rb').read(), content_type='image/png')
+        image.save()
+
+        call_command("run_worker", "--once", "--processes", "1", stdout=StringIO())
+
+        self.assertEqual(Job.objects.get().status, Job.DONE)
+        self.assertEqual(Thumbnail.objects.get().status, Thumbnail.READY)
+        self.assertTrue(os.path.isfile(Thumbnail.objects.get().file.path))
+
+
+class RenderThumbnailsTestCase(TestCase):
+    def test_original_decoded_once(self):
+        with mock.patch("image_api.rendering.PILImage.open", wraps=PILImage.open) as pil_open:
+            thumbnails = render_thumbnails(settings.BASE_DIR / "image_api/test_files/TestImage.png", [100, 400, 200])
+
+        pil_open.assert_called_once()
+        self.assertEqual(sorted(thumbnails), [100, 200, 400])
+        for height, content in thumbnails.items():
+            self.assertEqual(PILImage.open(content).size[1], height)
+
+    def test_jpeg_sizes_keep_aspect_ratio(self):
+        buffer = BytesIO()
+        PILImage.new("RGB", (3000, 2000), "red").save(buffer, format="JPEG")
+
+        thumbnails = render_thumbnails(buffer, [400, 200])
+
+        self.assertEqual(PILImage.open(thumbnails[400]).size, (600, 400))
+        self.assertEqual(PILImage.open(thumbnails[200]).size, (300, 200))
+
+    def test_peak_allocations_per_render(self):
+        buffer = BytesIO()
+        PILImage.effect_noise((1600, 1200), 64).convert("RGB").save(buffer, format="PNG")
+        name = default_storage.save("blobs/ff/ff/original.png", ContentFile(buffer.getvalue()))
+        self.addCleanup(remove_paths, [name])
+
+        tracemalloc.start()
+        try:
+            with open_original(name) as original:
+                thumbnail = render_thumbnails(original, [1000])[1000]
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # the original is read from a memory map and the thumbnail encoded into its file, so neither is copied into Python objects
+        with thumbnail:
+            self.assertLess(peak, thumbnail.size / 2)
+            self.assertLess(peak, buffer.tell() / 10)
+            self.assertTrue(thumbnail.temporary_file_path().startswith(str(settings.UPLOAD_TEMP_DIR)))
+        self.assertFalse(os.path.exists(thumbnail.temporary_file_path()))
+
+    def test_small_original_not_upscaled(self):
+        buffer = BytesIO()
+        PILImage.new("RGBA", (150, 100)).save(buffer, format="PNG")
+
+        thumbnails = render_thumbnails(buffer, [200])
+
+        self.assertEqual(PILImage.open(thumbnails[200]).size, (150, 100))
@@ -0,0 +1,181 @@
+"""
+On demand thumbnail rendering.
+
+With THUMBNAIL_RENDERING set to "lazy", thumbnails aren't rendered at upload time, but by the first request that needs them.
+Renditions of the height ladder, used for arbitrary thumbnail heights, and formats other than JPEG are always rendered this way.
+Rendered thumbnails are kept on disk, and when they take more than THUMBNAIL_CACHE_MAX_BYTES,
+the least recently requested ones are deleted, to be rendered again if they're ever needed.
+Only thumbnails that went through the cache count, they're the ones with a last_accessed,
+JPEGs rendered in the background are served without it and would never be rendered again.
+Their files are blobs, which `manage.py collect_blobs` deletes once no other image uses them,
+so a blob shared by several cached thumbnails counts once.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from contextlib import contextmanager
+from pathlib import Path
+from image_api.models import Blob, Thumbnail
+from image_api.rendering import FORMATS, open_original, render_thumbnails
+from image_api import metrics
+
+import fcntl
+import os
+import threading
+import time
+import zlib
+
+LOCK_STRIPES = 256  # keys share this many lock files, so the lock directory doesn't grow with the number of thumbnails
+
+# the cache size as this process last measured it, and when, see estimated_cache_size()
+size_estimate = {"size": 0, "measured_at": None}
+size_estimate_lock = threading.Lock()
+
+
+@contextmanager
+def key_lock(key):
+    """Lock held across threads and processes, so only one of them renders a given thumbnail"""
+    os.makedirs(settings.THUMBNAIL_LOCK_DIR, exist_ok=True)
+    stripe = zlib.crc32(key.encode()) % LOCK_STRIPES
+    with open(Path(settings.THUMBNAIL_LOCK_DIR) / f"{stripe}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def touch(thumbnail):
+    """Record a hit, at most once per THUMBNAIL_CACHE_TOUCH_INTERVAL"""
+    now = timezone.now()
+    if thumbnail.last_accessed is None or thumbnail.last_accessed < now - timedelta(seconds=settings.THUMBNAIL_CACHE_TOUCH_INTERVAL):
+        Thumbnail.objects.filter(pk=thumbnail.pk).update(last_accessed=now)
+        thumbnail.last_accessed = now
+
+
+def rendering_source(image, height, format, quality):
+    """
+    The file to render a thumbnail from, the smallest already rendered bigger thumbnail is much cheaper to decode than the original.
+    Only thumbnails of the same format and quality are used, the rendition is stored as if rendered from the original,
+    so it mustn't carry the losses of another encoder or a lower quality.
+    """
+    bigger_thumbnail = (
+        image.thumbnails.filter(status=Thumbnail.READY, thumbnail_height__height__gt=height, format=format, blob__quality=quality)
+        .order_by("thumbnail_height__height")
+        .first()
+    )
+    return bigger_thumbnail.file if bigger_thumbnail is not None else image.file
+
+
+def get_or_render_thumbnail(image, thumbnail_height, format=Thumbnail.JPEG, quality=None):
+    """
+    Return the thumbnail of the image with the given height and format, rendering it if it doesn't exist yet.
+    Returns the thumbnail and whether it was a cache hit.
+    """
+    thumbnail = image.thumbnails.filter(thumbnail_height=thumbnail_height, format=format, status=Thumbnail.READY).first()
+    if thumbnail is not None:
+        metrics.thumbnail_cache_hits.inc()
+        touch(thumbnail)
+        return thumbnail, True
+
+    with key_lock(f"{image.pk}/{thumbnail_height.height}/{format}"):
+        # another request could have rendered the thumbnail while this one waited for the lock
+        thumbnail = image.thumbnails.filter(thumbnail_height=thumbnail_height, format=format).first()
+        if thumbnail is not None and thumbnail.status == Thumbnail.READY:
+            metrics.thumbnail_cache_hits.inc()
+            touch(thumbnail)
+            return thumbnail, True
+
+        height = thumbnail_height.height
+        quality = quality or settings.THUMBNAIL_QUALITY
+        # the rendition could be stored already, for another image with the same original
+        blob = Blob.find_renditions(image.blob, [height], format, quality).get(height)
+        if thumbnail is None:
+            thumbnail = Thumbnail(image=image, thumbnail_height=thumbnail_height, format=format)
+        if blob is None:
+            source = rendering_source(image, height, format, quality)
+            with open_original(source.name) as file:
+                content = render_thumbnails(file, [height], format, quality)[height]
+            with content:
+                if image.blob is None:  # stored before blobs existed, there's no original to key the rendition by
+                    thumbnail.use_file(content, f"thumbnail{FORMATS[format][2]}")
+                else:
+                    blob = Blob.store(content, f"thumbnail{FORMATS[format][2]}", image.blob, height, format, quality)
+        if blob is not None:
+            thumbnail.use_blob(blob)
+        thumbnail.last_accessed = timezone.now()
+        try:
+            with transaction.atomic():
+                thumbnail.save()
+        except IntegrityError:
+            # created by a process the lock isn't shared with, like one on another host, it's given the rendition
+            thumbnail.pk = image.thumbnails.values_list("pk", flat=True).get(thumbnail_height=thumbnail_height, format=format)
+            thumbnail.save()
+    metrics.thumbnail_cache_misses.inc()
+
+    if settings.THUMBNAIL_CACHE_MAX_BYTES:
+        added = 0 if shares_blob(thumbnail) else thumbnail.size
+        evict_cold_thumbnails(size=estimated_cache_size(added=added))
+    return thumbnail, False
+
+
+def cached_thumbnails():
+    """The thumbnails the disk budget applies to, those rendered or served by get_or_render_thumbnail"""
+    return Thumbnail.objects.filter(status=Thumbnail.READY, last_accessed__isnull=False)
+
+
+def shares_blob(thumbnail):
+    """Whether another cached thumbnail uses the blob of the thumbnail, whose size is then counted already"""
+    return thumbnail.blob_id is not None and cached_thumbnails().filter(blob_id=thumbnail.blob_id).exclude(pk=thumbnail.pk).exists()
+
+
+def cache_size():
+    """The size of the blobs of cached thumbnails, each counted once, and of the thumbnails stored without one"""
+    blobs = Blob.objects.filter(pk__in=cached_thumbnails().values("blob_id")).aggregate(size=Sum("size"))["size"] or 0
+    files = cached_thumbnails().filter(blob__isnull=True).aggregate(size=Sum("size"))["size"] or 0
+    return blobs + files
+
+
+def estimated_cache_size(added=0):
+    """
+    The cache size without a query on every miss: it's measured at most every THUMBNAIL_CACHE_SIZE_INTERVAL seconds,
+    and the sizes this process adds and evicts are counted in between. Other processes' are seen at the next measurement.
+    """
+    with size_estimate_lock:
+        now = time.monotonic()
+        measured_at = size_estimate["measured_at"]
+        if measured_at is None or now - measured_at > settings.THUMBNAIL_CACHE_SIZE_INTERVAL:
+            size_estimate.update(size=cache_size(), measured_at=now)  # already includes the added thumbnail
+        else:
+            size_estimate["size"] += added
+        return size_estimate["size"]
+
+
+def evict_cold_thumbnails(batch_size=100, size=None):
+    """
+    Delete the least recently used thumbnails until they fit into the disk budget, returns the number of deleted thumbnails.
+    The size of the cache is measured, unless it's given.
+    """
+    if not settings.THUMBNAIL_CACHE_MAX_BYTES:
+        return 0
+    excess = (cache_size() if size is None else size) - settings.THUMBNAIL_CACHE_MAX_BYTES
+    evicted = freed = 0
+    while excess > 0:
+        coldest = list(cached_thumbnails().order_by("last_accessed", "id")[:batch_size])
+        if not coldest:
+            break
+        for thumbnail in coldest:
+            thumbnail.delete()  # the blob is left to collect_blobs, as other images may share it
+            evicted += 1
+            if shares_blob(thumbnail):  # still counted for the thumbnails left
+                continue
+            excess -= thumbnail.size
+            freed += thumbnail.size
+            if excess <= 0:
+                break
+    with size_estimate_lock:
+        size_estimate["size"] -= freed
+    metrics.thumbnail_cache_evictions.inc(evicted)
+    return evicted
@@ -0,0 +1,163 @@
+"""
+Upload handling that never holds a whole image in memory.
+
+Uploads are spooled to UPLOAD_TEMP_DIR, which is on the media volume, so storing them as blobs is a rename.
+Only the first bytes of an upload are read to check its format and size, and resumable uploads (see UploadSession)
+are appended to their part file in small chunks, as they're read from the request.
+"""
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from PIL import Image as PILImage
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+import os
+import re
+import tempfile
+import warnings
+
+CHUNK_SIZE = 64 * 1024  # bytes read from the request at a time
+SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "PNG",
+    b"\xff\xd8\xff": "JPEG",
+}
+CONTENT_RANGE = re.compile(r"^bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)$")
+
+
+class RejectedImage(APIException):
+    """An upload the API won't accept, its details aren't turned into strings, so the sizes in them stay numbers"""
+
+    def __init__(self, **details):
+        super().__init__()
+        self.detail = {"detail": self.default_detail, "code": self.default_code, **details}
+
+
+class ImageTooLarge(RejectedImage):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "The image is too large."
+    default_code = "image_too_large"
+
+
+class UploadTooLarge(RejectedImage):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "The upload is too large."
+    default_code = "upload_too_large"
+
+
+class UnreadableImage(RejectedImage):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = "The size of the image can't be read from its header."
+    default_code = "unreadable_image"
+
+
+class SpooledUploadedFile(TemporaryUploadedFile):
+    """An uploaded file written to a temporary file in UPLOAD_TEMP_DIR"""
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+        file = tempfile.NamedTemporaryFile(suffix=".upload" + os.path.splitext(name)[1], dir=settings.UPLOAD_TEMP_DIR)
+        super(TemporaryUploadedFile, self).__init__(file, name, content_type, size, charset, content_type_extra)
+
+
+class MediaVolumeUploadHandler(TemporaryFileUploadHandler):
+    """Upload handler spooling every upload to a temporary file in UPLOAD_TEMP_DIR, however small it is"""
+
+    def new_file(self, *args, **kwargs):
+        super(TemporaryFileUploadHandler, self).new_file(*args, **kwargs)
+        self.file = SpooledUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+
+
+class SpooledFile(File):
+    """A file in UPLOAD_TEMP_DIR, the storage moves it to its place instead of copying it"""
+
+    def __init__(self, path, name):
+        super().__init__(open(path, "rb"), name)
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def sniff_image_format(file):
+    """Guess the format of an image from its first bytes, returns None for anything but PNGs and JPEGs"""
+    file.seek(0)
+    header = file.read(max(len(signature) for signature in SIGNATURES))
+    file.seek(0)
+    for signature, format in SIGNATURES.items():
+        if header.startswith(signature):
+            return format
+    return None
+
+
+def check_image_size(file, max_pixels, max_dimension):
+    """
+    Make sure an image is within the pixel budget, reading only its header, so images declaring huge sizes
+    are rejected before anything decodes them. Raises ImageTooLarge or UnreadableImage, with the limits in the details.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", PILImage.DecompressionBombWarning)
+            width, height = PILImage.open(file).size  # open() is lazy, it only parses the header
+    except PILImage.DecompressionBombError:  # way over Pillow's own limit, the size isn't even returned
+        width, height = None, None
+    except (OSError, SyntaxError, ValueError):
+        raise UnreadableImage()
+    finally:
+        file.seek(0)
+
+    if width is None or width * height > max_pixels or max(width, height) > max_dimension:
+        raise ImageTooLarge(width=width, height=height, max_pixels=max_pixels, max_dimension=max_dimension)
+
+
+def check_upload_size(size, max_size):
+    """Make sure an upload doesn't take more than max_size bytes, raises UploadTooLarge with the limit in the details"""
+    if size > max_size:
+        raise UploadTooLarge(size=size, max_size=max_size)
+
+
+def check_partial_image_size(file, max_pixels, max_dimension):
+    """check_image_size for an upload still in progress, a header that isn't completely received yet isn't an error"""
+    try:
+        check_image_size(file, max_pixels, max_dimension)
+    except UnreadableImage:
+        pass
+
+
+def parse_content_range(header):
+    """
+    Parse a Content-Range header of a request, returns (start, end, total).
+    Start and end are None for "bytes */total", which only tells the total size, and total is None if it's not known yet.
+    """
+    match = CONTENT_RANGE.match(header or "")
+    if match is None:
+        raise ValueError(f"Invalid Content-Range {header!r}")
+    start, end, total = match.groups()
+    start, end, total = (int(value) if value not in (None, "*") else None for value in (start, end, total))
+    if start is not None and (end < start or (total is not None and end >= total)):
+        raise ValueError(f"Invalid Content-Range {header!r}")
+    return start, end, total
+
+
+def copy_stream(stream, file, length):
+    """Copy up to `length` bytes from the stream to the file, one chunk at a time, returns the number of bytes copied"""
+    copied = 0
+    while copied < length:
+        chunk = stream.read(min(CHUNK_SIZE, length - copied))
+        if not chunk:
+            break
+        file.write(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def skip_stream(stream, length):
+    """Read and throw away `length` bytes of the stream, used for the already received part of a retried chunk"""
+    skipped = 0
+    while skipped < length:
+        chunk = stream.read(min(CHUNK_SIZE, length - skipped))
+        if not chunk:
+            break
+        skipped += len(chunk)
+    return skipped
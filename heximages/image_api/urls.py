@@ -5,7 +5,11 @@ from image_api import views
 router = DefaultRouter()
 router.register(r'images', views.ImageViewSet, 'image')
 router.register(r'temporary_links', views.TemporaryLinkViewSet, 'temporarylink')
+router.register(r'uploads', views.UploadSessionViewSet, 'upload')
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('signed/<str:token>', views.signed_media, name='signed-media'),
+    path('thumbnail_cache/', views.ThumbnailCacheStatsView.as_view(), name='thumbnail-cache-stats'),
+    path('metrics', views.prometheus_metrics, name='metrics'),
 ]
@@ -1,27 +1,95 @@
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework import viewsets
-from image_api.models import Image, TemporaryLink, ThumbnailHeight
-from image_api.serializers import ImageSerializer, TemporaryLinkSerializer
+from rest_framework import mixins, viewsets, status
+from rest_framework.exceptions import APIException, ParseError, ValidationError
+from image_api.models import Blob, Image, TemporaryLink, Thumbnail, ThumbnailHeight, UploadSession, reconcile_thumbnails
+from image_api.serializers import ImageSerializer, TemporaryLinkBatchItemSerializer, TemporaryLinkSerializer, UploadSessionSerializer
+from image_api.uploads import ImageTooLarge, RejectedImage, SpooledFile, check_image_size, check_partial_image_size, check_upload_size, copy_stream, parse_content_range, skip_stream, sniff_image_format
 from rest_framework import permissions
 from image_api.permissions import IsImageOwnerOrReadOnly, IsTemporaryLinkCapableOrReadOnly, IsTemporaryLinkOwnerOrReadOnly
+from image_api.capabilities import get_capabilities
+from image_api.pagination import ImageCursorPagination, TemporaryLinkCursorPagination
+from rest_framework.renderers import JSONRenderer
+from django.http import HttpResponse, HttpResponseRedirect, Http404, StreamingHttpResponse
+from django.core.files.storage import default_storage
+from django.core import signing
+from image_api.signing import unsign_link
+from image_api.storage import filesystem_storage
+from urllib.parse import urlsplit
+import mimetypes
 from pathlib import Path
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch
+from django.shortcuts import get_object_or_404
+from rest_framework.views import APIView
+from image_api.thumbnail_cache import cache_size, get_or_render_thumbnail
+from image_api.rendering import FORMATS, snap_to_ladder
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from image_api.http_cache import add_cache_headers, is_versioned_request, not_modified
 from django.utils import timezone
-from django.db.models import F
+from image_api import metrics
+import fcntl
+import os
 
 
-class ImageViewSet(viewsets.ModelViewSet):
+class NDJSONExportMixin:
+    """
+    Mixin adding an export action, which streams the whole list as newline delimited JSON.
+    Objects are fetched in keyset chunks, so the memory used doesn't depend on the size of the list.
+    """
+
+    @action(detail=False)
+    def export(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).order_by("pk")
+        context = self.get_serializer_context()
+        serializer_class = self.get_serializer_class()
+        renderer = JSONRenderer()
+
+        def rows():
+            last_pk = 0
+            while True:
+                # slicing instead of iterator() keeps the prefetches of get_queryset working for every chunk
+                chunk = list(queryset.filter(pk__gt=last_pk)[:settings.EXPORT_CHUNK_SIZE])
+                if not chunk:
+                    break
+                for obj in chunk:
+                    yield renderer.render(serializer_class(obj, context=context).data) + b"\n"
+                last_pk = chunk[-1].pk
+
+        return StreamingHttpResponse(rows(), content_type="application/x-ndjson")
+
+
+def batch_response(results):
+    """The per item results of a batch request, 201 if every item was created, 207 if some of them weren't"""
+    all_created = all(result["status"] == status.HTTP_201_CREATED for result in results)
+    return Response({"results": results}, status=status.HTTP_201_CREATED if all_created else status.HTTP_207_MULTI_STATUS)
+
+
+class FileActionsMixin:
+    """
+    Mixin for viewsets with actions serving files through nginx.
+    Those are requested with image media types in Accept, which no renderer matches,
+    so content negotiation falls back to the default renderer for them, used only for errors.
+    """
+
+    file_actions = ()
+
+    def perform_content_negotiation(self, request, force=False):
+        return super().perform_content_negotiation(request, force=force or self.action in self.file_actions)
+
+
+class ImageViewSet(FileActionsMixin, NDJSONExportMixin, viewsets.ModelViewSet):
 
     serializer_class = ImageSerializer
+    pagination_class = ImageCursorPagination
     permission_classes = [permissions.IsAuthenticated, IsImageOwnerOrReadOnly]
     lookup_field = 'name'
+    file_actions = ("retrieve", "thumbnail")
 
     def retrieve(self, request, name, *args, **kwargs):
         image = self.get_object()
-        content_type = "image/png" if Path(image.file.path).suffix == "png" else "image/jpeg"
-        response = Response(content_type=content_type)
-        response['X-Accel-Redirect'] = image.file.url  # X-Accel-Redirect is used to serve the asset behind the scenes using NGINX
-        return response
+        return serve_image(request, image, get_capabilities(request).cache_max_age, is_versioned_request(request, image.content_hash))
 
     @action(detail=True, url_path=r'thumbnail/(?P<height>[\d]+)')
     def thumbnail(self, request, height, *args, **kwargs):
@@ -30,46 +98,359 @@ class ImageViewSet(viewsets.ModelViewSet):
         as they are an unseparable part of their image, and should be viewed as such
         """
         image = self.get_object()
-        thumbnail_height = ThumbnailHeight.objects.get(height=height)
-        thumbnail = image.thumbnails.get(thumbnail_height=thumbnail_height)
-        content_type = "image/jpeg"  # thumbnails are always JPEG
-        response = Response(content_type=content_type)
-        response['X-Accel-Redirect'] = thumbnail.file.url  # X-Accel-Redirect is used to serve the asset behind the scenes using NGINX
-        return response
+        capabilities = get_capabilities(request)
+        thumbnail_height, lazy = resolve_thumbnail_height(capabilities, int(height))
+        format = capabilities.negotiate_format(request.headers.get("Accept", ""))
+        hit = None
+        if lazy or format != Thumbnail.JPEG:
+            # only JPEGs are rendered in the background, other formats are rendered by the first request for them
+            thumbnail, hit = get_or_render_thumbnail(image, thumbnail_height, format, capabilities.thumbnail_quality)
+        else:
+            thumbnail = get_object_or_404(image.thumbnails, thumbnail_height=thumbnail_height, format=Thumbnail.JPEG)
+            response = unready_thumbnail_response(thumbnail)
+            if response is not None:
+                return response
+        return serve_thumbnail(request, image, thumbnail, thumbnail_height, format, capabilities.cache_max_age, hit)
 
-    def get_queryset(self):
-        user = self.request.user.image_api_user
+    @action(detail=False, methods=["post"])
+    def batch(self, request, *args, **kwargs):
+        """
+        Upload many images in one multipart request, with a "file" and a "name" field for each of them, in the same order.
+        Every file is checked like a single upload, but names are checked with one query for the whole batch,
+        and the images and their thumbnails are inserted in bulk. Rejected files don't stop the others.
+        """
+        if not hasattr(request.data, "getlist"):
+            raise ParseError("Images must be sent as multipart form data")
+        files, names = request.data.getlist("file"), request.data.getlist("name")
+        if not files or len(files) != len(names):
+            raise ValidationError({"file": "Send a name for every file, in the same order"})
+        if len(files) > settings.BATCH_MAX_ITEMS:
+            raise ValidationError({"file": f"A batch can't have more than {settings.BATCH_MAX_ITEMS} images"})
+
+        capabilities = get_capabilities(request)
+        name_field = self.get_serializer().fields["name"]
+        existing_names = set(Image.objects.filter(user_id=capabilities.image_api_user_id, name__in=names).values_list("name", flat=True))
+        results, images = [], []
+        for file, name in zip(files, names):
+            try:
+                try:
+                    name = name_field.run_validation(name)
+                except ValidationError as e:
+                    raise ValidationError({"name": e.detail})
+                if name in existing_names:
+                    raise ValidationError({"name": "That image already exists!"})
+                if sniff_image_format(file) not in ('PNG', 'JPEG'):
+                    raise ValidationError({"file": "Image must be a PNG or a JPEG"})
+                check_image_size(file, capabilities.max_pixels, capabilities.max_dimension)
+            except APIException as e:
+                results.append({"status": e.status_code, "errors": e.detail})
+                continue
+            existing_names.add(name)  # later files with the same name are rejected
+            image = Image(name=name, user_id=capabilities.image_api_user_id)
+            image.use_blob(Blob.store(file, file.name))
+            images.append(image)
+            results.append({"status": status.HTTP_201_CREATED, "name": name})
+
+        with transaction.atomic():
+            Image.objects.bulk_create(images)
+            created = {image.name: image for image in self.get_queryset().filter(name__in=[image.name for image in images])}
+            thumbnail_height_ids = list(ThumbnailHeight.objects.filter(height__in=capabilities.thumbnail_heights).values_list("id", flat=True))
+            reconcile_thumbnails([image.pk for image in created.values()], thumbnail_height_ids)
 
-        # dirty hack to make sure outdated links are deleted
-        # this has to be placed in the get_queryset of every
-        # ViewSet that includes temporary links
-        # I couldn't find a proper way to do it, but this works
-        outdated_links = TemporaryLink.objects.filter(datetime_created__lte=timezone.now() - F("duration"))
-        outdated_links.delete()
+        context = self.get_serializer_context()
+        for result in results:
+            if result["status"] == status.HTTP_201_CREATED:
+                result["data"] = ImageSerializer(created[result.pop("name")], context=context).data
+        return batch_response(results)
 
-        queryset = Image.objects.filter(user=user)
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["capabilities"] = get_capabilities(self.request)
+        return context
+
+    def get_queryset(self):
+        capabilities = get_capabilities(self.request)
+        queryset = Image.objects.filter(user_id=capabilities.image_api_user_id)
+        if self.action in ("list", "export", "batch"):
+            # everything the serializer touches is fetched up front, so listing doesn't make queries per image
+            queryset = queryset.select_related("user__auth_user").prefetch_related(
+                Prefetch("thumbnails", queryset=Thumbnail.objects.select_related("thumbnail_height")),
+                # expired links are only deleted by `manage.py purge_expired_links`, so they have to be filtered out
+                Prefetch("temporary_links", queryset=TemporaryLink.objects.active()),
+            )
         return queryset
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user.image_api_user)
 
 
-class TemporaryLinkViewSet(viewsets.ModelViewSet):
+class TemporaryLinkViewSet(FileActionsMixin, NDJSONExportMixin, viewsets.ModelViewSet):
 
     serializer_class = TemporaryLinkSerializer
+    pagination_class = TemporaryLinkCursorPagination
     permission_classes = [permissions.IsAuthenticated, IsTemporaryLinkOwnerOrReadOnly, IsTemporaryLinkCapableOrReadOnly]
     lookup_field = 'slug'
+    file_actions = ("retrieve",)
 
     def retrieve(self, request, *args, **kwargs):
         temporary_link = self.get_object()
-        content_type = "image/png" if Path(temporary_link.image.file.path).suffix == "png" else "image/jpeg"
-        response = Response(content_type=content_type)
-        response['X-Accel-Redirect'] = temporary_link.image.file.url  # X-Accel-Redirect is used to serve the asset behind the scenes using NGINX
-        return response
+        # the link mustn't outlive its expiry in any cache
+        max_age = min(get_capabilities(request).cache_max_age, (temporary_link.expires_at - timezone.now()).total_seconds())
+        return serve_image(request, temporary_link.image, max_age)
+
+    @action(detail=False, methods=["post"])
+    def batch(self, request, *args, **kwargs):
+        """
+        Create many temporary links in one request, from a list of {"image": name, "duration": seconds} objects.
+        The tier is checked once, every image is looked up with a single query, and the links are inserted in bulk.
+        Invalid items don't stop the others.
+        """
+        if not isinstance(request.data, list) or not request.data:
+            raise ValidationError({"non_field_errors": "Send a list of links to create"})
+        if len(request.data) > settings.BATCH_MAX_ITEMS:
+            raise ValidationError({"non_field_errors": f"A batch can't have more than {settings.BATCH_MAX_ITEMS} links"})
+
+        items = [TemporaryLinkBatchItemSerializer(data=item) for item in request.data]
+        names = [item.validated_data["image"] for item in items if item.is_valid()]
+        images = {image.name: image for image in Image.objects.filter(user_id=get_capabilities(request).image_api_user_id, name__in=names)}
+        results, links = [], []
+        for item in items:
+            if item.errors:
+                results.append({"status": status.HTTP_400_BAD_REQUEST, "errors": item.errors})
+            elif item.validated_data["image"] not in images:
+                results.append({"status": status.HTTP_400_BAD_REQUEST, "errors": {"image": ["Object with name={} does not exist.".format(item.validated_data["image"])]}})
+            else:
+                link = TemporaryLink(image=images[item.validated_data["image"]], duration=item.validated_data["duration"])
+                link.expires_at = link.datetime_created + link.duration  # set by save(), which bulk_create doesn't call
+                links.append(link)
+                results.append({"status": status.HTTP_201_CREATED, "data": link})
+
+        TemporaryLink.objects.bulk_create(links)
+        context = self.get_serializer_context()
+        for result in results:
+            if "data" in result:
+                result["data"] = TemporaryLinkSerializer(result["data"], context=context).data
+        return batch_response(results)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["capabilities"] = get_capabilities(self.request)
+        return context
 
     def get_queryset(self):
-        user = self.request.user.image_api_user
-        outdated_links = TemporaryLink.objects.filter(datetime_created__lte=timezone.now() - F("duration"))
-        outdated_links.delete()
-        queryset = TemporaryLink.objects.filter(image__user=user)
+        capabilities = get_capabilities(self.request)
+        queryset = TemporaryLink.objects.active().filter(image__user_id=capabilities.image_api_user_id).select_related("image")
         return queryset
+
+
+class UploadSessionViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """
+    Resumable uploads. A session is created with the name of the image, then the file is sent in PUT requests
+    with a Content-Range each, and the one completing the file creates the image.
+    After a failed request, the session tells how many bytes were received, so only the rest has to be sent again.
+    """
+
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    lookup_field = 'slug'
+
+    def get_queryset(self):
+        return UploadSession.objects.active().filter(user_id=get_capabilities(self.request).image_api_user_id)
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user.image_api_user)
+
+    def update(self, request, *args, **kwargs):
+        session = self.get_object()
+        try:
+            start, end, total = parse_content_range(request.headers.get("Content-Range"))
+        except ValueError as e:
+            raise ParseError(str(e))
+        if total is not None:
+            check_upload_size(total, settings.UPLOAD_SESSION_MAX_SIZE)
+        if start is not None:
+            check_upload_size(end + 1, settings.UPLOAD_SESSION_MAX_SIZE)
+
+        os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+        with os.fdopen(os.open(session.part_path, os.O_RDWR | os.O_CREAT, 0o600), "r+b") as part:
+            try:
+                fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:  # another request is writing to this upload
+                return self.progress(session, status.HTTP_409_CONFLICT)
+            # the progress is read, written and saved, and the upload completed, all while holding the lock,
+            # so concurrent requests can't roll back the received bytes or complete the upload twice
+            try:
+                session.refresh_from_db(fields=["size", "received"])
+            except UploadSession.DoesNotExist:  # completed or deleted by the request holding the lock before
+                os.remove(session.part_path)  # created again by opening it
+                raise Http404
+            if total is not None:
+                if session.size is not None and session.size != total:
+                    raise ParseError("The total size doesn't match the size of the upload")
+                session.size = total
+            if start is not None:
+                if start > session.received:  # the chunk doesn't continue the received bytes
+                    return self.progress(session, status.HTTP_409_CONFLICT)
+                stream = request.stream
+                if stream is not None and skip_stream(stream, session.received - start) == session.received - start:
+                    # bytes written by a request that failed before it counted them are overwritten
+                    part.seek(session.received)
+                    part.truncate()
+                    session.received += copy_stream(stream, part, end + 1 - session.received)
+                    part.flush()
+                    # a header declaring too many pixels is rejected as soon as it's received, not after the whole file
+                    capabilities = get_capabilities(request)
+                    try:
+                        check_partial_image_size(part, capabilities.max_pixels, capabilities.max_dimension)
+                    except ImageTooLarge:
+                        session.delete()
+                        raise
+            session.save(update_fields=["size", "received"])
+
+            if session.size is not None and session.received >= session.size:
+                return self.complete(session)
+        return self.progress(session, status.HTTP_200_OK)
+
+    def progress(self, session, status_code):
+        """Tell the client how much of the file was received, in the body and in a Range header"""
+        headers = {"Range": f"bytes=0-{session.received - 1}"} if session.received else {}
+        return Response(self.get_serializer(session).data, status=status_code, headers=headers)
+
+    def complete(self, session):
+        """Turn the complete upload into an image, its part file is moved to the blob storage, called with the part file locked"""
+        with SpooledFile(session.part_path, session.filename) as file:
+            if sniff_image_format(file) not in ('PNG', 'JPEG'):
+                session.delete()
+                raise ValidationError({"file": "Image must be a PNG or a JPEG"})
+            capabilities = get_capabilities(self.request)
+            try:
+                check_image_size(file, capabilities.max_pixels, capabilities.max_dimension)
+            except RejectedImage:
+                session.delete()
+                raise
+            if Image.objects.filter(name=session.name, user=session.user).exists():
+                session.delete()
+                raise ValidationError({"name": "That image already exists!"})
+            image = Image(name=session.name, user=session.user)
+            image.file = file
+            image.save()
+        session.delete()
+        context = {**self.get_serializer_context(), "capabilities": get_capabilities(self.request)}
+        return Response(ImageSerializer(image, context=context).data, status=status.HTTP_201_CREATED)
+
+
+class ThumbnailCacheStatsView(APIView):
+    """Counters of the lazy thumbnail cache, the hit, miss and eviction counts are those of the process serving the request"""
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            "hits": metrics.thumbnail_cache_hits.value,
+            "misses": metrics.thumbnail_cache_misses.value,
+            "evictions": metrics.thumbnail_cache_evictions.value,
+            "size": cache_size(),
+            "max_size": settings.THUMBNAIL_CACHE_MAX_BYTES,
+        })
+
+
+def prometheus_metrics(request):
+    """The metrics of the process serving the request, in the Prometheus text format, only available with METRICS_ENABLED"""
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def signed_media(request, token):
+    """
+    Serve a signed temporary link.
+    The token is verified without touching the DB (unless revocation checks are enabled),
+    and authentication isn't needed, as the signature proves the link was created by the owner.
+    """
+    try:
+        payload = unsign_link(token)
+    except signing.BadSignature:
+        raise Http404
+    if settings.SIGNED_LINK_CHECK_REVOCATION and not TemporaryLink.objects.active().filter(slug=payload["s"]).exists():
+        raise Http404
+    if redirects_to_object_storage():
+        return object_storage_redirect(payload["p"], 0)
+    return file_response(payload["p"], mimetypes.guess_type(payload["p"])[0] or "image/jpeg")
+
+
+def redirects_to_object_storage():
+    return settings.MEDIA_DELIVERY == "redirect" and not filesystem_storage()
+
+
+def object_storage_redirect(name, max_age):
+    """
+    Redirect to a presigned URL of a file in the object storage, which clients fetch it from directly.
+    The redirect is cached for at most half the lifetime of the URL, and without validators,
+    which would keep revalidating a redirect to a URL that has expired.
+    """
+    response = HttpResponseRedirect(default_storage.public_url(name))
+    patch_cache_control(response, private=True, max_age=min(max(int(max_age), 0), settings.AWS_QUERYSTRING_EXPIRE // 2))
+    return response
+
+
+def file_response(name, content_type):
+    """A response having nginx send the file, from the media directory, or fetched from a presigned URL of the object storage"""
+    response = HttpResponse(content_type=content_type)
+    if filesystem_storage():
+        response['X-Accel-Redirect'] = default_storage.url(name)  # X-Accel-Redirect is used to serve the asset behind the scenes using NGINX
+    else:
+        # nginx proxies /object_storage/<scheme>/<host>/<path> to the URL, see nginx.conf
+        url = urlsplit(default_storage.url(name))
+        response['X-Accel-Redirect'] = f"/object_storage/{url.scheme}/{url.netloc}{url.path}?{url.query}"
+    return response
+
+
+def serve_file(request, name, content_type, content_hash, last_modified, max_age, immutable=False):
+    """Answer a conditional request with 304, or have nginx send the file, the cache headers are added to both"""
+    if redirects_to_object_storage():
+        return object_storage_redirect(name, max_age)
+    response = not_modified(request, content_hash, last_modified)
+    if response is None:
+        response = file_response(name, content_type)
+    return add_cache_headers(response, content_hash, last_modified, max_age, immutable)
+
+
+def serve_image(request, image, max_age, immutable=False):
+    content_type = mimetypes.guess_type(image.file.name)[0] or "image/jpeg"
+    return serve_file(request, image.file.name, content_type, image.content_hash, image.datetime_uploaded, max_age, immutable)
+
+
+def serve_thumbnail(request, image, thumbnail, thumbnail_height, format, max_age, hit=None):
+    """Serve a rendered thumbnail, hit is whether a thumbnail rendered on demand was already there, None for background ones"""
+    # thumbnails are rendered from the original, so its version makes their URLs content addressed too
+    immutable = is_versioned_request(request, image.content_hash)
+    response = serve_file(request, thumbnail.file.name, FORMATS[format][1], thumbnail.content_hash, thumbnail.datetime_rendered, max_age, immutable)
+    patch_vary_headers(response, ["Accept"])  # the format depends on the Accept header
+    if hit is not None:
+        response['X-Thumbnail-Cache'] = "HIT" if hit else "MISS"
+        response['X-Thumbnail-Height'] = thumbnail_height.height
+    return response
+
+
+def resolve_thumbnail_height(capabilities, height):
+    """
+    The ThumbnailHeight serving a requested height, and whether it's rendered on demand.
+    Raises Http404 for heights the tier doesn't allow.
+    """
+    if height in capabilities.thumbnail_heights:
+        return get_object_or_404(ThumbnailHeight, height=height), settings.THUMBNAIL_RENDERING == "lazy"
+    if capabilities.allows_arbitrary_height(height):
+        # arbitrary heights are served the closest rendition of the ladder, rendered on demand
+        thumbnail_height, _ = ThumbnailHeight.objects.get_or_create(height=snap_to_ladder(height))
+        return thumbnail_height, True
+    raise Http404
+
+
+def unready_thumbnail_response(thumbnail, response_class=Response):
+    """The response for a thumbnail the background worker hasn't rendered, None if it's ready"""
+    if thumbnail.status == Thumbnail.PENDING:
+        # the thumbnail is still waiting for the background worker
+        return response_class({"detail": "Thumbnail is being rendered."}, status=status.HTTP_202_ACCEPTED, headers={"Retry-After": str(settings.THUMBNAIL_RETRY_AFTER)})
+    if thumbnail.status == Thumbnail.FAILED:
+        return response_class({"detail": "Thumbnail could not be rendered."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return None